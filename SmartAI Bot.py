@@ -11,18 +11,35 @@ import os
 import random
 import asyncio
 import aiohttp
+from abc import ABC, abstractmethod
+from array import array
+import bisect
+import math
 import re
 import feedparser
+import hashlib
+import heapq
+import itertools
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 import pytz
-from typing import Optional, Dict, List, Union, cast
+from typing import Optional, Dict, List, Union, AsyncIterator, Iterable, cast
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
-    CallbackQueryHandler, filters, ContextTypes
+    CallbackQueryHandler, ChatMemberHandler, filters, ContextTypes, ApplicationHandlerStop, TypeHandler
 )
+from telegram.request import HTTPXRequest
 from telegram.constants import ParseMode, ChatAction
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from metrics_bridge import metrics_file_path, write_metrics
 
 # === BEZPIECZEŃSTWO - ZMIENNE ŚRODOWISKOWE ===
 from dotenv import load_dotenv
@@ -32,6 +49,8 @@ load_dotenv()
 
 # === KONFIGURACJA LOGOWANIA Z ROTACJĄ I LIMITAMI ===
 import logging.handlers
+import queue
+import atexit
 
 # Stwórz folder logs jeśli nie istnieje
 if not os.path.exists('logs'):
@@ -55,42 +74,2394 @@ rotating_handler.setFormatter(formatter)
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(formatter)
 
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler bez formatowania w wątku wywołującym - robi to wątek listenera
+    
+    Kolejka jest lokalna dla procesu, więc rekord (z argumentami) nie musi być
+    serializowany; formatowanie %-argumentów odbywa się dopiero w handlerach.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# Pętla zdarzeń tylko wrzuca rekordy do kolejki; zapis na dysk/konsolę robi osobny wątek
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue, rotating_handler, console_handler, respect_handler_level=True
+)
+
 # Konfiguracja głównego loggera
 logging.basicConfig(
     level=logging.INFO,
-    handlers=[rotating_handler, console_handler]
+    handlers=[DeferredQueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Zmniejsz "gadatliwość" zewnętrznych bibliotek
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logging.getLogger('telegram').setLevel(logging.WARNING)
+logging.getLogger('google').setLevel(logging.WARNING)
+logging.getLogger('apscheduler').setLevel(logging.WARNING)
+
+logger = logging.getLogger(__name__)
+
+
+def configure_logging(logging_config: dict):
+    """Stosuje sekcję 'logging' konfiguracji (poziom, zapis do pliku)"""
+    logging.getLogger().setLevel(getattr(logging, str(logging_config.get('log_level', 'INFO')).upper(), logging.INFO))
+    if not logging_config.get('log_to_file', True):
+        log_listener.handlers = (console_handler,)
+
+
+class LogSampler:
+    """Przepuszcza najwyżej N logów danego rodzaju na okno czasowe (reszta jest liczona)"""
+
+    def __init__(self, per_window: int = 5, window: float = 60.0):
+        self.per_window = per_window
+        self.window = window
+        self.windows: Dict[str, list] = {}  # klucz -> [początek okna, przepuszczone, pominięte]
+
+    def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        state = self.windows.get(key)
+        if state is None or now - state[0] >= self.window:
+            if state is not None and state[2]:
+                logger.warning("🔇 Pominięto %d logów '%s' w ostatnim oknie", state[2], key)
+            state = self.windows[key] = [now, 0, 0]
+        if state[1] < self.per_window:
+            state[1] += 1
+            return True
+        state[2] += 1
+        return False
+
+# === KONFIGURACJA HTTP CLIENT ===
+# Jeden współdzielony klient dla Gemini, GIPHY, AccuWeather i RSS - połączenia
+# są utrzymywane (keep-alive) w puli per host, więc kolejne zapytania nie płacą
+# ponownie za DNS + TCP + TLS.
+
+# Ustawienia HTTP client dla lepszej stabilności
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30.0, connect=10.0, sock_read=30.0)
+GEMINI_TIMEOUT = aiohttp.ClientTimeout(total=90.0, connect=10.0)  # Generowanie bywa wolne
+HTTP_LIMITS = {
+    'max_connections': 100,          # Łącznie we wszystkich pulach
+    'max_connections_per_host': 10,  # Pula per host (Gemini, GIPHY, AccuWeather...)
+    'keepalive_timeout': 30.0,       # Jak długo trzymać bezczynne połączenie
+    'dns_cache_ttl': 300             # Cache DNS w sekundach
+}
+
+try:
+    import brotli  # noqa: F401 - aiohttp sam dekompresuje 'br' gdy pakiet jest dostępny
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+
+class HttpPoolStats:
+    """Liczniki użycia puli połączeń HTTP zbierane przez aiohttp TraceConfig"""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+        self.requests_per_host: Dict[str, int] = {}
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """Tworzy TraceConfig aktualizujący liczniki"""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.requests += 1
+            host = params.url.host or '?'
+            self.requests_per_host[host] = self.requests_per_host.get(host, 0) + 1
+
+        async def on_connection_create_end(session, ctx, params):
+            self.new_connections += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self.reused_connections += 1
+
+        async def on_dns_cache_hit(session, ctx, params):
+            self.dns_cache_hits += 1
+
+        async def on_dns_cache_miss(session, ctx, params):
+            self.dns_cache_misses += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
+    def snapshot(self, session: Optional[aiohttp.ClientSession] = None) -> dict:
+        """Zwraca aktualny stan puli (liczniki + połączenia aktywne/bezczynne)"""
+        active = idle = 0
+        connector = session.connector if session and not session.closed else None
+        if connector is not None:
+            # aiohttp nie udostępnia publicznie stanu puli - odczyt "best effort"
+            active = len(getattr(connector, '_acquired', ()))
+            idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+        total_connections = self.new_connections + self.reused_connections
+        return {
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+            'reuse_ratio': self.reused_connections / total_connections if total_connections else 0.0,
+            'dns_cache_hits': self.dns_cache_hits,
+            'dns_cache_misses': self.dns_cache_misses,
+            'active': active,
+            'idle': idle,
+            'hosts': dict(self.requests_per_host)
+        }
+
+
+# Custom HTTP client z lepszymi ustawieniami
+async def create_http_client(http_config: Optional[dict] = None,
+                             pool_stats: Optional[HttpPoolStats] = None) -> aiohttp.ClientSession:
+    """Tworzy współdzielony HTTP client z pulą połączeń per host, keep-alive i cache DNS"""
+    limits = {**HTTP_LIMITS, **(http_config or {})}
+    connector = aiohttp.TCPConnector(
+        limit=limits['max_connections'],
+        limit_per_host=limits['max_connections_per_host'],
+        keepalive_timeout=limits['keepalive_timeout'],
+        use_dns_cache=True,
+        ttl_dns_cache=limits['dns_cache_ttl']
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=HTTP_TIMEOUT,
+        headers={
+            'User-Agent': 'Silver3premiumsmartbot/4.0.0 (Windows)',
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate, br' if BROTLI_AVAILABLE else 'gzip, deflate'
+        },
+        trace_configs=[pool_stats.trace_config()] if pool_stats else None
+    )
+
+# === POMIARY OPÓŹNIEŃ ===
+
+# Granice kubełków histogramu: od 1 ms do ~2 min, co 25% (stała pamięć per histogram)
+LATENCY_BUCKETS = tuple(0.001 * 1.25 ** i for i in range(54))
+
+# Etykieta obsługiwanej komendy (ustawiana na początku obsługi update'u)
+current_command: ContextVar[str] = ContextVar('current_command', default='background')
+update_started: ContextVar[float] = ContextVar('update_started', default=0.0)
+
+
+class LatencyHistogram:
+    """Histogram o stałych kubełkach - percentyle z dokładnością do szerokości kubełka"""
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # ostatni kubełek - powyżej zakresu
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q: float) -> float:
+        """Górna granica kubełka, w którym wypada percentyl q"""
+        target = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target and bucket_count:
+                return LATENCY_BUCKETS[min(index, len(LATENCY_BUCKETS) - 1)]
+        return 0.0
+
+
+class StageTimer:
+    """Mierzy czas bloku `with` i zapisuje go do histogramu etapu"""
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics: 'LatencyMetrics', stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class NullTimer:
+    """Timer-atrapa używany, gdy pomiary są wyłączone"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class LatencyMetrics:
+    """Histogramy opóźnień per (etap, komenda); wyłączone kosztują jedno sprawdzenie flagi"""
+
+    def __init__(self, config: dict):
+        self.enabled = config.get('enabled', False)
+        self.histograms: Dict[tuple, LatencyHistogram] = {}
+
+    def observe(self, stage: str, seconds: float):
+        key = (stage, current_command.get())
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    def timer(self, stage: str):
+        return StageTimer(self, stage) if self.enabled else NULL_TIMER
+
+    def clock(self) -> float:
+        """Znacznik czasu dla since() (0.0, gdy wyłączone)"""
+        return time.perf_counter() if self.enabled else 0.0
+
+    def since(self, stage: str, started: float):
+        if self.enabled:
+            self.observe(stage, time.perf_counter() - started)
+
+    def merged(self, by_command: bool = False) -> Dict[tuple, LatencyHistogram]:
+        """Histogramy per (etap, komenda) - bez by_command komendy są sumowane (komenda '*')"""
+        merged: Dict[tuple, LatencyHistogram] = {}
+        for (stage, command), histogram in self.histograms.items():
+            key = (stage, command if by_command else '*')
+            target = merged.setdefault(key, LatencyHistogram())
+            target.counts = [a + b for a, b in zip(target.counts, histogram.counts)]
+            target.count += histogram.count
+            target.total += histogram.total
+        return merged
+
+    def summary(self, by_command: bool = False) -> List[tuple]:
+        """[(etap, komenda, liczba, p50, p95, p99)] - bez by_command komendy są sumowane"""
+        return [
+            (stage, command, h.count, h.percentile(0.5), h.percentile(0.95), h.percentile(0.99))
+            for (stage, command), h in sorted(self.merged(by_command).items())
+        ]
+
+
+class TimedRequest(HTTPXRequest):
+    """Transport Bot API mierzący czas każdego wywołania (etap telegram:<metoda>)"""
+
+    def __init__(self, metrics: LatencyMetrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        if not self.metrics.enabled:
+            return await super().do_request(url, method, *args, **kwargs)
+        with StageTimer(self.metrics, 'telegram:' + url.rsplit('/', 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+# === CACHE ODPOWIEDZI AI ===
+
+class ResponseCache:
+    """Cache TTL+LRU odpowiedzi Gemini dla powtarzalnych komend (/ocen, /pomoz, /web)"""
+
+    def __init__(self, config: dict):
+        self.enabled = config.get('enabled', False)
+        self.max_entries = config.get('max_entries', 1000)
+        self.max_bytes = int(config.get('max_memory_mb', 5) * 1024 * 1024)
+        self.ttls = config.get('ttl', {})
+        self.default_ttl = config.get('default_ttl', 3600)
+        self.persist = config.get('persist', False)
+        self.file = config.get('file', 'data/response_cache.json')
+        # klucz -> (czas wygaśnięcia jako unix timestamp, odpowiedź); kolejność = LRU
+        self.entries: OrderedDict = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(prompt: str, model: str, generation_config: dict) -> str:
+        """Klucz ze znormalizowanego promptu, modelu i konfiguracji generowania"""
+        normalized = ' '.join(prompt.lower().split())
+        raw = json.dumps([normalized, model, generation_config], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def ttl_for(self, command: str) -> float:
+        """TTL dla danej komendy (z konfiguracji lub domyślny)"""
+        return self.ttls.get(command, self.default_ttl)
+
+    def get(self, key: str) -> Optional[str]:
+        """Zwraca odpowiedź z cache lub None (brak / wygasła)"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, response = entry
+        if expires_at <= time.time():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key: str, response: str, ttl: float):
+        """Zapisuje odpowiedź i usuwa najdawniej używane wpisy ponad limity"""
+        if ttl <= 0:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.time() + ttl, response)
+        self.size_bytes += self._entry_size(key, response)
+        while self.entries and (len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes):
+            oldest_key, (_, oldest_response) = self.entries.popitem(last=False)
+            self.size_bytes -= self._entry_size(oldest_key, oldest_response)
+
+    def _remove(self, key: str):
+        _, response = self.entries.pop(key)
+        self.size_bytes -= self._entry_size(key, response)
+
+    @staticmethod
+    def _entry_size(key: str, response: str) -> int:
+        return len(key) + len(response.encode('utf-8'))
+
+    def load(self):
+        """Wczytuje niewygasłe wpisy z dysku (jeśli persystencja jest włączona)"""
+        if not (self.enabled and self.persist and os.path.exists(self.file)):
+            return
+        try:
+            with open(self.file, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            now = time.time()
+            for key, expires_at, response in stored:
+                if expires_at > now:
+                    self.put(key, response, expires_at - now)
+            logger.info(f"🗄️ Wczytano {len(self.entries)} odpowiedzi z cache na dysku")
+        except Exception as e:
+            logger.error(f"❌ Błąd wczytywania cache odpowiedzi: {e}")
+
+    def save(self):
+        """Zapisuje niewygasłe wpisy na dysk (atomowo przez plik tymczasowy)"""
+        if not (self.enabled and self.persist):
+            return
+        try:
+            os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+            now = time.time()
+            stored = [[key, expires_at, response] for key, (expires_at, response) in self.entries.items() if expires_at > now]
+            tmp_file = self.file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(stored, f, ensure_ascii=False)
+            os.replace(tmp_file, self.file)
+            logger.info(f"🗄️ Zapisano {len(stored)} odpowiedzi z cache na dysk")
+        except Exception as e:
+            logger.error(f"❌ Błąd zapisu cache odpowiedzi: {e}")
+
+    def stats(self) -> dict:
+        """Liczniki trafień i rozmiar cache"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+            'size_bytes': self.size_bytes
+        }
+
+
+# === DEDUPLIKACJA RÓWNOCZESNYCH ZAPYTAŃ ===
+
+class FlightAbandoned(RuntimeError):
+    """Prowadzący zapytanie został anulowany - czekający powtarzają je samodzielnie"""
+
+
+class SingleFlight:
+    """Równoczesne identyczne zapytania czekają na jeden wspólny wynik (jedno wywołanie upstream)"""
+
+    def __init__(self):
+        self.in_flight: Dict[tuple, asyncio.Future] = {}
+        self.calls: Dict[str, int] = {}   # wywołania upstream per rodzaj
+        self.saved: Dict[str, int] = {}   # wywołania zaoszczędzone per rodzaj
+
+    async def do(self, kind: str, key, factory):
+        """Wykonuje factory() raz dla (kind, key); pozostali czekają na ten sam wynik lub wyjątek"""
+        flight_key = (kind, key)
+        while True:
+            future = self.in_flight.get(flight_key)
+            if future is None:
+                break
+            try:
+                # shield - anulowanie jednego czekającego nie przerywa zapytania pozostałym
+                result = await asyncio.shield(future)
+            except FlightAbandoned:
+                continue  # prowadzący anulowany - pierwszy z czekających wykona zapytanie sam
+            self.saved[kind] = self.saved.get(kind, 0) + 1
+            return result
+        
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[flight_key] = future
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            # Czekający nie zostali anulowani - zwykły wyjątek każe im powtórzyć zapytanie
+            future.set_exception(FlightAbandoned(f"{kind}: prowadzący zapytanie anulowany"))
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Wyjątek odbierają czekający; bez nich nie chcemy ostrzeżenia "never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.in_flight[flight_key]
+
+    def stats(self) -> dict:
+        """Liczniki wywołań i oszczędności per rodzaj zapytania"""
+        return {
+            kind: {'calls': self.calls.get(kind, 0), 'saved': self.saved.get(kind, 0)}
+            for kind in sorted(set(self.calls) | set(self.saved))
+        }
+
+
+# === LIMITY ZAPYTAŃ ===
+
+# Rodzaje limitowanych operacji i zakresy limitów (kolejność = kolejność sprawdzania)
+RATE_LIMIT_KINDS = ('ai', 'giphy', 'weather', 'commands')
+RATE_LIMIT_SCOPES = ('user', 'chat', 'global')
+
+
+class TokenBucket:
+    """Token bucket dla wielu kluczy - sprawdzenie O(1), pamięć ograniczona do max_keys
+    
+    Klucz bezczynny dłużej niż czas pełnego napełnienia ma i tak pełny kubełek,
+    więc można go bezstratnie usunąć (LRU - najstarsze na początku OrderedDict).
+    """
+
+    def __init__(self, per_hour: float, burst: float, max_keys: int = 10000):
+        self.rate = per_hour / 3600.0  # tokeny na sekundę
+        self.capacity = max(1.0, burst)
+        self.idle_ttl = self.capacity / self.rate
+        self.max_keys = max_keys
+        self.buckets: OrderedDict = OrderedDict()  # klucz -> [tokeny, ostatnie uzupełnienie]
+
+    def tokens(self, key, now: float) -> float:
+        """Aktualna liczba tokenów (bez zużywania)"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        return min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def consume(self, key, now: float, cost: float = 1.0):
+        self.buckets[key] = [self.tokens(key, now) - cost, now]
+        self.buckets.move_to_end(key)
+        self.evict(now)
+
+    def wait_time(self, key, now: float, cost: float = 1.0) -> float:
+        """Ile sekund do uzbierania tokenów na zapytanie"""
+        return max(0.0, (cost - self.tokens(key, now)) / self.rate)
+
+    def evict(self, now: float):
+        # Najwyżej kilka kluczy na wywołanie - koszt zamortyzowany O(1)
+        for _ in range(2):
+            if not self.buckets:
+                return
+            key, (_, updated) = next(iter(self.buckets.items()))
+            if now - updated < self.idle_ttl and len(self.buckets) <= self.max_keys:
+                return
+            del self.buckets[key]
+
+
+class RateLimiter:
+    """Wspólne limity dla AI, GIPHY, pogody i komend w zakresach użytkownik/czat/globalnie
+    
+    Limity z sekcji 'limits': <rodzaj>_requests_per_<zakres>_per_hour (globalnie:
+    <rodzaj>_requests_global_per_hour) i opcjonalny <rodzaj>_burst_per_<zakres> /
+    <rodzaj>_burst_global. Brak wpisu = brak limitu w danym zakresie.
+    """
+
+    def __init__(self, limits: dict):
+        max_keys = limits.get('rate_limiter_max_keys', 10000)
+        self.buckets: Dict[tuple, TokenBucket] = {}
+        for kind in RATE_LIMIT_KINDS:
+            for scope in RATE_LIMIT_SCOPES:
+                suffix = 'global' if scope == 'global' else f'per_{scope}'
+                per_hour = limits.get(f'{kind}_requests_{suffix}_per_hour')
+                if not per_hour:
+                    continue
+                burst = limits.get(f'{kind}_burst_{suffix}', max(1, per_hour // 60))
+                self.buckets[(kind, scope)] = TokenBucket(per_hour, burst, max_keys)
+        self.rejected = {kind: 0 for kind in RATE_LIMIT_KINDS}
+
+    def scope_keys(self, kind: str, user_id: Optional[int], chat_id: Optional[int]):
+        keys = {'user': user_id, 'chat': chat_id, 'global': 'global'}
+        for scope in RATE_LIMIT_SCOPES:
+            bucket = self.buckets.get((kind, scope))
+            if bucket is not None and keys[scope] is not None:
+                yield scope, bucket, keys[scope]
+
+    def check(self, kind: str, user_id: Optional[int] = None, chat_id: Optional[int] = None) -> Optional[tuple]:
+        """Zużywa token we wszystkich zakresach albo zwraca (zakres, sekundy do odblokowania)"""
+        now = time.monotonic()
+        scopes = list(self.scope_keys(kind, user_id, chat_id))
+        for scope, bucket, key in scopes:
+            if bucket.tokens(key, now) < 1.0:
+                self.rejected[kind] += 1
+                return scope, bucket.wait_time(key, now)
+        for _, bucket, key in scopes:
+            bucket.consume(key, now)
+        return None
+
+    def exhausted(self, kind: str, user_id: Optional[int] = None, chat_id: Optional[int] = None) -> bool:
+        """Czy kolejne zapytanie zostałoby odrzucone (bez zużywania tokenów)"""
+        now = time.monotonic()
+        return any(bucket.tokens(key, now) < 1.0 for _, bucket, key in self.scope_keys(kind, user_id, chat_id))
+
+    def stats(self) -> dict:
+        return {
+            'rejected': dict(self.rejected),
+            'tracked_keys': sum(len(bucket.buckets) for bucket in self.buckets.values())
+        }
+
+
+# === OKNO KONTEKSTU ROZMOWY ===
+
+# Role zapisywane od razu w formacie Gemini API (bez konwersji przy budowaniu payloadu)
+ROLE_USER = "user"
+ROLE_MODEL = "model"
+
+
+class Turn:
+    """Jedna wiadomość historii - __slots__ zamiast dict (kilkukrotnie mniej pamięci na wpis)"""
+
+    __slots__ = ('role', 'text', 'tokens')
+
+    def __init__(self, role: str, text: str, tokens: int):
+        self.role = role
+        self.text = text
+        self.tokens = tokens
+
+    def to_row(self) -> list:
+        return [self.role, self.text, self.tokens]
+
+    @classmethod
+    def from_row(cls, row) -> 'Turn':
+        if isinstance(row, dict):  # starszy zapis: {"role": "user"/"assistant", "text", "tokens"}
+            return cls(ROLE_MODEL if row["role"] == "assistant" else ROLE_USER, row["text"], row["tokens"])
+        return cls(*row)
+
+
+class ConversationWindow:
+    """Przycina historię rozmowy do budżetu tokenów (od najnowszych wiadomości wstecz)"""
+
+    def __init__(self, config: dict, max_messages: int):
+        self.token_budget = config.get('token_budget', 2000)
+        self.chars_per_token = config.get('chars_per_token', 4)
+        self.max_turn_tokens = config.get('max_turn_tokens', 600)
+        self.max_messages = max_messages
+        self.summarize = config.get('summarize', True)
+        self.summary_max_tokens = config.get('summary_max_tokens', 300)
+
+    def estimate_tokens(self, text: str) -> int:
+        """Zgrubna estymacja liczby tokenów (bez tokenizera - liczba znaków / chars_per_token)"""
+        return len(text) // self.chars_per_token + 4  # +4 na narzut roli/struktury
+
+    def make_turn(self, role: str, text: str) -> Turn:
+        """Tworzy wpis historii; zbyt długie wiadomości są skracane do max_turn_tokens"""
+        max_chars = self.max_turn_tokens * self.chars_per_token
+        if len(text) > max_chars:
+            text = text[:max_chars] + "…"
+        return Turn(role, text, self.estimate_tokens(text))
+
+    def new_history(self, turns=()) -> deque:
+        """Bufor cykliczny o stałej pojemności max_messages"""
+        return deque(turns, maxlen=self.max_messages)
+
+    def add_exchange(self, history: deque, user_text: str, ai_text: str) -> List[Turn]:
+        """Dopisuje wymianę i przycina historię w miejscu; zwraca wiadomości, które wypadły"""
+        dropped = []
+        for turn in (self.make_turn(ROLE_USER, user_text), self.make_turn(ROLE_MODEL, ai_text)):
+            if len(history) == history.maxlen:
+                dropped.append(history.popleft())
+            history.append(turn)
+        # Budżet tokenów wypełniany od najnowszych
+        used = sum(turn.tokens for turn in history)
+        while history and used > self.token_budget:
+            turn = history.popleft()
+            used -= turn.tokens
+            dropped.append(turn)
+        # Historia zaczyna się od wiadomości użytkownika (pełne wymiany)
+        while history and history[0].role != ROLE_USER:
+            dropped.append(history.popleft())
+        return dropped
+
+
+# === MAGAZYN ROZMÓW ===
+
+class Conversation:
+    """Historia i kroczące podsumowanie rozmowy jednego użytkownika"""
+
+    __slots__ = ('turns', 'summary', 'last_used')
+
+    def __init__(self, turns: deque, summary: str = ""):
+        self.turns = turns
+        self.summary = summary
+        self.last_used = time.monotonic()
+
+
+class ConversationStore:
+    """Rozmowy w pamięci tylko dla aktywnych użytkowników, reszta w SQLite (WAL)
+    
+    Gorący zbiór to LRU ograniczone do max_hot_users; rozmowy bezczynne dłużej niż
+    idle_ttl_minutes są z niego usuwane. Zmiany trafiają na dysk partiami w tle
+    (write-behind) - zapis nigdy nie blokuje odpowiedzi. Jedyny wątek bazy
+    serializuje wszystkie operacje SQLite.
+    """
+
+    def __init__(self, config: dict, window: ConversationWindow, on_evict=None):
+        self.window = window
+        self.on_evict = on_evict  # on_evict(user_id) - rozmowa wypadła z pamięci
+        self.persist = config.get('enabled', True)
+        self.file = config.get('file', 'data/conversations.db')
+        self.max_hot_users = config.get('max_hot_users', 5000)
+        self.idle_ttl = config.get('idle_ttl_minutes', 60) * 60
+        self.flush_interval = config.get('flush_interval', 2.0)
+        self.flush_batch = config.get('flush_batch', 500)
+        self.hot: OrderedDict = OrderedDict()  # user_id -> Conversation; kolejność = LRU
+        # user_id -> Conversation do zapisania (None = usunięcie); trzyma też wyrzucone z pamięci
+        self.dirty: Dict[int, Optional[Conversation]] = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='conversations-db')
+        self.db: Optional[sqlite3.Connection] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        self.wakeup = asyncio.Event()
+        self.loads = 0
+        self.evictions = 0
+        self.written = 0
+
+    def __len__(self) -> int:
+        return len(self.hot)
+
+    # --- wątek bazy ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+            self.db = sqlite3.connect(self.file)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "user_id INTEGER PRIMARY KEY, turns TEXT NOT NULL, summary TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self.db
+
+    def _load(self, user_id: int) -> Optional[tuple]:
+        row = self._connect().execute(
+            "SELECT turns, summary FROM conversations WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def _write(self, upserts: List[tuple], deletes: List[tuple]):
+        db = self._connect()
+        with db:  # jedna transakcja na partię
+            if upserts:
+                db.executemany(
+                    "INSERT INTO conversations (user_id, turns, summary, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET turns = excluded.turns, "
+                    "summary = excluded.summary, updated_at = excluded.updated_at",
+                    upserts
+                )
+            if deletes:
+                db.executemany("DELETE FROM conversations WHERE user_id = ?", deletes)
+
+    def _close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    # --- pętla zdarzeń ---
+
+    def peek(self, user_id: int) -> Optional[Conversation]:
+        """Rozmowa z pamięci (bez sięgania na dysk)"""
+        conversation = self.hot.get(user_id)
+        if conversation is None:
+            conversation = self.dirty.get(user_id)
+            if conversation is not None:
+                self._admit(user_id, conversation)
+        return conversation
+
+    async def get(self, user_id: int) -> Conversation:
+        """Rozmowa użytkownika - z pamięci, z bazy albo nowa"""
+        conversation = self.peek(user_id)
+        if conversation is not None or user_id in self.dirty:  # dirty None = świeżo wyczyszczona
+            return conversation if conversation is not None else self._admit(user_id, self.new_conversation())
+        
+        stored = None
+        if self.persist:
+            try:
+                stored = await self._run(self._load, user_id)
+                self.loads += 1
+            except Exception as e:
+                logger.error(f"❌ Błąd odczytu rozmowy użytkownika {user_id}: {e}")
+            # Równoległe get() mogło w międzyczasie załadować lub zmienić rozmowę
+            conversation = self.peek(user_id)
+            if conversation is not None:
+                return conversation
+        return self._admit(user_id, self.new_conversation(*stored) if stored else self.new_conversation())
+
+    def new_conversation(self, rows=(), summary: str = "") -> Conversation:
+        return Conversation(self.window.new_history(Turn.from_row(row) for row in rows), summary)
+
+    def _admit(self, user_id: int, conversation: Conversation) -> Conversation:
+        conversation.last_used = time.monotonic()
+        self.hot[user_id] = conversation
+        self.hot.move_to_end(user_id)
+        self.evict()
+        return conversation
+
+    def touch(self, user_id: int):
+        """Oznacza rozmowę jako zmienioną - trafi na dysk przy najbliższym zapisie"""
+        conversation = self.hot.get(user_id)
+        if conversation is None:
+            return
+        conversation.last_used = time.monotonic()
+        self.hot.move_to_end(user_id)
+        if self.persist:
+            self.dirty[user_id] = conversation
+            if len(self.dirty) >= self.flush_batch:
+                self.wakeup.set()
+
+    def clear(self, user_id: int):
+        """Usuwa rozmowę z pamięci i (przy najbliższym zapisie) z dysku"""
+        self.hot.pop(user_id, None)
+        if self.persist:
+            self.dirty[user_id] = None
+
+    def evict(self):
+        """Wyrzuca z pamięci najdawniej używane rozmowy ponad limit i bezczynne"""
+        now = time.monotonic()
+        while self.hot:
+            user_id, conversation = next(iter(self.hot.items()))
+            if len(self.hot) <= self.max_hot_users and now - conversation.last_used < self.idle_ttl:
+                return
+            # Niezapisana rozmowa zostaje w self.dirty do najbliższego zapisu
+            del self.hot[user_id]
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(user_id)
+
+    async def flush(self):
+        """Zapisuje partię zmienionych rozmów w wątku bazy"""
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        now = time.time()
+        upserts = [
+            (user_id, json.dumps([turn.to_row() for turn in conversation.turns], ensure_ascii=False),
+             conversation.summary, now)
+            for user_id, conversation in batch.items() if conversation is not None
+        ]
+        deletes = [(user_id,) for user_id, conversation in batch.items() if conversation is None]
+        try:
+            await self._run(self._write, upserts, deletes)
+            self.written += len(batch)
+        except Exception as e:
+            logger.error(f"❌ Błąd zapisu rozmów do bazy: {e}")
+            # Nowsze zmiany z czasu zapisu mają pierwszeństwo
+            for user_id, conversation in batch.items():
+                self.dirty.setdefault(user_id, conversation)
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            self.evict()
+            await self.flush()
+
+    def start(self):
+        """Uruchamia zapis w tle (wywoływane w post_init)"""
+        if self.persist and self.flush_task is None:
+            self.wakeup = asyncio.Event()
+            self.flush_task = asyncio.create_task(self.flush_loop())
+
+    async def close(self):
+        """Zatrzymuje zapis w tle, zapisuje zaległe zmiany i zamyka bazę"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+        if self.persist:
+            await self.flush()
+            await self._run(self._close)
+            logger.info(f"💾 Zapisano rozmowy do {self.file}")
+        self.executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        return {
+            'hot': len(self.hot),
+            'pending': len(self.dirty),
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'written': self.written
+        }
+
+
+# === RANKING UŻYTKOWNIKÓW ===
+
+LEADERBOARD_METRICS = ('messages', 'ai_queries')
+LEADERBOARD_WINDOWS = ('all', 'today', 'week')
+
+
+class TopK:
+    """Najlepsze k kluczy dla liczników, które tylko rosną - aktualizacja O(k), odczyt bez sortowania
+    
+    Klucz spoza rankingu z wynikiem nie większym niż ostatni w rankingu nie może go
+    wyprzedzić bez kolejnej aktualizacji, więc wystarczy trzymać samo top k.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self.scores: Dict[int, int] = {}
+        self.ranking: List[tuple] = []  # (-wynik, klucz) rosnąco = od najlepszego
+
+    def update(self, key: int, score: int):
+        old = self.scores.get(key)
+        if old is not None:
+            del self.ranking[bisect.bisect_left(self.ranking, (-old, key))]
+        elif len(self.ranking) >= self.k and (-score, key) >= self.ranking[-1]:
+            return
+        self.scores[key] = score
+        bisect.insort(self.ranking, (-score, key))
+        if len(self.ranking) > self.k:
+            _, evicted = self.ranking.pop()
+            del self.scores[evicted]
+
+    def top(self, limit: int) -> List[tuple]:
+        return [(key, -score) for score, key in self.ranking[:limit]]
+
+
+class Leaderboard:
+    """Ranking aktywności aktualizowany przy każdej wiadomości: cały czas, dziś i ostatnie 7 dni
+    
+    Dni liczone w czasie warszawskim. Sumy tygodniowe są kroczące - przy zmianie dnia
+    odejmowany jest najstarszy dzień i raz przebudowywany ranking tygodnia.
+    """
+
+    def __init__(self, size: int = 50, days: int = 7):
+        self.size = size
+        self.days = days
+        self.day_counts: OrderedDict = OrderedDict()  # data -> {user_id: {metryka: liczba}}
+        self.week_counts: Dict[int, Dict[str, int]] = {}
+        self.current_day = None
+        self.tops = {(window, metric): TopK(size) for window in LEADERBOARD_WINDOWS for metric in LEADERBOARD_METRICS}
+
+    def roll(self):
+        """Przechodzi na nowy dzień (jeśli trzeba) i usuwa dni spoza okna"""
+        today = datetime.now(WARSAW_TZ).date()
+        if today == self.current_day:
+            return
+        self.current_day = today
+        self.day_counts[today] = {}
+        oldest = today - timedelta(days=self.days - 1)
+        while next(iter(self.day_counts)) < oldest:
+            _, expired = self.day_counts.popitem(last=False)
+            for user_id, counts in expired.items():
+                totals = self.week_counts[user_id]
+                for metric, value in counts.items():
+                    totals[metric] -= value
+                if not any(totals.values()):
+                    del self.week_counts[user_id]
+        for metric in LEADERBOARD_METRICS:
+            self.tops[('today', metric)] = TopK(self.size)
+            week_top = self.tops[('week', metric)] = TopK(self.size)
+            for user_id, totals in self.week_counts.items():
+                if totals[metric]:
+                    week_top.update(user_id, totals[metric])
+
+    def record(self, user_id: int, metric: str, all_time: int):
+        """Zlicza aktywność; all_time - aktualna suma z user_activity"""
+        self.roll()
+        self.tops[('all', metric)].update(user_id, all_time)
+        for window, counts in (('today', self.day_counts[self.current_day]), ('week', self.week_counts)):
+            user_counts = counts.setdefault(user_id, dict.fromkeys(LEADERBOARD_METRICS, 0))
+            user_counts[metric] += 1
+            self.tops[(window, metric)].update(user_id, user_counts[metric])
+
+    def counts(self, window: str, user_id: int) -> Dict[str, int]:
+        """Liczniki użytkownika w oknie czasowym (today/week)"""
+        self.roll()
+        counts = self.day_counts[self.current_day] if window == 'today' else self.week_counts
+        return counts.get(user_id) or dict.fromkeys(LEADERBOARD_METRICS, 0)
+
+    def top(self, window: str = 'all', metric: str = 'messages', limit: int = 10) -> List[tuple]:
+        """Lista (user_id, wynik) od najlepszego"""
+        self.roll()
+        return self.tops[(window, metric)].top(limit)
+
+
+# === PROFILE UŻYTKOWNIKÓW ===
+
+class UserProfileCache:
+    """Nazwy użytkowników do rankingów - uzupełniane z przychodzących wiadomości, get_chat tylko przy braku
+    
+    Wpis żyje ttl sekund (każda wiadomość użytkownika go odświeża). Brakujące nazwy
+    pobierane są równolegle, najwyżej lookup_concurrency zapytań naraz; nieudane
+    pobranie zapamiętuje zastępczą nazwę na krócej (failure_ttl).
+    """
+
+    def __init__(self, config: dict):
+        self.ttl = config.get('ttl_hours', 24) * 3600
+        self.failure_ttl = config.get('failure_ttl_minutes', 30) * 60
+        self.max_entries = config.get('max_entries', 10000)
+        self.concurrency = config.get('lookup_concurrency', 5)
+        self.entries: OrderedDict = OrderedDict()  # user_id -> (nazwa, wygasa o); kolejność = LRU
+        self.hits = 0
+        self.lookups = 0
+
+    @staticmethod
+    def display_name(user) -> str:
+        """Nazwa jak w rankingach: @username, potem imię"""
+        return user.username or user.first_name or f"Użytkownik {user.id}"
+
+    def put(self, user_id: int, name: str, ttl: float):
+        self.entries[user_id] = (name, time.monotonic() + ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def remember(self, user):
+        """Zapamiętuje nazwę z update.effective_user (bez zapytań do Telegrama)"""
+        if user is not None:
+            self.put(user.id, self.display_name(user), self.ttl)
+
+    async def resolve(self, bot, user_ids: List[int]) -> Dict[int, str]:
+        """Nazwy dla listy użytkowników - z cache, brakujące równolegle przez get_chat"""
+        now = time.monotonic()
+        names: Dict[int, str] = {}
+        misses = []
+        for user_id in user_ids:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                names[user_id] = entry[0]
+                self.hits += 1
+            else:
+                misses.append(user_id)
+        if not misses:
+            return names
+        
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def fetch(user_id: int) -> str:
+            async with semaphore:
+                self.lookups += 1
+                try:
+                    name = self.display_name(await bot.get_chat(user_id))
+                    self.put(user_id, name, self.ttl)
+                except Exception as e:
+                    logger.debug(f"Nie udało się pobrać profilu {user_id}: {e}")
+                    stale = self.entries.get(user_id)
+                    name = stale[0] if stale else f"Użytkownik {user_id}"
+                    self.put(user_id, name, self.failure_ttl)
+                return name
+        
+        names.update(zip(misses, await asyncio.gather(*(fetch(user_id) for user_id in misses))))
+        return names
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'hits': self.hits, 'lookups': self.lookups}
+
+
+# === STATYSTYKI W CZASIE ===
+
+ACTIVITY_METRICS = ('messages', 'ai_queries', 'web_queries', 'gifs', 'errors', 'input_tokens', 'output_tokens')
+# (nazwa, długość kubełka w sekundach, liczba kubełków) - od najdokładniejszej
+ACTIVITY_RESOLUTIONS = (('minute', 60, 180), ('hour', 3600, 168), ('day', 86400, 90))
+
+
+class TimeSeries:
+    """Pierścień kubełków stałej długości; liczniki wszystkich metryk w jednej tablicy array('q')
+    
+    Kubełek pamięta numer swojego okresu - zapis do kubełka z poprzedniego obiegu
+    najpierw go zeruje, więc nie trzeba niczego przesuwać ani sprzątać w tle.
+    """
+
+    def __init__(self, step: int, slots: int, width: int):
+        self.step = step
+        self.slots = slots
+        self.width = width
+        self.periods = array('q', [-1]) * slots
+        self.values = array('q', bytes(8 * slots * width))
+
+    def period(self, now: float) -> int:
+        return int(now // self.step)
+
+    def add(self, metric: int, value: int, now: float):
+        period = self.period(now)
+        index = period % self.slots
+        if self.periods[index] != period:
+            self.periods[index] = period
+            self.values[index * self.width:(index + 1) * self.width] = array('q', bytes(8 * self.width))
+        self.values[index * self.width + metric] += value
+
+    def total(self, metric: int, start: int, end: int) -> int:
+        """Suma metryki w okresach [start, end)"""
+        result = 0
+        for period in range(max(start, end - self.slots), end):
+            index = period % self.slots
+            if self.periods[index] == period:
+                result += self.values[index * self.width + metric]
+        return result
+
+    def to_dict(self) -> dict:
+        return {'periods': self.periods.tolist(), 'values': self.values.tolist()}
+
+    def load(self, stored: dict):
+        if len(stored['periods']) == self.slots and len(stored['values']) == self.slots * self.width:
+            self.periods = array('q', stored['periods'])
+            self.values = array('q', stored['values'])
+
+
+class ActivityStats:
+    """Trwałe liczniki aktywności (wiadomości, AI, wyszukiwania, GIF-y, błędy, tokeny) w czasie
+    
+    Każdy zapis trafia od razu do kubełków minutowych, godzinowych i dziennych -
+    zgrubniejsze rozdzielczości sięgają dalej wstecz przy stałej pamięci. Migawka
+    zapisywana jest na dysk co snapshot_interval sekund, więc restart nie zeruje statystyk.
+    """
+
+    def __init__(self, config: dict):
+        self.enabled = config.get('persist', True)
+        self.file = config.get('file', 'data/activity_stats.json')
+        self.snapshot_interval = config.get('snapshot_interval', 300)
+        self.index = {metric: i for i, metric in enumerate(ACTIVITY_METRICS)}
+        self.series = {name: TimeSeries(step, slots, len(ACTIVITY_METRICS)) for name, step, slots in ACTIVITY_RESOLUTIONS}
+        self.totals = array('q', bytes(8 * len(ACTIVITY_METRICS)))
+        self.first_start = time.time()
+        self.snapshot_task: Optional[asyncio.Task] = None
+
+    def record(self, metric: str, value: int = 1):
+        if not value:
+            return
+        now = time.time()
+        index = self.index[metric]
+        self.totals[index] += value
+        for series in self.series.values():
+            series.add(index, value, now)
+
+    def window(self, metric: str, seconds: int, offset: int = 0) -> int:
+        """Suma metryki z ostatnich `seconds` sekund (przesuniętych o `offset` wstecz)
+        
+        Okno liczone jest z najdokładniejszej rozdzielczości, która je jeszcze obejmuje.
+        """
+        now = time.time() - offset
+        for name, step, slots in ACTIVITY_RESOLUTIONS:
+            if seconds + offset <= step * slots and seconds % step == 0:
+                series = self.series[name]
+                end = series.period(now) + 1
+                return series.total(self.index[metric], end - seconds // step, end)
+        return 0
+
+    def total(self, metric: str) -> int:
+        return self.totals[self.index[metric]]
+
+    def trend(self, metric: str, seconds: int) -> str:
+        """Zmiana ostatniego okna względem poprzedniego, np. '↑ 12%'"""
+        current = self.window(metric, seconds)
+        previous = self.window(metric, seconds, offset=seconds)
+        if not previous:
+            return "nowe" if current else "bez zmian"
+        change = (current - previous) / previous
+        arrow = "↑" if change > 0 else "↓" if change < 0 else "→"
+        return f"{arrow} {abs(change):.0%}"
+
+    def snapshot(self) -> dict:
+        return {
+            'metrics': list(ACTIVITY_METRICS),
+            'first_start': self.first_start,
+            'totals': self.totals.tolist(),
+            'series': {name: series.to_dict() for name, series in self.series.items()}
+        }
+
+    def load(self):
+        """Wczytuje ostatnią migawkę z dysku"""
+        if not (self.enabled and os.path.exists(self.file)):
+            return
+        try:
+            with open(self.file, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            self.first_start = stored.get('first_start', self.first_start)
+            totals = dict(zip(stored['metrics'], stored['totals']))
+            for metric, index in self.index.items():
+                self.totals[index] = totals.get(metric, 0)
+            # Kubełki tylko przy tym samym zestawie metryk (inny układ kolumn w tablicy)
+            if stored['metrics'] == list(ACTIVITY_METRICS):
+                for name, series in self.series.items():
+                    if name in stored['series']:
+                        series.load(stored['series'][name])
+            logger.info(f"📈 Wczytano statystyki aktywności ({self.totals[self.index['messages']]} wiadomości łącznie)")
+        except Exception as e:
+            logger.error(f"❌ Błąd wczytywania statystyk aktywności: {e}")
+
+    def write(self, snapshot: dict):
+        """Zapisuje migawkę na dysk (atomowo przez plik tymczasowy)"""
+        try:
+            os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+            tmp_file = self.file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_file, self.file)
+        except Exception as e:
+            logger.error(f"❌ Błąd zapisu statystyk aktywności: {e}")
+
+    async def save(self):
+        """Migawka robiona w pętli zdarzeń, zapis na dysk w wątku"""
+        if self.enabled:
+            await asyncio.to_thread(self.write, self.snapshot())
+
+    async def snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.save()
+
+    def start(self):
+        """Uruchamia okresowe migawki (wywoływane w post_init)"""
+        if self.enabled and self.snapshot_task is None:
+            self.snapshot_task = asyncio.create_task(self.snapshot_loop())
+
+    async def close(self):
+        """Zatrzymuje migawki i zapisuje ostatnią"""
+        if self.snapshot_task is not None:
+            self.snapshot_task.cancel()
+            try:
+                await self.snapshot_task
+            except asyncio.CancelledError:
+                pass
+            self.snapshot_task = None
+        await self.save()
+
+
+# === CZŁONKOSTWO W KANALE ===
+
+def is_member_status(member) -> bool:
+    """Czy ChatMember oznacza członka kanału (ograniczony też, o ile nadal jest w kanale)"""
+    if member.status in ('member', 'administrator', 'creator'):
+        return True
+    return member.status == 'restricted' and bool(getattr(member, 'is_member', False))
+
+
+class MembershipCache:
+    """Cache członkostwa w kanale: TTL + LRU, wyniki negatywne i błędy też są zapamiętywane
+    
+    Zmiany członkostwa przychodzą jako update'y chat_member i od razu nadpisują wpis,
+    więc TTL może być długi - w stanie ustalonym zapytania AI nie pytają Telegrama.
+    """
+
+    def __init__(self, config: dict):
+        self.ttl = config.get('ttl_minutes', 360) * 60
+        self.negative_ttl = config.get('negative_ttl_minutes', 60) * 60
+        self.error_ttl = config.get('error_ttl_seconds', 60)
+        self.max_entries = config.get('max_entries', 10000)
+        self.entries: OrderedDict = OrderedDict()  # user_id -> (czy członek, wygasa o); kolejność = LRU
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int) -> Optional[bool]:
+        """Zapamiętany status albo None (brak / wygasł)"""
+        entry = self.entries.get(user_id)
+        if entry is None or entry[1] <= time.monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, user_id: int, is_member: bool, ttl: Optional[float] = None):
+        if ttl is None:
+            ttl = self.ttl if is_member else self.negative_ttl
+        self.entries[user_id] = (is_member, time.monotonic() + ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put_error(self, user_id: int):
+        """Błąd sprawdzania - krótko traktujemy jako 'nie członek', żeby nie pytać przy każdej wiadomości"""
+        self.errors += 1
+        self.put(user_id, False, self.error_ttl)
+
+    def update(self, user_id: int, is_member: bool):
+        """Status z update'u chat_member - pewny, więc od razu zastępuje wpis"""
+        self.invalidations += 1
+        self.put(user_id, is_member)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'invalidations': self.invalidations
+        }
+
+
+# === ZAPIS W TLE ===
+
+class BackgroundSaver:
+    """Zapis pliku w wątku, najwyżej jeden naraz - równoległe zapisy nadpisywałyby wspólny plik .tmp
+    
+    Prośby zgłoszone w trakcie zapisu łączą się w jeden kolejny zapis, więc najnowszy
+    stan zawsze trafia na dysk, a pętla zdarzeń nigdy nie czeka na I/O.
+    """
+
+    def __init__(self, save):
+        self.save = save
+        self.task: Optional[asyncio.Task] = None
+        self.again = False
+
+    def schedule(self):
+        if self.task is not None and not self.task.done():
+            self.again = True
+            return
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        self.again = True
+        while self.again:
+            self.again = False
+            await asyncio.to_thread(self.save)
+
+    async def close(self):
+        """Czeka na trwający zapis i zapisuje ostatni stan (przy wyłączaniu)"""
+        if self.task is not None and not self.task.done():
+            self.again = False
+            await self.task
+        self.save()
+
+
+# === PULE GIF-ÓW GIPHY ===
+
+class GifPools:
+    """Pule wyników GIPHY per zapytanie - jedno wyszukiwanie z dużym limitem, losowanie lokalnie
+    
+    Pula młodsza niż refresh_after jest serwowana bez zapytań do GIPHY; starsza - nadal
+    serwowana, ale odświeżana w tle. Dopiero brak puli (lub starsza niż max_age)
+    wymaga wyszukiwania przed odpowiedzią. Pule zapisywane są na dysk.
+    """
+
+    def __init__(self, config: dict):
+        self.pool_size = config.get('pool_size', 50)
+        self.refresh_after = config.get('pool_refresh_hours', 6) * 3600
+        self.max_age = config.get('pool_max_age_hours', 72) * 3600
+        self.max_pools = config.get('max_pools', 200)
+        self.persist = config.get('persist_pools', True)
+        self.file = config.get('pools_file', 'data/giphy_pools.json')
+        self.pools: OrderedDict = OrderedDict()  # zapytanie -> (czas pobrania jako unix timestamp, [url]); kolejność = LRU
+        self.refreshing: Dict[str, asyncio.Task] = {}
+        self.saver = BackgroundSaver(self.save)
+        self.served = 0
+        self.searches = 0
+
+    @staticmethod
+    def key(query: str) -> str:
+        return ' '.join(query.lower().split())
+
+    def get(self, query: str) -> tuple:
+        """(lista URL-i lub None, czy trzeba odświeżyć)"""
+        key = self.key(query)
+        entry = self.pools.get(key)
+        if entry is None:
+            return None, True
+        fetched_at, urls = entry
+        age = time.time() - fetched_at
+        if age >= self.max_age:
+            return None, True
+        self.pools.move_to_end(key)
+        return urls, age >= self.refresh_after
+
+    def stale(self, query: str) -> Optional[List[str]]:
+        """Pula niezależnie od wieku - awaryjnie, gdy GIPHY nie odpowiada"""
+        entry = self.pools.get(self.key(query))
+        return entry[1] if entry else None
+
+    def put(self, query: str, urls: List[str]):
+        key = self.key(query)
+        self.pools[key] = (time.time(), urls)
+        self.pools.move_to_end(key)
+        while len(self.pools) > self.max_pools:
+            self.pools.popitem(last=False)
+
+    def load(self):
+        """Wczytuje pule z dysku (bez tych starszych niż max_age)"""
+        if not (self.persist and os.path.exists(self.file)):
+            return
+        try:
+            with open(self.file, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            now = time.time()
+            for key, fetched_at, urls in stored:
+                if now - fetched_at < self.max_age and urls:
+                    self.pools[key] = (fetched_at, urls)
+            logger.info(f"🎬 Wczytano {len(self.pools)} pul GIF-ów z dysku")
+        except Exception as e:
+            logger.error(f"❌ Błąd wczytywania pul GIF-ów: {e}")
+
+    def save(self):
+        """Zapisuje pule na dysk (atomowo przez plik tymczasowy)"""
+        if not self.persist:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+            stored = [[key, fetched_at, urls] for key, (fetched_at, urls) in list(self.pools.items())]
+            tmp_file = self.file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(stored, f, ensure_ascii=False)
+            os.replace(tmp_file, self.file)
+        except Exception as e:
+            logger.error(f"❌ Błąd zapisu pul GIF-ów: {e}")
+
+    def stats(self) -> dict:
+        return {'pools': len(self.pools), 'served': self.served, 'searches': self.searches}
+
+
+# === FILE_ID ANIMACJI ===
+
+class AnimationFileIds:
+    """Mapa URL GIF-a -> file_id nadany przez Telegram przy pierwszym wysłaniu
+    
+    Ponowne wysłanie po file_id to tylko odwołanie do pliku na serwerach Telegrama
+    (bez pobierania GIF-a z GIPHY). Mapa jest LRU i zapisywana na dysk.
+    """
+
+    def __init__(self, config: dict):
+        self.enabled = config.get('enabled', True)
+        self.file = config.get('file', 'data/animation_file_ids.json')
+        self.max_entries = config.get('max_entries', 5000)
+        self.save_every = config.get('save_every', 10)
+        self.ids: OrderedDict = OrderedDict()  # url -> file_id; kolejność = LRU
+        self.unsaved = 0
+        self.saver = BackgroundSaver(self.save)
+        self.reused = 0
+        self.uploaded = 0
+        self.expired = 0
+
+    def get(self, url: str) -> Optional[str]:
+        file_id = self.ids.get(url)
+        if file_id is not None:
+            self.ids.move_to_end(url)
+        return file_id
+
+    def put(self, url: str, file_id: str) -> bool:
+        """Zapamiętuje file_id; zwraca True, gdy czas zapisać mapę na dysk"""
+        self.ids[url] = file_id
+        self.ids.move_to_end(url)
+        while len(self.ids) > self.max_entries:
+            self.ids.popitem(last=False)
+        self.unsaved += 1
+        return self.unsaved >= self.save_every
+
+    def forget(self, url: str):
+        self.expired += 1
+        self.ids.pop(url, None)
+
+    def load(self):
+        if not (self.enabled and os.path.exists(self.file)):
+            return
+        try:
+            with open(self.file, 'r', encoding='utf-8') as f:
+                self.ids = OrderedDict(json.load(f))
+            logger.info(f"🎞️ Wczytano {len(self.ids)} file_id animacji")
+        except Exception as e:
+            logger.error(f"❌ Błąd wczytywania file_id animacji: {e}")
+
+    def save(self):
+        """Zapisuje mapę na dysk (atomowo przez plik tymczasowy)"""
+        if not self.enabled:
+            return
+        self.unsaved = 0
+        try:
+            os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+            tmp_file = self.file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(list(self.ids.items()), f)
+            os.replace(tmp_file, self.file)
+        except Exception as e:
+            logger.error(f"❌ Błąd zapisu file_id animacji: {e}")
+
+    def stats(self) -> dict:
+        return {'entries': len(self.ids), 'reused': self.reused, 'uploaded': self.uploaded, 'expired': self.expired}
+
+
+# === POGODA ===
+
+# Słownik miast dla wykrywania pytań o pogodę: nazwa dla AccuWeather -> odmienione formy
+# ("pogoda w Krakowie", "pogoda dla Krakowa"); miasta zagraniczne - też polskie nazwy
+WEATHER_CITIES = {
+    "Warszawa": ["Warszawie", "Warszawy"], "Kraków": ["Krakowie", "Krakowa"], "Łódź": ["Łodzi"],
+    "Wrocław": ["Wrocławiu", "Wrocławia"], "Poznań": ["Poznaniu", "Poznania"], "Gdańsk": ["Gdańsku", "Gdańska"],
+    "Szczecin": ["Szczecinie", "Szczecina"], "Bydgoszcz": ["Bydgoszczy"], "Lublin": ["Lublinie", "Lublina"],
+    "Białystok": ["Białymstoku", "Białegostoku"], "Katowice": ["Katowicach", "Katowic"], "Gdynia": ["Gdyni"],
+    "Częstochowa": ["Częstochowie", "Częstochowy"], "Radom": ["Radomiu", "Radomia"], "Toruń": ["Toruniu", "Torunia"],
+    "Sosnowiec": ["Sosnowcu", "Sosnowca"], "Rzeszów": ["Rzeszowie", "Rzeszowa"], "Kielce": ["Kielcach", "Kielc"],
+    "Gliwice": ["Gliwicach", "Gliwic"], "Olsztyn": ["Olsztynie", "Olsztyna"], "Zabrze": ["Zabrzu", "Zabrza"],
+    "Bielsko-Biała": ["Bielsku-Białej", "Bielska-Białej"], "Bytom": ["Bytomiu", "Bytomia"],
+    "Zielona Góra": ["Zielonej Górze", "Zielonej Góry"], "Rybnik": ["Rybniku", "Rybnika"],
+    "Ruda Śląska": ["Rudzie Śląskiej", "Rudy Śląskiej"], "Opole": ["Opolu", "Opola"], "Tychy": ["Tychach", "Tychów"],
+    "Gorzów Wielkopolski": ["Gorzowie Wielkopolskim", "Gorzowa Wielkopolskiego", "Gorzów", "Gorzowie", "Gorzowa"],
+    "Elbląg": ["Elblągu", "Elbląga"], "Płock": ["Płocku", "Płocka"], "Wałbrzych": ["Wałbrzychu", "Wałbrzycha"],
+    "Włocławek": ["Włocławku", "Włocławka"], "Tarnów": ["Tarnowie", "Tarnowa"], "Chorzów": ["Chorzowie", "Chorzowa"],
+    "Koszalin": ["Koszalinie", "Koszalina"], "Kalisz": ["Kaliszu", "Kalisza"], "Legnica": ["Legnicy"],
+    "Grudziądz": ["Grudziądzu", "Grudziądza"], "Słupsk": ["Słupsku", "Słupska"], "Jaworzno": ["Jaworznie", "Jaworzna"],
+    "Nowy Sącz": ["Nowym Sączu", "Nowego Sącza"], "Jelenia Góra": ["Jeleniej Górze", "Jeleniej Góry"],
+    "Siedlce": ["Siedlcach", "Siedlec"], "Piotrków Trybunalski": ["Piotrkowie Trybunalskim", "Piotrkowie", "Piotrkowa"],
+    "Konin": ["Koninie", "Konina"], "Inowrocław": ["Inowrocławiu", "Inowrocławia"], "Lubin": ["Lubinie", "Lubina"],
+    "Ostrów Wielkopolski": ["Ostrowie Wielkopolskim", "Ostrowa Wielkopolskiego"], "Suwałki": ["Suwałkach", "Suwałk"],
+    "Gniezno": ["Gnieźnie", "Gniezna"], "Przemyśl": ["Przemyślu", "Przemyśla"], "Zamość": ["Zamościu", "Zamościa"],
+    "Ostrołęka": ["Ostrołęce", "Ostrołęki"], "Łomża": ["Łomży"], "Leszno": ["Lesznie", "Leszna"],
+    "Sopot": ["Sopocie", "Sopotu"], "Zakopane": ["Zakopanem", "Zakopanego"], "Kołobrzeg": ["Kołobrzegu"],
+    "Świnoujście": ["Świnoujściu", "Świnoujścia"], "Malbork": ["Malborku", "Malborka"], "Hel": ["Helu"],
+    "Władysławowo": ["Władysławowie", "Władysławowa"], "Międzyzdroje": ["Międzyzdrojach", "Międzyzdrojów"],
+    "Ustka": ["Ustce", "Ustki"], "Karpacz": ["Karpaczu", "Karpacza"], "Szklarska Poręba": ["Szklarskiej Porębie", "Szklarskiej Poręby"],
+    "Augustów": ["Augustowie", "Augustowa"], "Giżycko": ["Giżycku", "Giżycka"], "Mikołajki": ["Mikołajkach", "Mikołajek"],
+    "London": ["Londyn", "Londynie", "Londynu"], "Paris": ["Paryż", "Paryżu", "Paryża"], "Berlin": ["Berlinie", "Berlina"],
+    "Rome": ["Rzym", "Rzymie", "Rzymu"], "Madrid": ["Madryt", "Madrycie", "Madrytu"], "Barcelona": ["Barcelonie", "Barcelony"],
+    "Vienna": ["Wiedeń", "Wiedniu", "Wiednia"], "Prague": ["Praga", "Pradze", "Pragi"],
+    "Budapest": ["Budapeszt", "Budapeszcie", "Budapesztu"], "Amsterdam": ["Amsterdamie", "Amsterdamu"],
+    "Brussels": ["Bruksela", "Brukseli"], "Lisbon": ["Lizbona", "Lizbonie", "Lizbony"], "Athens": ["Ateny", "Atenach", "Aten"],
+    "Kyiv": ["Kijów", "Kijowie", "Kijowa"], "Lviv": ["Lwów", "Lwowie", "Lwowa"], "Vilnius": ["Wilno", "Wilnie", "Wilna"],
+    "Riga": ["Ryga", "Rydze", "Rygi"], "Tallinn": ["Tallinnie", "Tallinna"], "Minsk": ["Mińsk", "Mińsku", "Mińska"],
+    "Moscow": ["Moskwa", "Moskwie", "Moskwy"], "Stockholm": ["Sztokholm", "Sztokholmie", "Sztokholmu"],
+    "Oslo": [], "Copenhagen": ["Kopenhaga", "Kopenhadze", "Kopenhagi"], "Helsinki": ["Helsinkach"],
+    "Reykjavik": ["Reykjavíku"], "Dublin": ["Dublinie", "Dublina"], "Edinburgh": ["Edynburg", "Edynburgu"],
+    "Manchester": ["Manchesterze", "Manchesteru"], "Milan": ["Mediolan", "Mediolanie", "Mediolanu"],
+    "Venice": ["Wenecja", "Wenecji"], "Florence": ["Florencja", "Florencji"], "Naples": ["Neapol", "Neapolu"],
+    "Munich": ["Monachium"], "Frankfurt": ["Frankfurcie", "Frankfurtu"], "Hamburg": ["Hamburgu"],
+    "Cologne": ["Kolonia", "Kolonii"], "Dresden": ["Drezno", "Dreźnie", "Drezna"], "Zurich": ["Zurych", "Zurychu"],
+    "Geneva": ["Genewa", "Genewie", "Genewy"], "Bratislava": ["Bratysława", "Bratysławie", "Bratysławy"],
+    "Bucharest": ["Bukareszt", "Bukareszcie", "Bukaresztu"], "Sofia": ["Sofii"], "Belgrade": ["Belgrad", "Belgradzie", "Belgradu"],
+    "Zagreb": ["Zagrzeb", "Zagrzebiu", "Zagrzebia"], "Dubrovnik": ["Dubrowniku", "Dubrownika"],
+    "Istanbul": ["Stambuł", "Stambule", "Stambułu"], "Malaga": ["Maladze", "Malagi"], "Valencia": ["Walencja", "Walencji"],
+    "Porto": [], "Nice": ["Nicea", "Nicei"], "Marseille": ["Marsylia", "Marsylii"],
+    "New York": ["Nowy Jork", "Nowym Jorku", "Nowego Jorku"], "Los Angeles": [], "Chicago": [],
+    "Washington": ["Waszyngton", "Waszyngtonie", "Waszyngtonu"], "Miami": [], "San Francisco": [], "Las Vegas": [],
+    "Toronto": [], "Vancouver": [], "Mexico City": ["Meksyku"], "Rio de Janeiro": [], "Buenos Aires": [],
+    "Tokyo": ["Tokio"], "Beijing": ["Pekin", "Pekinie", "Pekinu"], "Shanghai": ["Szanghaj", "Szanghaju"],
+    "Seoul": ["Seul", "Seulu"], "Hong Kong": ["Hongkong", "Hongkongu"], "Singapore": ["Singapur", "Singapurze", "Singapuru"],
+    "Bangkok": ["Bangkoku"], "Dubai": ["Dubaj", "Dubaju"], "Delhi": ["Delhi"], "Cairo": ["Kair", "Kairze", "Kairu"],
+    "Tel Aviv": ["Tel Awiw", "Tel Awiwie"], "Jerusalem": ["Jerozolima", "Jerozolimie", "Jerozolimy"],
+    "Sydney": [], "Melbourne": [], "Cape Town": ["Kapsztad", "Kapsztadzie", "Kapsztadu"],
+}
+
+# Słowa oznaczające pytanie o pogodę (po normalizacji); "pogodny" czy "pogodzić się" się nie liczą
+WEATHER_TRIGGERS = frozenset({
+    'pogoda', 'pogody', 'pogode', 'pogodzie', 'pogodka', 'pogodke', 'pogodki',
+    'temperatura', 'temperatury', 'temperature', 'temperaturze', 'prognoza', 'prognoze', 'prognozy'
+})
 
-# Zmniejsz "gadatliwość" zewnętrznych bibliotek
-logging.getLogger('httpx').setLevel(logging.WARNING)
-logging.getLogger('telegram').setLevel(logging.WARNING)
-logging.getLogger('google').setLevel(logging.WARNING)
-logging.getLogger('apscheduler').setLevel(logging.WARNING)
+# Miasto musi stać tuż przy wyzwalaczu ("pogoda Kraków", "Kraków pogoda") albo po przyimku ("pogoda jutro w Krakowie")
+WEATHER_PREPOSITIONS = frozenset({'w', 'we', 'dla', 'na', 'do', 'z', 'ze'})
 
-logger = logging.getLogger(__name__)
+# Formy ze słownika, które częściej są imieniem lub zwykłym słowem niż miastem - nie są rozpoznawane
+# ("Milan mówi, że pogoda jest super"); odmiany pozostają (Mediolanie, Nicei, Sofii, Pradze)
+WEATHER_AMBIGUOUS_NAMES = frozenset({'milan', 'nice', 'sofia', 'porto', 'praga'})
 
-# === KONFIGURACJA HTTP CLIENT ===
-import httpx
-from httpx import Timeout, Limits
 
-# Ustawienia HTTP client dla lepszej stabilności
-HTTP_TIMEOUT = Timeout(30.0, connect=10.0, read=30.0, write=10.0, pool=10.0)
-HTTP_LIMITS = Limits(max_keepalive_connections=5, max_connections=10, keepalive_expiry=30.0)
+class WeatherError(Exception):
+    """Błąd pobierania pogody - treść wyjątku to gotowy komunikat dla użytkownika"""
+
+
+def normalize_place(name: str) -> str:
+    """Nazwa miejscowości bez wielkości liter, znaków diakrytycznych i zbędnych spacji ('  ŁÓDŹ ' -> 'lodz')"""
+    text = unicodedata.normalize('NFKD', name.casefold().replace('ł', 'l'))  # ł nie rozkłada się w NFKD
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(re.sub(r'[^\w\s-]', ' ', text).split())
+
+
+PLACE_WORD_RE = re.compile(r'\w+')
+
+
+def place_key(name: str) -> str:
+    """Klucz miejscowości w słownikach i cache - słowa po normalize_place ('Kędzierzyn-Koźle' -> 'kedzierzyn kozle')"""
+    return ' '.join(PLACE_WORD_RE.findall(normalize_place(name)))
+
+
+class LocationKeyCache:
+    """Cache nazwa miasta -> location key AccuWeather (razem z nazwą i krajem do odpowiedzi)
+    
+    Klucze lokalizacji praktycznie się nie zmieniają, więc wpisy żyją długo i są zapisywane
+    na dysk - pogoda wymaga wtedy tylko jednego zapytania (currentconditions). Miasta,
+    których AccuWeather nie zna, pamiętane są krócej (negative_ttl_hours).
+    """
+
+    def __init__(self, config: dict):
+        self.persist = config.get('persist_locations', True)
+        self.file = config.get('locations_file', 'data/weather_locations.json')
+        self.ttl = config.get('location_ttl_days', 90) * 86400
+        self.negative_ttl = config.get('negative_ttl_hours', 24) * 3600
+        self.max_entries = config.get('max_locations', 5000)
+        self.preload = config.get('preload_cities', [])
+        self.entries: OrderedDict = OrderedDict()  # place_key -> (czas zapisu jako unix timestamp, [key, miasto, kraj] lub None)
+        self.saver = BackgroundSaver(self.save)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, city: str) -> tuple:
+        """(czy jest aktualny wpis, lokalizacja lub None gdy AccuWeather nie zna miasta)"""
+        key = place_key(city)
+        entry = self.entries.get(key)
+        if entry is not None:
+            stored_at, location = entry
+            if time.time() - stored_at < (self.ttl if location else self.negative_ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, location
+        self.misses += 1
+        return False, None
+
+    def known(self, key: str) -> Optional[str]:
+        """Nazwa miasta z AccuWeather dla klucza place_key (bez liczników i przedłużania LRU)"""
+        entry = self.entries.get(key)
+        return entry[1][1] if entry is not None and entry[1] else None
+
+    def put(self, city: str, location: Optional[list]):
+        key = place_key(city)
+        self.entries[key] = (time.time(), location)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def load(self):
+        """Wczytuje lokalizacje z dysku (bez przeterminowanych)"""
+        if not (self.persist and os.path.exists(self.file)):
+            return
+        try:
+            with open(self.file, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            now = time.time()
+            for key, stored_at, location in stored:
+                if now - stored_at < (self.ttl if location else self.negative_ttl):
+                    self.entries[place_key(key)] = (stored_at, location)  # starsze pliki: klucze z myślnikami
+            logger.info(f"🌍 Wczytano {len(self.entries)} lokalizacji pogodowych z dysku")
+        except Exception as e:
+            logger.error(f"❌ Błąd wczytywania lokalizacji pogodowych: {e}")
+
+    def save(self):
+        """Zapisuje lokalizacje na dysk (atomowo przez plik tymczasowy)"""
+        if not self.persist:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+            stored = [[key, stored_at, location] for key, (stored_at, location) in list(self.entries.items())]
+            tmp_file = self.file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(stored, f, ensure_ascii=False)
+            os.replace(tmp_file, self.file)
+        except Exception as e:
+            logger.error(f"❌ Błąd zapisu lokalizacji pogodowych: {e}")
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class WeatherIntentDetector:
+    """Wykrywanie pytań o pogodę jednym przejściem po słowach wiadomości
+    
+    Wiadomość bez słowa-wyzwalacza (pogoda, temperatura, prognoza) odpada na jednym prekompilowanym
+    regeksie. Pozostałe są normalizowane i dzielone na słowa; po wyzwalaczu lub przyimku (albo
+    tuż przed wyzwalaczem) szukamy najdłuższej nazwy miasta (do max_words słów) w słowniku -
+    tylko znane miasta trafiają do AccuWeather, więc "wkurza mnie ta pogoda" nie kosztuje
+    żadnego zapytania.
+    """
+
+    WORD_RE = PLACE_WORD_RE
+
+    def __init__(self, cities: Dict[str, List[str]]):
+        self.trigger_re = re.compile(r'pogod|temperatur|prognoz', re.IGNORECASE)
+        self.cities: Dict[str, str] = {}  # znormalizowana forma ("krakowie") -> nazwa dla AccuWeather ("Kraków")
+        for city, forms in cities.items():
+            for form in [city, *forms]:
+                key = self.key(form)
+                if key not in WEATHER_AMBIGUOUS_NAMES:
+                    self.cities[key] = city
+        self.max_words = max((key.count(' ') + 1 for key in self.cities), default=1)
+
+    @staticmethod
+    def key(text: str) -> str:
+        return place_key(text)
+
+    def detect(self, text: str, known=None) -> Optional[str]:
+        """Miasto z pytania o pogodę albo None; known(klucz) - dodatkowe miasta (np. z cache lokalizacji)"""
+        if not self.trigger_re.search(text):
+            return None
+        words = self.WORD_RE.findall(normalize_place(text))
+        if WEATHER_TRIGGERS.isdisjoint(words):
+            return None
+        for start in range(len(words)):
+            after_anchor = start > 0 and (words[start - 1] in WEATHER_TRIGGERS or words[start - 1] in WEATHER_PREPOSITIONS)
+            for length in range(min(self.max_words, len(words) - start), 0, -1):
+                end = start + length
+                if not (after_anchor or (end < len(words) and words[end] in WEATHER_TRIGGERS)):
+                    continue
+                key = ' '.join(words[start:end])
+                city = self.cities.get(key) or (known(key) if known and key not in WEATHER_AMBIGUOUS_NAMES else None)
+                if city:
+                    return city
+        return None
+
+
+class WeatherConditionsCache:
+    """Gotowe odpowiedzi z aktualnymi warunkami per location key (stale-while-revalidate)
+    
+    Odpowiedź młodsza niż fresh_minutes idzie prosto z pamięci; starsza (do max_stale_minutes)
+    też, ale w tle startuje odświeżenie. Dopiero brak wpisu wymaga czekania na AccuWeather.
+    """
+
+    def __init__(self, config: dict):
+        self.fresh = config.get('conditions_fresh_minutes', 10) * 60
+        self.max_stale = config.get('conditions_max_stale_minutes', 90) * 60
+        self.max_entries = config.get('max_conditions', 500)
+        self.entries: OrderedDict = OrderedDict()  # location key -> (czas pobrania jako monotonic, tekst odpowiedzi)
+        self.refreshing: Dict[str, asyncio.Task] = {}
+        self.fresh_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, location_key: str) -> tuple:
+        """(tekst odpowiedzi lub None, czy trzeba odświeżyć)"""
+        entry = self.entries.get(location_key)
+        if entry is not None:
+            fetched_at, text = entry
+            age = time.monotonic() - fetched_at
+            if age < self.max_stale:
+                self.entries.move_to_end(location_key)
+                if age < self.fresh:
+                    self.fresh_hits += 1
+                    return text, False
+                self.stale_hits += 1
+                return text, True
+        self.misses += 1
+        return None, True
+
+    def put(self, location_key: str, text: str):
+        self.entries[location_key] = (time.monotonic(), text)
+        self.entries.move_to_end(location_key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'fresh': self.fresh_hits, 'stale': self.stale_hits, 'miss': self.misses}
+
+
+# === PROMPT SYSTEMOWY ===
+
+WARSAW_TZ = pytz.timezone('Europe/Warsaw')
+
+# Polskie nazwy dni (kolejność jak datetime.weekday()) i miesięcy
+POLISH_DAYS = ['Poniedziałek', 'Wtorek', 'Środa', 'Czwartek', 'Piątek', 'Sobota', 'Niedziela']
+POLISH_MONTHS = ['Styczeń', 'Luty', 'Marzec', 'Kwiecień', 'Maj', 'Czerwiec',
+                 'Lipiec', 'Sierpień', 'Wrzesień', 'Październik', 'Listopad', 'Grudzień']
+
+# Dopiski o typie rozmowy - jeden wariant osobowości na każdy typ
+CHAT_CONTEXT_SUFFIXES = {
+    'default': "",
+    'channel_member': "\n\nKONTEKST ROZMOWY: Rozmawiasz z członkiem kanału. Możesz używać wulgaryzmów, ale NIE WYZYWAJ bezpośrednio rozmówcy.",
+    'group_insult': "\n\nKONTEKST ROZMOWY: Rozmawiasz w grupie VIP. Możesz używać wulgaryzmów i czasami wyzwać rozmówcy.",
+    'group_no_insult': "\n\nKONTEKST ROZMOWY: Rozmawiasz w grupie VIP. Możesz używać wulgaryzmów, ale NIE WYZYWAJ bezpośrednio rozmówcy.",
+    'private': "\n\nKONTEKST ROZMOWY: Prywatna rozmowa. Możesz używać wulgaryzmów i być bezpośredni, w tym wyzywać rozmówcy."
+}
+
+
+class SystemPromptBuilder:
+    """Prekompilowane warianty promptu systemowego + data odświeżana najwyżej raz na minutę"""
+
+    def __init__(self, personality: str):
+        # Osobowość + dopisek o typie rozmowy - składane raz, przy starcie
+        self.variants = {variant: personality + suffix for variant, suffix in CHAT_CONTEXT_SUFFIXES.items()}
+        self.current_datetime = datetime.now(WARSAW_TZ)
+        self.formatted_date = ''
+        self._minute = None
+        self._messages: Dict[str, dict] = {}
+        self._cached_messages: Dict[str, dict] = {}
+
+    def _refresh(self):
+        """Przelicza datę i gotowe wiadomości systemowe, jeśli zmieniła się minuta"""
+        minute = int(time.time() // 60)
+        if minute == self._minute:
+            return
+        now = datetime.now(WARSAW_TZ)
+        self.current_datetime = now
+        self.formatted_date = f"{POLISH_DAYS[now.weekday()]}, {now.day:02d} {POLISH_MONTHS[now.month - 1]} {now.year}, {now:%H:%M}"
+        date_part = {"text": (
+            f"AKTUALNA DATA I CZAS: {self.formatted_date} (strefa czasowa: Europa/Warszawa)"
+            f"\n\nWAŻNE: Zawsze używaj tej daty jako punktu odniesienia. Jeśli szukasz informacji w internecie, "
+            f"pamiętaj że dzisiaj jest {self.formatted_date}. Jesteśmy w roku {now.year}!"
+        )}
+        self._messages = {
+            variant: {"role": "user", "parts": [{"text": text}, date_part]}
+            for variant, text in self.variants.items()
+        }
+        # Warianty bez osobowości - gdy osobowość siedzi w cache kontekstu Gemini
+        self._cached_messages = {
+            variant: {"role": "user", "parts": [{"text": suffix.strip()}, date_part] if suffix else [date_part]}
+            for variant, suffix in CHAT_CONTEXT_SUFFIXES.items()
+        }
+        self._minute = minute
+
+    def system_message(self, variant: str = 'default') -> dict:
+        """Gotowa wiadomość systemowa dla wariantu (nie modyfikować - współdzielona)"""
+        self._refresh()
+        return self._messages[variant]
+
+    def cached_system_message(self, variant: str = 'default') -> dict:
+        """Jak system_message, ale bez osobowości (ta jest w cachedContent)"""
+        self._refresh()
+        return self._cached_messages[variant]
+
+    def now(self) -> datetime:
+        """Aktualna data w strefie Europa/Warszawa (z dokładnością do minuty)"""
+        self._refresh()
+        return self.current_datetime
+
+
+class GeminiContextCache:
+    """Statyczna osobowość zarejestrowana w Gemini jako cachedContent (z odświeżaniem TTL)"""
+
+    def __init__(self, config: dict, base_url: str, api_key: str, model: str, personality: str):
+        self.enabled = config.get('enabled', False)
+        self.ttl_seconds = config.get('ttl_seconds', 3600)
+        self.refresh_before_expiry = config.get('refresh_before_expiry', 300)
+        self.retry_after_failure = config.get('retry_after_failure', 600)
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.personality = personality
+        self.name: Optional[str] = None
+        self.expires_at = 0.0      # time.monotonic()
+        self.disabled_until = 0.0  # po błędzie - tryb inline do tego czasu
+        self.cached_requests = 0
+        self.inline_requests = 0
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def current_name(self, session: aiohttp.ClientSession) -> Optional[str]:
+        """Nazwa aktywnego cache albo None (tryb inline) - nigdy nie czeka na sieć"""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        if self.name and now >= self.expires_at:
+            self.name = None
+        # Rejestracja/odświeżenie w tle, zanim TTL wygaśnie
+        needs_refresh = self.name is None or now >= self.expires_at - self.refresh_before_expiry
+        if needs_refresh and now >= self.disabled_until and (self._refresh_task is None or self._refresh_task.done()):
+            self._refresh_task = asyncio.create_task(self.refresh(session))
+        if self.name:
+            self.cached_requests += 1
+        else:
+            self.inline_requests += 1
+        return self.name
+
+    async def refresh(self, session: aiohttp.ClientSession):
+        """Przedłuża TTL istniejącego cache albo rejestruje nowy"""
+        ttl = {"ttl": f"{self.ttl_seconds}s"}
+        try:
+            if self.name:
+                async with session.patch(f"{self.base_url}/{self.name}?updateMask=ttl&key={self.api_key}", json=ttl) as response:
+                    if response.status == 200:
+                        self.expires_at = time.monotonic() + self.ttl_seconds
+                        logger.info(f"🧊 Odświeżono cache kontekstu Gemini: {self.name}")
+                        return
+                    logger.warning(f"⚠️ Nie udało się odświeżyć cache kontekstu ({response.status}) - tworzę nowy")
+            payload = {
+                "model": f"models/{self.model}",
+                "displayName": "silver3premiumsmartbot-persona",
+                "contents": [{"role": "user", "parts": [{"text": self.personality}]}],
+                **ttl
+            }
+            async with session.post(f"{self.base_url}/cachedContents?key={self.api_key}", json=payload) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    self.name = data['name']
+                    self.expires_at = time.monotonic() + self.ttl_seconds
+                    logger.info(f"🧊 Zarejestrowano cache kontekstu Gemini: {self.name}")
+                else:
+                    # Np. za krótki prompt na cache (minimalna liczba tokenów) - zostajemy przy inline
+                    error_text = await response.text()
+                    logger.warning(f"⚠️ Cache kontekstu niedostępny ({response.status}): {error_text[:200]}")
+                    self.invalidate()
+        except Exception as e:
+            logger.warning(f"⚠️ Błąd cache kontekstu Gemini: {e}")
+            self.invalidate()
+
+    def invalidate(self):
+        """Porzuca cache i wstrzymuje ponowne próby na jakiś czas (tryb inline)"""
+        self.name = None
+        self.disabled_until = time.monotonic() + self.retry_after_failure
+
+    async def delete(self, session: aiohttp.ClientSession):
+        """Usuwa cache przy wyłączaniu bota (best effort)"""
+        if not self.name:
+            return
+        try:
+            async with session.delete(f"{self.base_url}/{self.name}?key={self.api_key}"):
+                pass
+        except Exception as e:
+            logger.warning(f"⚠️ Nie udało się usunąć cache kontekstu: {e}")
+        self.name = None
+
+
+# === ODPORNOŚĆ KLIENTA GEMINI ===
+
+# Błędy przejściowe - warto ponowić (ewentualnie na innym modelu)
+GEMINI_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class GeminiUnavailableError(Exception):
+    """Wszystkie modele Gemini są chwilowo wyłączone przez circuit breaker"""
+
+
+class CircuitBreaker:
+    """Circuit breaker per model: po serii błędów przestaje wysyłać zapytania na cooldown"""
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None  # time.monotonic(); None = zamknięty
+        self.trial_in_progress = False
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> bool:
+        """Czy można wysłać zapytanie (w stanie half_open - tylko jedno próbne)"""
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.trial_in_progress:
+            self.trial_in_progress = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_in_progress or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.trial_in_progress:
+                self.times_opened += 1
+            self.opened_at = time.monotonic()
+            self.trial_in_progress = False
+
+    def release_trial(self):
+        """Próba przerwana bez wyniku (np. anulowana) - kolejne zapytanie może spróbować ponownie"""
+        self.trial_in_progress = False
+
+
+class LatencyWindow:
+    """Ostatnie czasy odpowiedzi (okno kroczące) do wyznaczania p95 dla hedgingu"""
+
+    def __init__(self, size: int = 200):
+        self.samples: deque = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# === HARMONOGRAM ZAPYTAŃ GEMINI ===
+
+# Pasy priorytetów (niższy indeks = obsługiwany wcześniej)
+GEMINI_LANES = ('admin', 'direct', 'ambient', 'background')
+LANE_ADMIN, LANE_DIRECT, LANE_AMBIENT, LANE_BACKGROUND = range(len(GEMINI_LANES))
+
+
+class GeminiScheduler:
+    """Globalny limit równoległych zapytań do Gemini z pasami priorytetów i sprawiedliwą kolejką per czat
+    
+    W obrębie pasa kolejność wyznacza start-time fair queuing: każdy czat dostaje
+    wirtualny czas zakończenia (koszt 1/waga), więc jeden zalany czat nie wypycha innych.
+    """
+
+    def __init__(self, config: dict):
+        self.max_concurrent = config.get('max_concurrent', 8)
+        self.chat_weights = {int(chat): weight for chat, weight in config.get('chat_weights', {}).items()}
+        self.active = 0
+        self.queue: List[tuple] = []  # kopiec (pas, finish, seq, start, future)
+        self.virtual_time = 0.0
+        self.last_finish: Dict[int, float] = {}
+        self.sequence = itertools.count()
+        self.dispatched = [0] * len(GEMINI_LANES)
+        self.waits = [LatencyWindow() for _ in GEMINI_LANES]
+
+    @asynccontextmanager
+    async def slot(self, chat_key: int, lane: int = LANE_DIRECT):
+        """Zajmuje miejsce na czas zapytania (czeka w kolejce, jeśli limit jest wyczerpany)"""
+        await self.acquire(chat_key, lane)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, chat_key: int, lane: int):
+        started = time.monotonic()
+        # Anulowane wpisy na czubku kolejki nie blokują nowych zapytań
+        while self.queue and self.queue[0][-1].done():
+            heapq.heappop(self.queue)
+        if self.active < self.max_concurrent and not self.queue:
+            self.active += 1
+        else:
+            start = max(self.virtual_time, self.last_finish.get(chat_key, 0.0))
+            finish = start + 1.0 / self.chat_weights.get(chat_key, 1.0)
+            self.last_finish[chat_key] = finish
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.queue, (lane, finish, next(self.sequence), start, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Miejsce mogło zostać przydzielone tuż przed anulowaniem - oddaj je
+                if future.done() and not future.cancelled():
+                    self.release()
+                raise
+        self.dispatched[lane] += 1
+        self.waits[lane].add(time.monotonic() - started)
+
+    def release(self):
+        """Przekazuje zwolnione miejsce następnemu w kolejce albo zmniejsza licznik aktywnych"""
+        while self.queue:
+            _, finish, _, start, future = heapq.heappop(self.queue)
+            if future.done():
+                continue  # czekający został anulowany
+            self.virtual_time = max(self.virtual_time, start)
+            future.set_result(None)
+            return
+        self.active -= 1
+        # Czaty, które nadrobiły wirtualny czas, nie muszą już być pamiętane
+        if len(self.last_finish) > 1000:
+            self.last_finish = {chat: finish for chat, finish in self.last_finish.items() if finish > self.virtual_time}
+
+    def stats(self) -> dict:
+        """Aktywne zapytania, głębokość kolejki i czasy oczekiwania per pas"""
+        queued = [0] * len(GEMINI_LANES)
+        for lane, *_, future in self.queue:
+            if not future.done():
+                queued[lane] += 1
+        return {
+            'active': self.active,
+            'max_concurrent': self.max_concurrent,
+            'lanes': {
+                name: {
+                    'queued': queued[lane],
+                    'dispatched': self.dispatched[lane],
+                    'wait_p50': self.waits[lane].percentile(0.5) or 0.0,
+                    'wait_p95': self.waits[lane].percentile(0.95) or 0.0
+                }
+                for lane, name in enumerate(GEMINI_LANES)
+            }
+        }
+
+
+def abandon_posts(tasks):
+    """Anuluje zapytania HTTP w locie; odpowiedź, która zdążyła przyjść, oddaje połączenie do puli"""
+    for task in tasks:
+        task.cancel()
+        task.add_done_callback(lambda t: t.cancelled() or t.exception() or t.result().release())
+
+
+def retry_after_header(response: aiohttp.ClientResponse) -> Optional[float]:
+    """Retry-After w sekundach (format daty HTTP jest ignorowany)"""
+    value = response.headers.get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+# === BACKENDY MODELU ===
+
+# Status HTTP -> klucz komunikatu błędu z get_error_message
+MODEL_ERROR_TYPES = {429: "rate_limit", 403: "access_denied", 400: "bad_request"}
+
+
+class ModelResponse:
+    """Wynik zapytania do backendu modelu (niezależny od transportu)"""
+    __slots__ = ('status', 'text', 'error', 'error_text', 'input_tokens', 'output_tokens')
+
+    def __init__(self, status: int = 200, text: Optional[str] = None, error: Optional[str] = None,
+                 error_text: str = '', input_tokens: int = 0, output_tokens: int = 0):
+        self.status = status
+        self.text = text
+        self.error = error  # klucz komunikatu błędu albo None przy sukcesie
+        self.error_text = error_text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+
+
+class ModelBackendError(Exception):
+    """Błąd strumienia zgłoszony przed pierwszym fragmentem odpowiedzi"""
+
+    def __init__(self, status: int, error: str, error_text: str = ''):
+        super().__init__(f"{status}: {error_text[:200]}")
+        self.status = status
+        self.error = error
+        self.error_text = error_text
+
+
+class ModelBackend(ABC):
+    """Interfejs backendu modelu: payload w formacie Gemini -> odpowiedź (całość albo strumień)
+    
+    build_inline_payload to korutyna budująca payload bez cachedContent (fallback).
+    Każde wywołanie - także przerwane wyjątkiem - kończy się dokładnie jednym record().
+    """
+    name = 'base'
+
+    def __init__(self, config: dict):
+        pricing = config.get('pricing', {})
+        self.input_price = pricing.get('input_per_million_usd', 0.0)
+        self.output_price = pricing.get('output_per_million_usd', 0.0)
+        self.calls = 0
+        self.errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.latency = LatencyWindow()
+        self.usage_listener = None  # opcjonalnie: callback(ok, input_tokens, output_tokens)
+
+    @abstractmethod
+    async def generate(self, payload: dict, build_inline_payload) -> ModelResponse:
+        """Cała odpowiedź naraz"""
+
+    @abstractmethod
+    def stream(self, payload: dict, build_inline_payload) -> AsyncIterator[str]:
+        """Odpowiedź fragmentami (ModelBackendError, jeśli błąd wystąpi przed pierwszym fragmentem)"""
+
+    def record(self, started: float, ok: bool, input_tokens: int = 0, output_tokens: int = 0):
+        """Zapisuje liczniki wywołania (czas, tokeny, błędy)"""
+        self.calls += 1
+        self.latency.add(time.monotonic() - started)
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        if not ok:
+            self.errors += 1
+        if self.usage_listener is not None:
+            self.usage_listener(ok, input_tokens, output_tokens)
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.name,
+            'calls': self.calls,
+            'errors': self.errors,
+            'latency_p50': self.latency.percentile(0.5) or 0.0,
+            'latency_p95': self.latency.percentile(0.95) or 0.0,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens,
+            'cost_usd': (self.input_tokens * self.input_price + self.output_tokens * self.output_price) / 1_000_000
+        }
+
+
+class GeminiRestBackend(ModelBackend):
+    """Gemini przez REST API (z ponowieniami, breakerem i fallbackiem z post_gemini)"""
+    name = 'gemini'
+
+    def __init__(self, config: dict, post, log_payload):
+        super().__init__(config)
+        self.post = post  # SmartAIBot.post_gemini
+        self.log_payload = log_payload
+
+    async def generate(self, payload: dict, build_inline_payload) -> ModelResponse:
+        started = time.monotonic()
+        try:
+            response = await self.post('generateContent', payload, build_inline_payload)
+        except GeminiUnavailableError as e:
+            self.record(started, False)
+            return ModelResponse(503, error="general_error", error_text=str(e))
+        
+        try:
+            async with response:
+                if response.status != 200:
+                    result = ModelResponse(
+                        response.status, error=MODEL_ERROR_TYPES.get(response.status, "general_error"),
+                        error_text=await response.text()
+                    )
+                else:
+                    result = self.parse(await response.json())
+        except BaseException:
+            self.record(started, False)  # zerwane połączenie, niepoprawny JSON, anulowanie
+            raise
+        self.record(started, result.error is None, result.input_tokens, result.output_tokens)
+        return result
+
+    def parse(self, data: dict) -> ModelResponse:
+        """Wyciąga tekst odpowiedzi (albo klucz błędu) z odpowiedzi generateContent"""
+        usage = data.get('usageMetadata', {})
+        tokens = {'input_tokens': usage.get('promptTokenCount', 0), 'output_tokens': usage.get('candidatesTokenCount', 0)}
+        if not data.get('candidates'):
+            self.log_payload("❌ Brak 'candidates' w odpowiedzi", data)
+            return ModelResponse(error="no_candidates", **tokens)
+        
+        candidate = data['candidates'][0]
+        logger.debug("🔍 Struktura candidate: %s", candidate.keys())
+        try:
+            if 'content' in candidate and 'parts' in candidate['content']:
+                return ModelResponse(text=candidate['content']['parts'][0]['text'], **tokens)
+            if 'content' in candidate and 'role' in candidate['content']:
+                # Przypadek gdy finishReason = MAX_TOKENS i brak 'parts'
+                if candidate.get('finishReason', '') == 'MAX_TOKENS':
+                    logger.warning("⚠️ Odpowiedź przerwana (MAX_TOKENS)")
+                    return ModelResponse(error="max_tokens", **tokens)
+                self.log_payload("❌ Brak 'parts' w content", candidate)
+                return ModelResponse(error="no_parts", **tokens)
+            if 'text' in candidate:
+                # Alternatywny format odpowiedzi
+                return ModelResponse(text=candidate['text'], **tokens)
+            self.log_payload("❌ Nieoczekiwana struktura candidate", candidate)
+            return ModelResponse(error="unexpected_structure", **tokens)
+        except (KeyError, IndexError) as e:
+            logger.error(f"❌ Błąd parsowania odpowiedzi Gemini: {e}")
+            self.log_payload("🔍 Pełna odpowiedź", data)
+            return ModelResponse(error="parsing_error", **tokens)
+
+    async def stream(self, payload: dict, build_inline_payload) -> AsyncIterator[str]:
+        started = time.monotonic()
+        usage: dict = {}
+        try:
+            response = await self.post('streamGenerateContent', payload, build_inline_payload)
+        except GeminiUnavailableError as e:
+            self.record(started, False)
+            raise ModelBackendError(503, "general_error", str(e))
+        
+        # Liczniki zapisywane w finally - także gdy strumień zerwie się w połowie albo odbiorca
+        # przestanie czytać; sukces tylko wtedy, gdy model oddał jakikolwiek tekst
+        produced = failed = False
+        try:
+            async with response:
+                if response.status != 200:
+                    raise ModelBackendError(
+                        response.status, MODEL_ERROR_TYPES.get(response.status, "general_error"), await response.text()
+                    )
+                
+                # Każde zdarzenie SSE to jedna linia "data: {...}" z fragmentem odpowiedzi
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    chunk = json.loads(line[5:])
+                    usage = chunk.get('usageMetadata', usage)
+                    for candidate in chunk.get('candidates', [])[:1]:
+                        for part in candidate.get('content', {}).get('parts', []):
+                            if part.get('text') and not part.get('thought'):
+                                produced = True
+                                yield part['text']
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.record(started, produced and not failed, usage.get('promptTokenCount', 0), usage.get('candidatesTokenCount', 0))
+
+
+class FakeModelBackend(ModelBackend):
+    """Deterministyczny backend-atrapa do testów obciążeniowych offline
+    
+    Opóźnienie losowane z rozkładu (fixed / uniform / lognormal), błędy z zadanym
+    prawdopodobieństwem, odpowiedź z zadanej liczby tokenów (1 słowo = 1 token).
+    Ten sam seed i ta sama kolejność zapytań dają te same wyniki.
+    """
+    name = 'fake'
+    WORDS = ("siema", "stary", "no", "jasne", "kurde", "serio", "sprawdźmy", "to", "ogarniemy",
+             "spoko", "dokładnie", "bot", "odpowiada", "szybko", "luz")
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.rng = random.Random(config.get('seed', 42))
+        self.latency_config = config.get('latency_ms', {})
+        self.error_rate = config.get('error_rate', 0.0)
+        self.error_statuses = config.get('error_statuses', [429, 503])
+        self.output_tokens_range = config.get('output_tokens', [20, 120])
+        self.chunk_tokens = config.get('stream_chunk_tokens', 8)
+        self.chunk_delay = config.get('stream_chunk_delay_ms', 20) / 1000
+        self.gif_tag_rate = config.get('gif_tag_rate', 0.0)
+
+    def sample_latency(self) -> float:
+        """Czas odpowiedzi w sekundach wg skonfigurowanego rozkładu"""
+        cfg = self.latency_config
+        distribution = cfg.get('distribution', 'lognormal')
+        if distribution == 'fixed':
+            ms = cfg.get('median', 800)
+        elif distribution == 'uniform':
+            ms = self.rng.uniform(cfg.get('min', 300), cfg.get('max', 1500))
+        else:
+            ms = self.rng.lognormvariate(math.log(cfg.get('median', 800)), cfg.get('sigma', 0.5))
+        return min(ms, cfg.get('max', 60000)) / 1000
+
+    def make_text(self) -> tuple:
+        """(tekst odpowiedzi, liczba tokenów)"""
+        tokens = self.rng.randint(*self.output_tokens_range)
+        text = " ".join(self.rng.choice(self.WORDS) for _ in range(tokens)) + " 😎"
+        if self.rng.random() < self.gif_tag_rate:
+            text += " [GIF_TAG: smiech]"
+        return text, tokens
+
+    @staticmethod
+    def count_input_tokens(payload: dict) -> int:
+        chars = sum(len(part.get('text', '')) for content in payload.get('contents', []) for part in content.get('parts', []))
+        return chars // 4
+
+    def sample_error(self) -> Optional[int]:
+        return self.rng.choice(self.error_statuses) if self.rng.random() < self.error_rate else None
+
+    async def generate(self, payload: dict, build_inline_payload) -> ModelResponse:
+        started = time.monotonic()
+        await asyncio.sleep(self.sample_latency())
+        status = self.sample_error()
+        if status is not None:
+            self.record(started, False)
+            return ModelResponse(status, error=MODEL_ERROR_TYPES.get(status, "general_error"), error_text="fake error")
+        text, tokens = self.make_text()
+        input_tokens = self.count_input_tokens(payload)
+        self.record(started, True, input_tokens, tokens)
+        return ModelResponse(text=text, input_tokens=input_tokens, output_tokens=tokens)
+
+    async def stream(self, payload: dict, build_inline_payload) -> AsyncIterator[str]:
+        started = time.monotonic()
+        await asyncio.sleep(self.sample_latency())  # czas do pierwszego fragmentu
+        status = self.sample_error()
+        if status is not None:
+            self.record(started, False)
+            raise ModelBackendError(status, MODEL_ERROR_TYPES.get(status, "general_error"), "fake error")
+        text, tokens = self.make_text()
+        words = text.split(" ")
+        try:
+            for index in range(0, len(words), self.chunk_tokens):
+                if index:
+                    await asyncio.sleep(self.chunk_delay)
+                yield " ".join(words[index:index + self.chunk_tokens]) + " "
+        finally:
+            self.record(started, True, self.count_input_tokens(payload), tokens)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Zwraca czas oczekiwania z RetryAfter (int albo timedelta zależnie od wersji PTB)"""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+# === EKSPORT METRYK ===
+
+# Co który kubełek histogramu opóźnień trafia do eksportu (granice co ~2.4x zamiast co 25%)
+EXPORT_BUCKET_STEP = 4
+
+
+def prometheus_escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PrometheusText:
+    """Buduje tekst w formacie ekspozycji Prometheus (HELP/TYPE + próbki)"""
+
+    def __init__(self):
+        self.lines: List[str] = []
+
+    @staticmethod
+    def labels(labels: dict) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{prometheus_escape(value)}"' for key, value in labels.items()) + '}'
+
+    def metric(self, name: str, kind: str, help_text: str, samples: Iterable[tuple]):
+        """samples: [(etykiety, wartość)]"""
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{self.labels(labels)} {value}")
+
+    def histogram(self, name: str, help_text: str, series: Iterable[tuple]):
+        """series: [(etykiety, LatencyHistogram)] - kubełki skumulowane, jak wymaga Prometheus"""
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in series:
+            cumulative = 0
+            for index, bucket_count in enumerate(histogram.counts[:-1]):
+                cumulative += bucket_count
+                if index % EXPORT_BUCKET_STEP == EXPORT_BUCKET_STEP - 1:
+                    bucket_labels = self.labels({**labels, 'le': f"{LATENCY_BUCKETS[index]:.6g}"})
+                    self.lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            self.lines.append(f"{name}_bucket{self.labels({**labels, 'le': '+Inf'})} {histogram.count}")
+            self.lines.append(f"{name}_sum{self.labels(labels)} {histogram.total:.6f}")
+            self.lines.append(f"{name}_count{self.labels(labels)} {histogram.count}")
+
+    def render(self) -> str:
+        return '\n'.join(self.lines) + '\n'
+
+
+class MetricsExporter:
+    """Co `interval` sekund publikuje metryki bota dla serwera HTTP (patrz metrics_bridge.py)
+    
+    Tekst budowany jest w pętli zdarzeń (O(liczba metryk)), zapis pliku - w wątku.
+    Zapytanie o /metrics czyta gotową migawkę i nie angażuje procesu bota.
+    """
+
+    def __init__(self, config: dict, render):
+        self.enabled = config.get('enabled', True)
+        self.interval = config.get('interval', 10)
+        self.file = metrics_file_path(config.get('file', ''))
+        self.render = render
+        self.task: Optional[asyncio.Task] = None
+
+    async def publish(self):
+        try:
+            await asyncio.to_thread(write_metrics, self.render(), self.file)
+        except Exception as e:
+            logger.error(f"❌ Błąd publikowania metryk: {e}")
+
+    async def publish_loop(self):
+        while True:
+            await self.publish()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Uruchamia publikowanie (wywoływane w post_init)"""
+        if self.enabled and self.task is None:
+            logger.info(f"📡 Metryki publikowane do {self.file} co {self.interval}s")
+            self.task = asyncio.create_task(self.publish_loop())
+
+    async def close(self):
+        """Zatrzymuje publikowanie i zapisuje ostatnią migawkę"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            await self.publish()
 
-# Custom HTTP client z lepszymi ustawieniami
-async def create_http_client():
-    """Tworzy HTTP client z lepszymi ustawieniami dla stabilności"""
-    return httpx.AsyncClient(
-        timeout=HTTP_TIMEOUT,
-        limits=HTTP_LIMITS,
-        headers={
-            'User-Agent': 'Silver3premiumsmartbot/4.0.0 (Windows)',
-            'Accept': 'application/json',
-            'Accept-Encoding': 'gzip, deflate'
-        },
-        follow_redirects=True,
-        max_redirects=5
-    )
 
 class SmartAIBot:
     def __init__(self, config: dict):
@@ -99,41 +2470,67 @@ class SmartAIBot:
         self.token = config['bot_token']
         self.gemini_api_key = config.get('gemini_api_key', '')
         
+        # Logowanie: flagi z sekcji 'logging' faktycznie wyłączają logi zapytań/wiadomości
+        self.logging_config = config.get('logging', {})
+        configure_logging(self.logging_config)
+        self.log_ai_queries = self.logging_config.get('log_ai_queries', True)
+        self.log_user_messages = self.logging_config.get('log_user_messages', True)
+        self.log_sampler = LogSampler(
+            self.logging_config.get('sampled_logs_per_minute', 5)
+        )
+        
         # Ustawienia bota z konfiguracji
         self.settings = config.get('settings', {})
+        
+        # Okno kontekstu: budżet tokenów + kroczące podsumowanie starszych wiadomości
+        self.conversation_window = ConversationWindow(
+            config.get('context_window', {}),
+            self.settings.get('max_context_messages', 10) * 2  # x2 bo user+assistant
+        )
+        self.pending_summary_turns: Dict[int, List[Turn]] = {}
+        self.summary_tasks: Dict[int, asyncio.Task] = {}
         self.bot_name = self.settings.get('bot_name', 'SmartAI')
         
         # Kanał dla członków (mniej obraźliwy tryb)
         self.channel_id = config.get('channel_id', '')  # ID kanału do sprawdzania
-        self.channel_members_cache = {}  # Cache członków kanału
+        self.channel_members = MembershipCache(config.get('channel_membership', {}))
+        
+        # Pomiary opóźnień etapów obsługi update'u (histogramy p50/p95/p99)
+        self.latency = LatencyMetrics(config.get('latency_metrics', {}))
         
         # Inicjalizacja aplikacji z lepszymi ustawieniami połączenia
         self.application = (
             Application.builder()
             .token(self.token)
-            .read_timeout(30.0)
-            .write_timeout(30.0)
-            .connect_timeout(10.0)
-            .pool_timeout(10.0)
-            .get_updates_read_timeout(30.0)
-            .get_updates_write_timeout(30.0)
-            .get_updates_connect_timeout(10.0)
-            .get_updates_pool_timeout(10.0)
+            .request(TimedRequest(
+                self.latency,
+                connection_pool_size=256,
+                read_timeout=30.0,
+                write_timeout=30.0,
+                connect_timeout=10.0,
+                pool_timeout=10.0
+            ))
+            .get_updates_request(HTTPXRequest(
+                read_timeout=30.0,
+                write_timeout=30.0,
+                connect_timeout=10.0,
+                pool_timeout=10.0
+            ))
             .build()
         )
         
-        # Cache rozmów dla kontekstu
-        self.conversation_cache = {}
+        # Współdzielony klient HTTP - tworzony w post_init, zamykany przy wyłączeniu
+        self.http_config = config.get('http_client', {})
+        self.http_session: Optional[aiohttp.ClientSession] = None
+        self.http_pool_stats = HttpPoolStats()
         
-        # Rate limiting dla Gemini API - z konfiguracji
-        self.last_ai_request = {}  # Ostatnie zapytanie per użytkownik
-        self.ai_request_count = {}  # Licznik zapytań per użytkownik
-        self.max_requests_per_minute = config.get('limits', {}).get('ai_requests_per_user_per_hour', 200) // 60  # Przelicz na minutę
+        # Rozmowy: aktywni użytkownicy w pamięci, historia w SQLite (przetrwa restart)
+        self.conversation_store = ConversationStore(
+            config.get('conversation_store', {}), self.conversation_window, on_evict=self.forget_pending_summary
+        )
         
-        # Rate limiting dla GIPHY API
-        self.last_giphy_request = {}  # Ostatnie zapytanie GIPHY per użytkownik
-        self.giphy_request_count = {}  # Licznik zapytań GIPHY per użytkownik
-        self.max_giphy_requests_per_hour = config.get('limits', {}).get('giphy_requests_per_user_per_hour', 50)
+        # Limity zapytań (AI, GIPHY, pogoda, komendy) - z sekcji 'limits' konfiguracji
+        self.rate_limiter = RateLimiter(config.get('limits', {}))
         
         # Osobowość bota z konfiguracji - rozszerzona o emotki i GIF-y
         self.personality = config.get('system_prompt', """Jesteś SmartAI - inteligentnym, przyjaznym asystentem z charakterem! 😎
@@ -182,20 +2579,61 @@ class SmartAIBot:
         - Wybieraj tylko jeden typ (GIF lub naklejka) na wiadomość
         - Emotki dodawaj naturalnie, nie na siłę! 🎯""")
         
+        # Gotowe warianty promptu systemowego (osobowość + typ rozmowy + data)
+        self.prompt_builder = SystemPromptBuilder(self.personality)
+        
         # Konfiguracja Gemini z pliku
         self.gemini_config = config.get('gemini_config', {})
         self.safety_settings = config.get('safety_settings', {})
+        self.gemini_base_url = self.gemini_config.get('api_base_url', 'https://generativelanguage.googleapis.com/v1beta').rstrip('/')
+        
+        # Odporność klienta Gemini: ponowienia, circuit breaker, model zapasowy, hedging
+        self.gemini_resilience = self.gemini_config.get('resilience', {})
+        self.gemini_breakers: Dict[str, CircuitBreaker] = {}
+        self.gemini_latency: Dict[str, LatencyWindow] = {}
+        self.gemini_client_stats = {'retries': 0, 'fallbacks': 0, 'hedged': 0, 'hedge_wins': 0, 'breaker_rejections': 0}
+        
+        # Globalny harmonogram zapytań: limit równoległości, pasy priorytetów, kolejka per czat
+        self.gemini_scheduler = GeminiScheduler(self.gemini_config.get('scheduler', {}))
+        
+        # Backend modelu: Gemini REST albo deterministyczna atrapa do testów obciążeniowych
+        self.model_backend = self.create_model_backend(config.get('model_backend', {}))
+        
+        # Cache kontekstu Gemini dla statycznej osobowości (fallback: inline)
+        self.context_cache = GeminiContextCache(
+            self.gemini_config.get('context_cache', {}),
+            self.gemini_base_url,
+            self.gemini_api_key,
+            self.gemini_config.get('model', 'gemini-1.5-flash-latest'),
+            self.personality
+        )
+        
+        # Cache odpowiedzi dla powtarzalnych komend AI
+        self.response_cache = ResponseCache(config.get('response_cache', {}))
+        self.response_cache.load()
+        
+        # Deduplikacja równoczesnych identycznych zapytań (Gemini, GIPHY, pogoda, członkostwo)
+        self.single_flight = SingleFlight()
+        
+        # Strumieniowanie odpowiedzi (streamGenerateContent + edycje wiadomości)
+        self.streaming_config = config.get('streaming', {})
+        self.streaming_enabled = self.streaming_config.get('enabled', False)
         
-        # Statystyki
+        # Statystyki: czas startu procesu + trwałe liczniki w czasie (przetrwają restart)
         self.stats = {
-            'messages_processed': 0,
-            'ai_queries': 0,
-            'web_queries': 0,
             'start_time': datetime.now()
         }
+        self.activity = ActivityStats(config.get('activity_stats', {}))
+        self.activity.load()
+        self.model_backend.usage_listener = self.record_model_usage
+        
+        # Publikowanie metryk dla /metrics serwera HTTP (render_server.py / server.py)
+        self.metrics_exporter = MetricsExporter(config.get('metrics_export', {}), self.render_metrics)
         
         # Statystyki aktywności użytkowników
         self.user_activity = {}  # {user_id: {'messages': 0, 'ai_queries': 0, 'last_activity': datetime}}
+        self.leaderboard = Leaderboard(self.settings.get('leaderboard_size', 50))
+        self.user_profiles = UserProfileCache(config.get('user_profiles', {}))
         
         # Rozszerzona baza GIF-ów i naklejek
         self.gifs_database = {
@@ -311,11 +2749,22 @@ class SmartAIBot:
         
         # API klucze dla funkcji internetowych
         self.accuweather_api_key = config.get('accuweather_api_key', '')
+        self.weather_config = config.get('weather_config', {})
+        self.weather_api_url = self.weather_config.get('api_url', 'http://dataservice.accuweather.com').rstrip('/')
+        self.weather_locations = LocationKeyCache(self.weather_config)
+        self.weather_locations.load()
+        self.weather_preload_task: Optional[asyncio.Task] = None
+        self.weather_conditions = WeatherConditionsCache(self.weather_config)
+        self.weather_detector = WeatherIntentDetector({**WEATHER_CITIES, **self.weather_config.get('extra_cities', {})})
         self.giphy_api_key = config.get('giphy_api_key', '')
         
         # Konfiguracja GIPHY
         self.giphy_config = config.get('giphy_config', {})
         self.giphy_enabled = config.get('features', {}).get('giphy_integration', False)
+        self.gif_pools = GifPools(self.giphy_config)
+        self.gif_pools.load()
+        self.animation_ids = AnimationFileIds(config.get('animation_cache', {}))
+        self.animation_ids.load()
         
         # Konfiguracja RSS
         self.rss_enabled = config.get('rss_enabled', True)
@@ -336,6 +2785,181 @@ class SmartAIBot:
         
         # RSS scheduler zostanie uruchomiony po starcie aplikacji
     
+    async def get_http_session(self) -> aiohttp.ClientSession:
+        """Zwraca współdzielony klient HTTP (tworzy go, jeśli jeszcze nie istnieje)"""
+        if self.http_session is None or self.http_session.closed:
+            self.http_session = await create_http_client(self.http_config, self.http_pool_stats)
+            logger.info("🔌 Utworzono współdzielony klient HTTP")
+        return self.http_session
+    
+    async def close_http_session(self):
+        """Zamyka współdzielony klient HTTP i jego pulę połączeń"""
+        if self.http_session is not None and not self.http_session.closed:
+            await self.http_session.close()
+            logger.info("🔌 Zamknięto współdzielony klient HTTP")
+        self.http_session = None
+    
+    def format_response_cache_stats(self) -> str:
+        """Formatuje statystyki cache odpowiedzi do /stats"""
+        cache = self.response_cache.stats()
+        return (f"• 🗄️ Cache AI: {cache['hits']} trafień / {cache['misses']} pudeł "
+                f"({cache['hit_ratio']:.0%}), {cache['entries']} wpisów")
+    
+    def render_metrics(self) -> str:
+        """Liczniki, stany i histogramy opóźnień bota w formacie Prometheus"""
+        out = PrometheusText()
+        out.metric('smartai_uptime_seconds', 'gauge', 'Czas działania procesu bota',
+                   [({}, f"{(datetime.now() - self.stats['start_time']).total_seconds():.0f}")])
+        out.metric('smartai_activity_total', 'counter', 'Trwałe liczniki aktywności (przetrwają restart)',
+                   [({'metric': metric}, self.activity.total(metric)) for metric in ACTIVITY_METRICS])
+        
+        backend = self.model_backend.stats()
+        out.metric('smartai_model_calls_total', 'counter', 'Wywołania backendu modelu',
+                   [({'backend': backend['backend']}, backend['calls'])])
+        out.metric('smartai_model_errors_total', 'counter', 'Nieudane wywołania backendu modelu',
+                   [({'backend': backend['backend']}, backend['errors'])])
+        out.metric('smartai_model_tokens_total', 'counter', 'Tokeny modelu od startu procesu',
+                   [({'direction': 'input'}, backend['input_tokens']), ({'direction': 'output'}, backend['output_tokens'])])
+        out.metric('smartai_model_cost_usd_total', 'counter', 'Szacowany koszt tokenów od startu procesu',
+                   [({}, f"{backend['cost_usd']:.6f}")])
+        out.metric('smartai_gemini_client_events_total', 'counter', 'Ponowienia, fallbacki i hedging klienta Gemini',
+                   [({'event': event}, count) for event, count in self.gemini_client_stats.items()])
+        out.metric('smartai_gemini_breaker_open', 'gauge', 'Czy circuit breaker modelu jest otwarty',
+                   [({'model': model}, int(breaker.state != 'closed')) for model, breaker in self.gemini_breakers.items()])
+        
+        scheduler = self.gemini_scheduler.stats()
+        out.metric('smartai_gemini_active_requests', 'gauge', 'Zapytania Gemini w toku', [({}, scheduler['active'])])
+        out.metric('smartai_gemini_queued_requests', 'gauge', 'Zapytania Gemini czekające w kolejce',
+                   [({'lane': name}, lane['queued']) for name, lane in scheduler['lanes'].items()])
+        out.metric('smartai_gemini_dispatched_total', 'counter', 'Zapytania Gemini wpuszczone z kolejki',
+                   [({'lane': name}, lane['dispatched']) for name, lane in scheduler['lanes'].items()])
+        
+        cache = self.response_cache.stats()
+        out.metric('smartai_response_cache_lookups_total', 'counter', 'Odczyty cache odpowiedzi AI',
+                   [({'result': 'hit'}, cache['hits']), ({'result': 'miss'}, cache['misses'])])
+        out.metric('smartai_response_cache_entries', 'gauge', 'Wpisy w cache odpowiedzi AI', [({}, cache['entries'])])
+        out.metric('smartai_single_flight_total', 'counter', 'Zapytania upstream i zaoszczędzone przez deduplikację',
+                   [({'kind': kind, 'outcome': outcome}, counts[outcome])
+                    for kind, counts in self.single_flight.stats().items() for outcome in ('calls', 'saved')])
+        limiter = self.rate_limiter.stats()
+        out.metric('smartai_rate_limited_total', 'counter', 'Zapytania odrzucone przez limity',
+                   [({'kind': kind}, count) for kind, count in limiter['rejected'].items()])
+        
+        store = self.conversation_store.stats()
+        membership = self.channel_members.stats()
+        out.metric('smartai_membership_cache_lookups_total', 'counter', 'Odczyty cache członkostwa w kanale',
+                   [({'result': 'hit'}, membership['hits']), ({'result': 'miss'}, membership['misses'])])
+        out.metric('smartai_membership_checks_failed_total', 'counter', 'Nieudane sprawdzenia członkostwa',
+                   [({}, membership['errors'])])
+        out.metric('smartai_membership_updates_total', 'counter', "Zmiany członkostwa z update'ów chat_member",
+                   [({}, membership['invalidations'])])
+        gifs = self.gif_pools.stats()
+        out.metric('smartai_giphy_pools', 'gauge', 'Pule wyników GIPHY w pamięci', [({}, gifs['pools'])])
+        out.metric('smartai_giphy_events_total', 'counter', 'GIF-y podane z pul i wyszukiwania w GIPHY',
+                   [({'event': 'served'}, gifs['served']), ({'event': 'search'}, gifs['searches'])])
+        animations = self.animation_ids.stats()
+        out.metric('smartai_animation_sends_total', 'counter', 'Wysłane GIF-y: po file_id, po URL, nieważne file_id',
+                   [({'mode': mode}, animations[mode]) for mode in ('reused', 'uploaded', 'expired')])
+        locations = self.weather_locations.stats()
+        out.metric('smartai_weather_location_lookups_total', 'counter', 'Odczyty cache lokalizacji AccuWeather',
+                   [({'result': 'hit'}, locations['hits']), ({'result': 'miss'}, locations['misses'])])
+        conditions = self.weather_conditions.stats()
+        out.metric('smartai_weather_conditions_lookups_total', 'counter', 'Odczyty cache aktualnych warunków pogodowych',
+                   [({'result': result}, conditions[result]) for result in ('fresh', 'stale', 'miss')])
+        out.metric('smartai_conversations_hot', 'gauge', 'Rozmowy w pamięci', [({}, store['hot'])])
+        out.metric('smartai_conversations_pending_writes', 'gauge', 'Rozmowy czekające na zapis', [({}, store['pending'])])
+        out.metric('smartai_conversation_store_events_total', 'counter', 'Odczyty, wyrzucenia i zapisy magazynu rozmów',
+                   [({'event': event}, store[event]) for event in ('loads', 'evictions', 'written')])
+        
+        pool = self.http_pool_stats.snapshot(self.http_session)
+        out.metric('smartai_http_requests_total', 'counter', 'Zapytania współdzielonego klienta HTTP', [({}, pool['requests'])])
+        out.metric('smartai_http_connections_total', 'counter', 'Połączenia HTTP nowe i użyte ponownie',
+                   [({'kind': 'new'}, pool['new_connections']), ({'kind': 'reused'}, pool['reused_connections'])])
+        out.metric('smartai_http_pool_connections', 'gauge', 'Połączenia w puli',
+                   [({'state': 'active'}, pool['active']), ({'state': 'idle'}, pool['idle'])])
+        
+        if self.latency.enabled:
+            out.histogram('smartai_stage_latency_seconds', "Opóźnienia etapów obsługi update'u",
+                          [({'stage': stage}, histogram) for (stage, _), histogram in sorted(self.latency.merged().items())])
+        return out.render()
+    
+    def record_model_usage(self, ok: bool, input_tokens: int, output_tokens: int):
+        """Callback backendu modelu - tokeny Gemini do statystyk w czasie"""
+        self.activity.record('input_tokens', input_tokens)
+        self.activity.record('output_tokens', output_tokens)
+    
+    def format_activity_stats(self) -> str:
+        """Formatuje tempo i trendy aktywności do /stats (godzina i doba vs poprzednie)"""
+        activity = self.activity
+        lines = []
+        for metric, label in (('messages', '💬 Wiadomości'), ('ai_queries', '🧠 Zapytania AI'),
+                              ('web_queries', '🌐 Wyszukiwania'), ('gifs', '🎬 GIF-y'), ('errors', '⚠️ Błędy')):
+            lines.append(f"• {label}: {activity.window(metric, 3600)}/h ({activity.trend(metric, 3600)}), "
+                         f"{activity.window(metric, 86400)}/24h ({activity.trend(metric, 86400)}), "
+                         f"łącznie {activity.total(metric)}")
+        lines.append(f"• 🔤 Tokeny Gemini /24h: {activity.window('input_tokens', 86400)} wejście, "
+                     f"{activity.window('output_tokens', 86400)} wyjście "
+                     f"({activity.trend('output_tokens', 86400)})")
+        since = datetime.fromtimestamp(activity.first_start).strftime('%d.%m.%Y')
+        lines.append(f"• 📅 Statystyki zbierane od {since}")
+        return "\n".join(lines)
+    
+    def format_conversation_store_stats(self) -> str:
+        """Formatuje statystyki magazynu rozmów do /stats"""
+        store = self.conversation_store.stats()
+        return (f"• 👥 Aktywne rozmowy: {store['hot']} w pamięci "
+                f"({store['loads']} wczytanych z bazy, {store['evictions']} wyrzuconych, {store['pending']} do zapisu)")
+    
+    def format_user_profile_stats(self) -> str:
+        """Formatuje statystyki cache nazw użytkowników do /stats"""
+        profiles = self.user_profiles.stats()
+        return (f"• 🪪 Profile: {profiles['entries']} w cache, {profiles['hits']} trafień, "
+                f"{profiles['lookups']} pobrań z Telegrama")
+    
+    def format_single_flight_stats(self) -> str:
+        """Formatuje statystyki deduplikacji zapytań do /stats"""
+        stats = self.single_flight.stats()
+        saved = sum(s['saved'] for s in stats.values())
+        details = ", ".join(f"{kind} {s['saved']}" for kind, s in stats.items() if s['saved']) or "brak"
+        return f"• 🔗 Zaoszczędzone zapytania: {saved} ({details})"
+    
+    def format_gemini_client_stats(self) -> str:
+        """Formatuje statystyki odporności klienta Gemini do /stats"""
+        stats = self.gemini_client_stats
+        open_breakers = [model for model, breaker in self.gemini_breakers.items() if breaker.state != 'closed']
+        return (f"• 🛡️ Gemini: {stats['retries']} ponowień, {stats['fallbacks']} na modelu zapasowym, "
+                f"{stats['hedged']} hedged ({stats['hedge_wins']} wygranych)"
+                + (f", breaker otwarty: {', '.join(open_breakers)}" if open_breakers else ""))
+    
+    def format_gemini_scheduler_stats(self) -> str:
+        """Formatuje stan kolejki Gemini do /stats"""
+        stats = self.gemini_scheduler.stats()
+        lanes = ", ".join(
+            f"{name} {lane['queued']} (p95 {lane['wait_p95']:.1f}s)"
+            for name, lane in stats['lanes'].items() if lane['dispatched'] or lane['queued']
+        ) or "pusta"
+        return f"• 🚦 Kolejka Gemini: {stats['active']}/{stats['max_concurrent']} aktywnych, {lanes}"
+    
+    def format_rate_limiter_stats(self) -> str:
+        """Formatuje statystyki limitów do /stats"""
+        stats = self.rate_limiter.stats()
+        rejected = ", ".join(f"{kind} {count}" for kind, count in stats['rejected'].items() if count) or "brak"
+        return f"• 🚧 Odrzucone przez limity: {rejected} ({stats['tracked_keys']} śledzonych kluczy)"
+    
+    def format_model_backend_stats(self) -> str:
+        """Formatuje statystyki backendu modelu do /stats"""
+        stats = self.model_backend.stats()
+        return (f"• 🧠 Backend {stats['backend']}: {stats['calls']} wywołań ({stats['errors']} błędów), "
+                f"p95 {stats['latency_p95']:.1f}s, tokeny {stats['input_tokens']}/{stats['output_tokens']}, "
+                f"~${stats['cost_usd']:.4f}")
+    
+    def format_http_pool_stats(self) -> str:
+        """Formatuje statystyki puli HTTP do /stats"""
+        pool = self.http_pool_stats.snapshot(self.http_session)
+        return (f"• 🔌 HTTP: {pool['requests']} zapytań, połączenia {pool['active']} aktywne / {pool['idle']} w puli\n"
+                f"• ♻️ Reużycie połączeń: {pool['reuse_ratio']:.0%} ({pool['new_connections']} nowych), "
+                f"DNS cache: {pool['dns_cache_hits']}/{pool['dns_cache_hits'] + pool['dns_cache_misses']}")
+    
     def update_user_activity(self, user_id: int, activity_type: str = 'message'):
         """Aktualizuje statystyki aktywności użytkownika"""
         if user_id not in self.user_activity:
@@ -345,26 +2969,22 @@ class SmartAIBot:
                 'last_activity': datetime.now()
             }
         
-        if activity_type == 'message':
-            self.user_activity[user_id]['messages'] += 1
-        elif activity_type == 'ai_query':
-            self.user_activity[user_id]['ai_queries'] += 1
+        metric = {'message': 'messages', 'ai_query': 'ai_queries'}.get(activity_type)
+        if metric:
+            self.user_activity[user_id][metric] += 1
+            self.leaderboard.record(user_id, metric, self.user_activity[user_id][metric])
         
         self.user_activity[user_id]['last_activity'] = datetime.now()
 
-    def get_top_users(self, limit: int = 10) -> list:
-        """Zwraca top użytkowników według aktywności"""
-        if not self.user_activity:
-            return []
-        
-        # Sortuj użytkowników według liczby wiadomości
-        sorted_users = sorted(
-            self.user_activity.items(),
-            key=lambda x: x[1]['messages'],
-            reverse=True
-        )
-        
-        return sorted_users[:limit]
+    def get_top_users(self, limit: int = 10, metric: str = 'messages', window: str = 'all') -> list:
+        """Zwraca top użytkowników według aktywności (window: all/today/week, metric: messages/ai_queries)"""
+        top_users = []
+        for user_id, _ in self.leaderboard.top(window, metric, limit):
+            data = self.user_activity[user_id]
+            if window != 'all':
+                data = {**self.leaderboard.counts(window, user_id), 'last_activity': data['last_activity']}
+            top_users.append((user_id, data))
+        return top_users
 
     def parse_media_tags(self, text: str) -> tuple[str, str, str]:
         """Parsuje tagi multimediów z odpowiedzi Gemini i zwraca (czysty_tekst, typ_mediów, tag)"""
@@ -413,73 +3033,123 @@ class SmartAIBot:
         return ''
 
     async def get_giphy_gif(self, query: str, user_id: Optional[int] = None) -> str:
-        """Pobiera GIF z GIPHY API"""
+        """Pobiera GIF z GIPHY API (z lokalnej puli wyników, wyszukiwanie tylko przy braku puli)"""
         if not self.giphy_enabled or not self.giphy_api_key:
             # Fallback do lokalnej bazy
             return self.get_random_gif(query)
         
-        # Rate limiting dla GIPHY
-        if user_id:
-            current_time = datetime.now()
-            if user_id not in self.giphy_request_count:
-                self.giphy_request_count[user_id] = 0
-                self.last_giphy_request[user_id] = current_time
-            
-            # Reset licznika co godzinę
-            if (current_time - self.last_giphy_request[user_id]).total_seconds() > 3600:
-                self.giphy_request_count[user_id] = 0
-                self.last_giphy_request[user_id] = current_time
-            
-            # Sprawdź limit
-            if self.giphy_request_count[user_id] >= self.max_giphy_requests_per_hour:
+        gif_urls, needs_refresh = self.gif_pools.get(query)
+        if gif_urls is None:
+            # Rate limiting dla GIPHY (dotyczy tylko prawdziwych wyszukiwań)
+            if self.rate_limiter.check('giphy', user_id=user_id):
                 logger.warning(f"⚠️ Przekroczono limit GIPHY dla użytkownika {user_id}")
-                return self.get_random_gif(query)
-            
-            self.giphy_request_count[user_id] += 1
-            self.last_giphy_request[user_id] = current_time
+                gif_urls = self.gif_pools.stale(query)
+            else:
+                with self.latency.timer('giphy'):
+                    gif_urls = await self.refresh_gif_pool(query) or self.gif_pools.stale(query)
+        elif needs_refresh:
+            self.schedule_gif_pool_refresh(query)
+        
+        if gif_urls:
+            # Wybierz losowy GIF z puli
+            self.gif_pools.served += 1
+            gif_url = random.choice(gif_urls)
+            logger.debug(f"🎬 GIF z puli GIPHY dla zapytania '{query}': {gif_url}")
+            return gif_url
+        
+        # Fallback do lokalnej bazy lub domyślnych GIF-ów
+        fallback_gifs = self.giphy_config.get('fallback_gifs', {})
+        if query in fallback_gifs:
+            return fallback_gifs[query]
+        
+        return self.get_random_gif(query)
+
+    async def refresh_gif_pool(self, query: str) -> List[str]:
+        """Wypełnia pulę jednym wyszukiwaniem (równoczesne odświeżenia tej samej puli - jedno zapytanie)"""
+        gif_urls = await self.single_flight.do('giphy', self.gif_pools.key(query), lambda: self.search_giphy(query))
+        if gif_urls:
+            self.gif_pools.put(query, gif_urls)
+            self.gif_pools.saver.schedule()  # na dysk od razu, poza pętlą zdarzeń
+            logger.info(f"🎬 Odświeżono pulę GIPHY '{query}' ({len(gif_urls)} GIF-ów)")
+        return gif_urls
+    
+    def schedule_gif_pool_refresh(self, query: str):
+        """Odświeża starzejącą się pulę w tle - odpowiedź nie czeka na GIPHY"""
+        key = self.gif_pools.key(query)
+        task = self.gif_pools.refreshing.get(key)
+        if task is not None and not task.done():
+            return
+        if self.rate_limiter.check('giphy'):
+            return  # globalny limit wyczerpany - odświeżymy przy kolejnym użyciu
+        
+        async def refresh():
+            try:
+                await self.refresh_gif_pool(query)
+            finally:
+                self.gif_pools.refreshing.pop(key, None)
         
+        self.gif_pools.refreshing[key] = asyncio.create_task(refresh())
+    
+    async def search_giphy(self, query: str) -> List[str]:
+        """Wyszukuje GIF-y w GIPHY API i zwraca listę URL-i (pusta przy błędzie)"""
+        self.gif_pools.searches += 1
         try:
-            # Przygotuj parametry zapytania
+            # Przygotuj parametry zapytania (duży limit - wyniki trafiają do puli)
             params = {
                 'api_key': self.giphy_api_key,
                 'q': query,
-                'limit': self.giphy_config.get('limit', 10),
+                'limit': self.gif_pools.pool_size,
                 'rating': self.giphy_config.get('rating', 'g'),
                 'lang': self.giphy_config.get('lang', 'pl')
-            }
-            
-            # Wykonaj zapytanie do GIPHY
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    f"{self.giphy_config.get('base_url', 'https://api.giphy.com/v1/gifs')}/search",
-                    params=params,
-                    timeout=aiohttp.ClientTimeout(total=10)
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        
-                        if data.get('data') and len(data['data']) > 0:
-                            # Wybierz losowy GIF z wyników
-                            gif_data = random.choice(data['data'])
-                            gif_url = gif_data['images']['original']['url']
-                            
-                            logger.info(f"🎬 Pobrano GIF z GIPHY dla zapytania '{query}': {gif_url}")
-                            return gif_url
-                        else:
-                            logger.warning(f"⚠️ Brak wyników GIPHY dla zapytania '{query}'")
+            }
+            
+            # Wykonaj zapytanie do GIPHY
+            session = await self.get_http_session()
+            async with session.get(
+                f"{self.giphy_config.get('base_url', 'https://api.giphy.com/v1/gifs')}/search",
+                params=params,
+                timeout=aiohttp.ClientTimeout(total=10)
+            ) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    
+                    if data.get('data') and len(data['data']) > 0:
+                        return [gif_data['images']['original']['url'] for gif_data in data['data']]
                     else:
-                        logger.error(f"❌ Błąd GIPHY API: {response.status}")
-                        
+                        logger.warning(f"⚠️ Brak wyników GIPHY dla zapytania '{query}'")
+                else:
+                    logger.error(f"❌ Błąd GIPHY API: {response.status}")
+                    
         except Exception as e:
             logger.error(f"❌ Błąd podczas pobierania GIF z GIPHY: {e}")
         
-        # Fallback do lokalnej bazy lub domyślnych GIF-ów
-        fallback_gifs = self.giphy_config.get('fallback_gifs', {})
-        if query in fallback_gifs:
-            return fallback_gifs[query]
-        
-        return self.get_random_gif(query)
+        return []
 
+    async def send_animation(self, message: Message, gif_url: str, **kwargs) -> Message:
+        """Wysyła GIF-a po zapamiętanym file_id (bez ponownego pobierania z GIPHY), a bez niego po URL"""
+        file_id = self.animation_ids.get(gif_url) if self.animation_ids.enabled else None
+        if file_id:
+            try:
+                sent = await message.reply_animation(animation=file_id, **kwargs)
+                self.animation_ids.reused += 1
+                self.activity.record('gifs')
+                return sent
+            except BadRequest as e:
+                # Nieważny/wygasły file_id - zapominamy go i wysyłamy po URL; inne błędy (np. Markdown) przekazujemy dalej
+                if 'file' not in str(e).lower():
+                    raise
+                logger.warning(f"⚠️ Nieważny file_id animacji, wysyłam po URL: {e}")
+                self.animation_ids.forget(gif_url)
+        
+        sent = await message.reply_animation(animation=gif_url, **kwargs)
+        self.activity.record('gifs')
+        animation = getattr(sent, 'animation', None)
+        if self.animation_ids.enabled and animation is not None:
+            self.animation_ids.uploaded += 1
+            if self.animation_ids.put(gif_url, animation.file_id):
+                self.animation_ids.saver.schedule()
+        return sent
+    
     def get_sticker_id(self, tag: str) -> str:
         """Zwraca file_id naklejki dla danego tagu - WYŁĄCZONE"""
         # Opcja naklejek wyłączona - powoduje błędy z Telegram API
@@ -561,7 +3231,7 @@ class SmartAIBot:
         
         # Wybierz emotki
         emotion_emoji_list = emotion_emojis.get(emotion, emotion_emojis["neutral"])
-        message_emoji_list = message_emojis.get(message_type, message_emojis["neutral"])
+        message_emoji_list = message_emojis.get(message_type, [])  # "neutral" nie ma własnej listy
         
         # Połącz listy i usuń duplikaty
         all_emojis = list(set(emotion_emoji_list + message_emoji_list))
@@ -579,6 +3249,7 @@ class SmartAIBot:
     
     async def get_error_message(self, error_type: str, context: Optional[dict] = None, user_id: Optional[int] = None) -> str:
         """Generuje komunikat błędu w stylu kumpla"""
+        self.activity.record('errors')
         # Sprawdź czy użytkownik jest członkiem kanału
         is_member = await self.is_channel_member(user_id) if user_id else False
         
@@ -678,24 +3349,41 @@ class SmartAIBot:
         """Sprawdza czy użytkownik jest członkiem kanału"""
         if not self.channel_id:
             return False
-            
-        # Sprawdź cache (ważny przez 10 minut)
-        if user_id in self.channel_members_cache:
-            cache_time, is_member = self.channel_members_cache[user_id]
-            if (datetime.now() - cache_time).seconds < 600:  # 10 minut
-                return is_member
         
+        # Cache (także wyniki negatywne i błędy) - odświeżany update'ami chat_member
+        is_member = self.channel_members.get(user_id)
+        if is_member is not None:
+            return is_member
+        
+        # Równoczesne sprawdzenia tego samego użytkownika dzielą jedno zapytanie do Telegrama
+        return await self.single_flight.do('membership', user_id, lambda: self.fetch_channel_membership(user_id))
+    
+    async def fetch_channel_membership(self, user_id: int) -> bool:
+        """Pobiera status członkostwa z Telegrama i zapisuje go do cache"""
         try:
-            # Sprawdź status członkostwa
             member = await self.application.bot.get_chat_member(self.channel_id, user_id)
-            is_member = member.status in ['member', 'administrator', 'creator']
-            
-            # Zapisz do cache
-            self.channel_members_cache[user_id] = (datetime.now(), is_member)
-            
-            return is_member
-        except:
+        except Exception as e:
+            logger.debug(f"Nie udało się sprawdzić członkostwa {user_id}: {e}")
+            self.channel_members.put_error(user_id)
             return False
+        is_member = is_member_status(member)
+        self.channel_members.put(user_id, is_member)
+        return is_member
+    
+    def is_tracked_channel(self, chat) -> bool:
+        """Czy czat to kanał z konfiguracji (channel_id jako ID albo @nazwa)"""
+        channel = str(self.channel_id)
+        return channel == str(chat.id) or (bool(chat.username) and channel.lstrip('@').lower() == chat.username.lower())
+    
+    async def handle_chat_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Zmiana członkostwa w kanale (wymaga bota jako administratora kanału) - aktualizuje cache"""
+        change = update.chat_member
+        if not change or not self.channel_id or not self.is_tracked_channel(change.chat):
+            return
+        member = change.new_chat_member
+        is_member = is_member_status(member)
+        self.channel_members.update(member.user.id, is_member)
+        logger.debug(f"Członkostwo {member.user.id} w kanale: {member.status}")
     
     def sanitize_markdown(self, text: str) -> str:
         """Usuwa nieprawidłowe znaki Markdown które psują formatowanie Telegram"""
@@ -721,6 +3409,13 @@ class SmartAIBot:
     
     def setup_handlers(self):
         """Konfiguracja handlerów"""
+        # Pomiar czasu całej obsługi update'u (start przed, koniec po wszystkich handlerach)
+        self.application.add_handler(TypeHandler(Update, self.begin_update_timing), group=-2)
+        self.application.add_handler(TypeHandler(Update, self.end_update_timing), group=99)
+        
+        # Limit komend - sprawdzany przed wszystkimi handlerami
+        self.application.add_handler(MessageHandler(filters.COMMAND, self.enforce_command_limit), group=-1)
+        
                 # Komendy
         self.application.add_handler(CommandHandler("start", self.cmd_start))
         self.application.add_handler(CommandHandler("help", self.cmd_help))
@@ -744,6 +3439,7 @@ class SmartAIBot:
         self.application.add_handler(CommandHandler("gif", self.cmd_gif))
         self.application.add_handler(CommandHandler("giphy", self.cmd_giphy))
         self.application.add_handler(CommandHandler("top_users", self.cmd_top_users))
+        self.application.add_handler(CommandHandler("latency", self.cmd_latency))
         
         # Komendy Render
         # Render management commands - REMOVED
@@ -751,101 +3447,123 @@ class SmartAIBot:
         # Przyciski
         self.application.add_handler(CallbackQueryHandler(self.button_callback))
         
+        # Zmiany członkostwa w kanale (cache członków)
+        self.application.add_handler(ChatMemberHandler(self.handle_chat_member, ChatMemberHandler.CHAT_MEMBER))
+        
         # Wszystkie wiadomości tekstowe
         self.application.add_handler(MessageHandler(
             filters.TEXT & ~filters.COMMAND, 
             self.handle_message
         ))
     
-    async def query_gemini(self, prompt: str, context: Optional[List[Dict[str, str]]] = None, user_id: Optional[int] = None, chat_id: Optional[int] = None) -> str:
-        """Zapytanie do Gemini AI"""
-        logger.info(f"🔍 Rozpoczynam zapytanie do Gemini AI")
-        logger.info(f"📝 Prompt: {prompt[:100]}...")
-        
-        # Sprawdź rate limiting dla użytkownika
-        if user_id:
-            current_time = datetime.now()
-            if user_id in self.last_ai_request:
-                time_diff = (current_time - self.last_ai_request[user_id]).total_seconds()
-                if time_diff < 60:  # W ciągu ostatniej minuty
-                    if user_id not in self.ai_request_count:
-                        self.ai_request_count[user_id] = 0
-                    self.ai_request_count[user_id] += 1
-                    
-                    if self.ai_request_count[user_id] > self.max_requests_per_minute:
-                        logger.warning(f"⚠️ Użytkownik {user_id} przekroczył limit zapytań")
-                        return "⚠️ Zbyt wiele zapytań! Poczekaj minutę i spróbuj ponownie. ⏰"
-                else:
-                    # Reset licznika po minucie
-                    self.ai_request_count[user_id] = 1
-            
-            self.last_ai_request[user_id] = current_time
-        
-        # Model z konfiguracji
-        model = self.gemini_config.get('model', 'gemini-1.5-flash-latest')
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={self.gemini_api_key}"
-        logger.info(f"🌐 URL API: {url[:50]}...")
-        
+    def check_ai_rate_limit(self, user_id: Optional[int], chat_id: Optional[int] = None) -> Optional[str]:
+        """Sprawdza limity zapytań AI - zwraca komunikat, jeśli limit przekroczony"""
+        return self.rate_limit_message('ai', user_id, chat_id)
+    
+    async def begin_update_timing(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Oznacza update etykietą komendy (dla histogramów) i zapamiętuje czas startu"""
+        if not self.latency.enabled:
+            return
+        command = 'message'
+        if update.callback_query:
+            command = 'button'
+        elif update.message and update.message.text and update.message.text.startswith('/'):
+            command = update.message.text.split()[0].split('@')[0]
+        current_command.set(command)
+        update_started.set(time.perf_counter())
+    
+    async def end_update_timing(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Zapisuje całkowity czas obsługi update'u"""
+        if self.latency.enabled and update_started.get():
+            self.latency.since('update_total', update_started.get())
+    
+    def rate_limit_message(self, kind: str, user_id: Optional[int], chat_id: Optional[int] = None) -> Optional[str]:
+        """Zużywa limit danego rodzaju - zwraca komunikat dla użytkownika, jeśli limit przekroczony"""
+        with self.latency.timer('rate_limit'):
+            rejected = self.rate_limiter.check(kind, user_id, chat_id)
+        if rejected is None:
+            return None
+        scope, wait = rejected
+        logger.warning(f"⚠️ Limit {kind} ({scope}) przekroczony - użytkownik {user_id}, czat {chat_id}")
+        who = {'user': "Zbyt wiele zapytań", 'chat': "Zbyt wiele zapytań w tym czacie", 'global': "Bot jest teraz mocno obciążony"}[scope]
+        return f"⚠️ {who}! Spróbuj ponownie za {max(1, round(wait))} s. ⏰"
+    
+    async def enforce_command_limit(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Limit komend (grupa -1, przed właściwymi handlerami) - nadmiarowe komendy są zatrzymywane"""
+        if not update.message or not update.effective_user:
+            return
+        limit_message = self.rate_limit_message('commands', update.effective_user.id, update.message.chat.id)
+        if limit_message:
+            await update.message.reply_text(limit_message)
+            raise ApplicationHandlerStop
+    
+    def create_model_backend(self, backend_config: dict) -> ModelBackend:
+        """Tworzy backend modelu wg sekcji 'model_backend' (type: gemini | fake)"""
+        backend_type = backend_config.get('type', 'gemini')
+        if backend_type == 'fake':
+            logger.warning("🧪 Używam atrapy modelu (model_backend.type = fake) - odpowiedzi nie pochodzą z AI!")
+            return FakeModelBackend(backend_config.get('fake', {}))
+        return GeminiRestBackend(backend_config, self.post_gemini, self.log_payload)
+    
+    def log_payload(self, message: str, payload):
+        """Zrzut dużego obiektu do logu - formatowany leniwie (w wątku logów) i próbkowany"""
+        if self.log_sampler.allow(message):
+            logger.error("%s: %.2000s", message, payload)
+    
+    def gemini_url(self, method: str = 'generateContent', model: Optional[str] = None) -> str:
+        """Buduje URL endpointu Gemini (domyślnie dla modelu z konfiguracji)"""
+        model = model or self.gemini_config.get('model', 'gemini-1.5-flash-latest')
+        url = f"{self.gemini_base_url}/models/{model}:{method}?key={self.gemini_api_key}"
+        if method == 'streamGenerateContent':
+            url += "&alt=sse"  # Server-Sent Events - jeden fragment odpowiedzi na linię
+        return url
+    
+    def gemini_generation_config(self) -> dict:
+        """Konfiguracja generowania z pliku konfiguracyjnego"""
+        return {
+            "temperature": self.gemini_config.get('temperature', 0.8),
+            "topK": self.gemini_config.get('top_k', 40),
+            "topP": self.gemini_config.get('top_p', 0.95),
+            "maxOutputTokens": self.gemini_config.get('max_output_tokens', 1024),
+        }
+    
+    async def build_gemini_payload(self, prompt: str, context: Optional[Iterable[Turn]] = None, user_id: Optional[int] = None, chat_id: Optional[int] = None, use_context_cache: bool = True) -> dict:
+        """Buduje payload zapytania do Gemini (osobowość, historia, konfiguracja generowania)"""
+        started = self.latency.clock()
         # Przygotuj historię rozmowy
         messages = []
         if context:
-            for msg in context[-5:]:  # Ostatnie 5 wiadomości dla kontekstu
-                # Konwertuj role do formatu Gemini API
-                role = "model" if msg["role"] == "assistant" else "user"
+            conversation = self.conversation_store.peek(user_id) if user_id else None
+            summary = conversation.summary if conversation is not None else None
+            if summary:
                 messages.append({
-                    "role": role,
-                    "parts": [{"text": msg["text"]}]
+                    "role": "user",
+                    "parts": [{"text": f"PODSUMOWANIE WCZEŚNIEJSZEJ ROZMOWY: {summary}"}]
                 })
+            # Historia jest już przycięta do budżetu, a role są w formacie Gemini API
+            messages.extend({"role": turn.role, "parts": [{"text": turn.text}]} for turn in context)
         
-        # Dodaj aktualną datę i czas (polska strefa czasowa)
-        warsaw_tz = pytz.timezone('Europe/Warsaw')
-        current_datetime = datetime.now(warsaw_tz)
-        formatted_date = current_datetime.strftime("%A, %d %B %Y, %H:%M")
-        
-        # Polskie nazwy dni i miesięcy
-        polish_days = {
-            'Monday': 'Poniedziałek', 'Tuesday': 'Wtorek', 'Wednesday': 'Środa',
-            'Thursday': 'Czwartek', 'Friday': 'Piątek', 'Saturday': 'Sobota', 'Sunday': 'Niedziela'
-        }
-        polish_months = {
-            'January': 'Styczeń', 'February': 'Luty', 'March': 'Marzec',
-            'April': 'Kwiecień', 'May': 'Maj', 'June': 'Czerwiec',
-            'July': 'Lipiec', 'August': 'Sierpień', 'September': 'Wrzesień',
-            'October': 'Październik', 'November': 'Listopad', 'December': 'Grudzień'
-        }
-        
-        # Zamień na polskie nazwy
-        for eng, pol in polish_days.items():
-            formatted_date = formatted_date.replace(eng, pol)
-        for eng, pol in polish_months.items():
-            formatted_date = formatted_date.replace(eng, pol)
-        
-        # Dodaj informacje o typie chatu do personality
-        personality_text = self.personality
-        personality_text += f"\n\nAKTUALNA DATA I CZAS: {formatted_date} (strefa czasowa: Europa/Warszawa)"
-        personality_text += f"\n\nWAŻNE: Zawsze używaj tej daty jako punktu odniesienia. Jeśli szukasz informacji w internecie, pamiętaj że dzisiaj jest {formatted_date}. Jesteśmy w roku {current_datetime.year}!"
-        
+        # Wybierz gotowy wariant osobowości dla typu rozmowy
+        variant = 'default'
         if chat_id:
             is_channel = await self.is_channel_member(user_id) if user_id else False
             is_group = chat_id < 0  # Grupy i kanały mają ujemne ID
             
             if is_channel:
-                personality_text += "\n\nKONTEKST ROZMOWY: Rozmawiasz z członkiem kanału. Możesz używać wulgaryzmów, ale NIE WYZYWAJ bezpośrednio rozmówcy."
+                variant = 'channel_member'
             elif is_group:
                 # Losuj czy może wyzywać rozmówcy (20% szans)
-                can_insult_user = random.random() < 0.2
-                if can_insult_user:
-                    personality_text += "\n\nKONTEKST ROZMOWY: Rozmawiasz w grupie VIP. Możesz używać wulgaryzmów i czasami wyzwać rozmówcy."
-                else:
-                    personality_text += "\n\nKONTEKST ROZMOWY: Rozmawiasz w grupie VIP. Możesz używać wulgaryzmów, ale NIE WYZYWAJ bezpośrednio rozmówcy."
+                variant = 'group_insult' if random.random() < 0.2 else 'group_no_insult'
             else:
-                personality_text += "\n\nKONTEKST ROZMOWY: Prywatna rozmowa. Możesz używać wulgaryzmów i być bezpośredni, w tym wyzywać rozmówcy."
+                variant = 'private'
         
-        # Dodaj osobowość bota na początku
-        system_message = {
-            "role": "user",
-            "parts": [{"text": personality_text}]
-        }
+        # Osobowość bota na początku (z aktualną datą, odświeżaną raz na minutę).
+        # Jeśli osobowość jest w cache kontekstu Gemini, wysyłamy tylko dopiski.
+        cached_content = self.context_cache.current_name(await self.get_http_session()) if use_context_cache else None
+        if cached_content:
+            system_message = self.prompt_builder.cached_system_message(variant)
+        else:
+            system_message = self.prompt_builder.system_message(variant)
         
         # Obecne zapytanie
         current_message = {
@@ -856,18 +3574,12 @@ class SmartAIBot:
         # Złóż wszystko razem
         contents = [system_message] + messages + [current_message] if messages else [system_message, current_message]
         
-        # Konfiguracja generowania z pliku konfiguracyjnego
-        generation_config = {
-            "temperature": self.gemini_config.get('temperature', 0.8),
-            "topK": self.gemini_config.get('top_k', 40),
-            "topP": self.gemini_config.get('top_p', 0.95),
-            "maxOutputTokens": self.gemini_config.get('max_output_tokens', 1024),
-        }
-        
         payload = {
             "contents": contents,
-            "generationConfig": generation_config,
+            "generationConfig": self.gemini_generation_config(),
         }
+        if cached_content:
+            payload["cachedContent"] = cached_content
         
         # Dodaj ustawienia bezpieczeństwa jeśli są w konfiguracji
         if self.safety_settings:
@@ -879,178 +3591,524 @@ class SmartAIBot:
                 for category, threshold in self.safety_settings.items()
             ]
         
-        logger.info(f"📦 Payload przygotowany: {len(contents)} wiadomości")
-        logger.info(f"🔧 Konfiguracja: temp={payload['generationConfig']['temperature']}, max_tokens={payload['generationConfig']['maxOutputTokens']}")
+        logger.debug("📦 Payload przygotowany: %d wiadomości, temp=%s, max_tokens=%s",
+                     len(contents), payload['generationConfig']['temperature'], payload['generationConfig']['maxOutputTokens'])
+        self.latency.since('prompt_build', started)
+        return payload
+    
+    def gemini_breaker(self, model: str) -> CircuitBreaker:
+        """Circuit breaker dla modelu (tworzony przy pierwszym użyciu)"""
+        if model not in self.gemini_breakers:
+            self.gemini_breakers[model] = CircuitBreaker(
+                self.gemini_resilience.get('breaker_failure_threshold', 5),
+                self.gemini_resilience.get('breaker_cooldown', 30)
+            )
+        return self.gemini_breakers[model]
+    
+    def gemini_backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Wykładniczy backoff z pełnym jitterem; Retry-After ma pierwszeństwo jako minimum"""
+        base = self.gemini_resilience.get('backoff_base', 0.5)
+        cap = self.gemini_resilience.get('backoff_max', 8.0)
+        delay = random.uniform(0, min(cap, base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+    
+    async def post_gemini(self, method: str, payload: dict, build_inline_payload) -> aiohttp.ClientResponse:
+        """POST do Gemini z ponowieniami, circuit breakerem i przełączeniem na model zapasowy
+        
+        Zwraca odpowiedź (także błędną - wywołujący mapuje status na komunikat).
+        Rzuca GeminiUnavailableError, gdy żaden model nie przyjmuje zapytań.
+        """
+        primary = self.gemini_config.get('model', 'gemini-1.5-flash-latest')
+        fallback = self.gemini_config.get('fallback_model')
+        models = [primary] + ([fallback] if fallback and fallback != primary else [])
+        max_retries = self.gemini_resilience.get('max_retries', 2)
+        max_retry_after = self.gemini_resilience.get('max_retry_after', 20)
+        last_error: Optional[Exception] = None
+        last_response: Optional[aiohttp.ClientResponse] = None
+        
+        for model in models:
+            breaker = self.gemini_breaker(model)
+            for attempt in range(max_retries + 1):
+                if not breaker.allow():
+                    if attempt == 0:
+                        self.gemini_client_stats['breaker_rejections'] += 1
+                        logger.warning(f"⚡ Circuit breaker otwarty dla {model} - pomijam")
+                    break
+                if model != primary and attempt == 0:
+                    # cachedContent jest związany z modelem głównym
+                    self.gemini_client_stats['fallbacks'] += 1
+                    logger.warning(f"🔀 Przełączam na model zapasowy {model}")
+                    if 'cachedContent' in payload:
+                        payload = await build_inline_payload()
+                
+                retry_after = None
+                try:
+                    started = time.monotonic()
+                    response = await self.send_gemini(method, model, payload, build_inline_payload)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    breaker.record_failure()
+                    last_error = e
+                    logger.warning(f"⚠️ Błąd połączenia z Gemini ({model}, próba {attempt + 1}): {type(e).__name__}: {e}")
+                except BaseException:
+                    # Anulowanie albo nieoczekiwany błąd - próba half_open nie może zablokować modelu na stałe
+                    breaker.release_trial()
+                    raise
+                else:
+                    if response.status not in GEMINI_RETRYABLE_STATUSES:
+                        # 4xx poza 429 to błąd zapytania, nie modelu - nie otwiera breakera
+                        breaker.record_success()
+                        if response.status == 200 and method == 'generateContent':
+                            self.gemini_latency.setdefault(model, LatencyWindow()).add(time.monotonic() - started)
+                        return response
+                    
+                    breaker.record_failure()
+                    retry_after = retry_after_header(response)
+                    logger.warning(f"⚠️ Gemini {model} zwrócił {response.status} (próba {attempt + 1}, Retry-After: {retry_after})")
+                    # Treść zostaje w pamięci (text() działa dalej), połączenie wraca do puli
+                    await response.read()
+                    last_response = response
+                    if retry_after is not None and retry_after > max_retry_after:
+                        break  # nie czekamy tak długo - od razu model zapasowy
+                
+                if attempt == max_retries or breaker.state != 'closed':
+                    break
+                self.gemini_client_stats['retries'] += 1
+                await asyncio.sleep(self.gemini_backoff(attempt, retry_after))
+        
+        # Wszystko zawiodło - wywołujący zmapuje ostatni status na komunikat
+        if last_response is not None:
+            return last_response
+        if last_error is not None:
+            raise last_error
+        raise GeminiUnavailableError("Wszystkie modele Gemini są chwilowo niedostępne")
+    
+    async def send_gemini(self, method: str, model: str, payload: dict, build_inline_payload) -> aiohttp.ClientResponse:
+        """Pojedynczy POST (z hedgingiem); odrzucony cachedContent ponawia w trybie inline"""
+        session = await self.get_http_session()
+        url = self.gemini_url(method, model)
+        # Dla strumienia mierzony jest czas do nagłówków (pierwszego bajtu), nie całego strumienia
+        with self.latency.timer('gemini_http'):
+            response = await self.hedged_post(session, url, payload, model) if method == 'generateContent' else \
+                await session.post(url, json=payload, timeout=GEMINI_TIMEOUT)
+        if 'cachedContent' in payload and response.status in (400, 403, 404):
+            error_text = await response.text()
+            response.release()
+            logger.warning(f"⚠️ Gemini odrzucił cache kontekstu ({response.status}): {error_text[:200]} - przechodzę na inline")
+            self.context_cache.invalidate()
+            response = await session.post(url, json=await build_inline_payload(), timeout=GEMINI_TIMEOUT)
+        return response
+    
+    async def hedged_post(self, session: aiohttp.ClientSession, url: str, payload: dict, model: str) -> aiohttp.ClientResponse:
+        """Jeśli odpowiedź nie przyszła w czasie p95, wysyła drugie zapytanie i bierze szybsze"""
+        first = asyncio.ensure_future(session.post(url, json=payload, timeout=GEMINI_TIMEOUT))
+        latency = self.gemini_latency.get(model)
+        hedge_after = latency.percentile(0.95) if latency and len(latency.samples) >= self.gemini_resilience.get('hedge_min_samples', 20) else None
+        if not self.gemini_resilience.get('hedge_enabled', False) or hedge_after is None:
+            return await first
+        
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait({first}, timeout=hedge_after)
+            if done:
+                return first.result()
+            
+            self.gemini_client_stats['hedged'] += 1
+            logger.info(f"🏁 Brak odpowiedzi po {hedge_after:.1f}s (p95) - wysyłam zapytanie równoległe")
+            second = asyncio.ensure_future(session.post(url, json=payload, timeout=GEMINI_TIMEOUT))
+            tasks.add(second)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if not task.exception()), None)
+                if winner is not None or not pending:
+                    abandon_posts(pending)
+                    if winner is None:
+                        return done.pop().result()  # oba zawiodły - rzuć wyjątek
+                    if winner is second:
+                        self.gemini_client_stats['hedge_wins'] += 1
+                    for task in done:
+                        if task is not winner and not task.exception():
+                            task.result().release()
+                    return winner.result()
+            return await first  # nieosiągalne
+        except asyncio.CancelledError:
+            # Wywołujący zrezygnował - zapytania w locie nie mogą trzymać połączeń z puli
+            abandon_posts(tasks)
+            raise
+    
+    def gemini_lane(self, user_id: Optional[int], chat_id: Optional[int], direct: bool = False) -> int:
+        """Pas priorytetu: właściciel/admini, bezpośrednie komendy i czaty prywatne, reszta grup"""
+        if user_id and (user_id == self.config.get('owner_id') or user_id in self.config.get('admin_ids', [])):
+            return LANE_ADMIN
+        if direct or chat_id is None or chat_id > 0:
+            return LANE_DIRECT
+        return LANE_AMBIENT
+    
+    async def query_gemini(self, prompt: str, context: Optional[Iterable[Turn]] = None, user_id: Optional[int] = None, chat_id: Optional[int] = None, cache_command: Optional[str] = None, direct: bool = False) -> str:
+        """Zapytanie do Gemini AI (cache_command włącza cache odpowiedzi dla danej komendy)"""
+        if self.log_ai_queries:
+            logger.info("🔍 Zapytanie do Gemini AI, prompt: %.100s...", prompt)
+        
+        # Powtarzalne komendy bez kontekstu rozmowy mogą być obsłużone z cache
+        cache_key = None
+        if cache_command and self.response_cache.enabled and not context:
+            cache_key = self.response_cache.make_key(
+                prompt, self.gemini_config.get('model', 'gemini-1.5-flash-latest'), self.gemini_generation_config()
+            )
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                logger.debug("⚡ Odpowiedź z cache dla komendy /%s", cache_command)
+                return cached_response
+        
+        # Sprawdź rate limiting dla użytkownika
+        limit_message = self.check_ai_rate_limit(user_id, chat_id)
+        if limit_message:
+            return limit_message
+        
+        lane = self.gemini_lane(user_id, chat_id, direct or bool(cache_command))
+        
+        async def scheduled_request() -> str:
+            async with self.gemini_scheduler.slot(chat_id or user_id or 0, lane):
+                return await self.request_gemini(prompt, context, user_id, chat_id, cache_key, cache_command)
+        
+        if cache_key:
+            # Ten sam cache'owalny prompt w locie - czekamy na jedno wspólne zapytanie
+            return await self.single_flight.do('gemini', cache_key, scheduled_request)
+        return await scheduled_request()
+    
+    async def request_gemini(self, prompt: str, context: Optional[Iterable[Turn]] = None, user_id: Optional[int] = None, chat_id: Optional[int] = None, cache_key: Optional[str] = None, cache_command: Optional[str] = None) -> str:
+        """Właściwe zapytanie do backendu modelu (bez cache i limitów)"""
+        logger.debug("🌐 Backend: %s, model: %s", self.model_backend.name, self.gemini_config.get('model', 'gemini-1.5-flash-latest'))
+        payload = await self.build_gemini_payload(prompt, context, user_id, chat_id)
         
         try:
-            logger.info(f"🚀 Wysyłam zapytanie do Gemini API...")
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload) as response:
-                    logger.info(f"📡 Status odpowiedzi: {response.status}")
-                    
-                    if response.status == 200:
-                        data = await response.json()
-                        logger.info(f"✅ Otrzymano odpowiedź z Gemini")
-                        logger.info(f"📊 Struktura odpowiedzi: {list(data.keys())}")
-                        
-                        if 'candidates' in data and data['candidates']:
-                            candidate = data['candidates'][0]
-                            logger.info(f"🔍 Struktura candidate: {list(candidate.keys())}")
-                            
-                            # Bezpieczne parsowanie odpowiedzi
-                            try:
-                                finish_reason = candidate.get('finishReason', '')
-                                
-                                if 'content' in candidate and 'parts' in candidate['content']:
-                                    response_text = candidate['content']['parts'][0]['text']
-                                    logger.info(f"💬 Odpowiedź Gemini: {response_text[:100]}...")
-                                    self.stats['ai_queries'] += 1
-                                    # Aktualizuj aktywność użytkownika
-                                    if user_id:
-                                        self.update_user_activity(user_id, 'ai_query')
-                                    return response_text
-                                elif 'content' in candidate and 'role' in candidate['content']:
-                                    # Przypadek gdy finishReason = MAX_TOKENS i brak 'parts'
-                                    if finish_reason == 'MAX_TOKENS':
-                                        logger.warning(f"⚠️ Odpowiedź przerwana (MAX_TOKENS)")
-                                        return await self.get_error_message("max_tokens")
-                                    else:
-                                        logger.error(f"❌ Brak 'parts' w content: {candidate}")
-                                        return await self.get_error_message("no_parts")
-                                elif 'text' in candidate:
-                                    # Alternatywny format odpowiedzi
-                                    response_text = candidate['text']
-                                    logger.info(f"💬 Odpowiedź Gemini (alt format): {response_text[:100]}...")
-                                    self.stats['ai_queries'] += 1
-                                    return response_text
-                                else:
-                                    logger.error(f"❌ Nieoczekiwana struktura candidate: {candidate}")
-                                    return self.get_error_message("unexpected_structure")
-                            except (KeyError, IndexError) as e:
-                                logger.error(f"❌ Błąd parsowania odpowiedzi Gemini: {e}")
-                                logger.error(f"🔍 Pełna odpowiedź: {data}")
-                                return self.get_error_message("parsing_error")
-                        else:
-                            logger.error(f"❌ Brak 'candidates' w odpowiedzi: {data}")
-                            return self.get_error_message("no_candidates")
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"❌ Gemini API error: {response.status} - {error_text}")
-                        
-                        if response.status == 429:
-                            return self.get_error_message("rate_limit")
-                        elif response.status == 403:
-                            return self.get_error_message("access_denied")
-                        elif response.status == 400:
-                            return self.get_error_message("bad_request")
-                        else:
-                            return self.get_error_message("general_error", {"status": response.status})
+            result = await self.model_backend.generate(
+                payload, lambda: self.build_gemini_payload(prompt, context, user_id, chat_id, use_context_cache=False)
+            )
         except Exception as e:
             logger.error(f"❌ Error querying Gemini: {e}")
             logger.error(f"🔍 Szczegóły błędu: {type(e).__name__}: {str(e)}")
-            return self.get_error_message("exception", {"error": str(e)})
+            return await self.get_error_message("exception", {"error": str(e)}, user_id)
+        
+        if result.error:
+            if result.status != 200:
+                logger.error("❌ Gemini API error: %s - %.500s", result.status, result.error_text)
+            return await self.get_error_message(result.error, {"status": result.status}, user_id)
+        
+        response_text = cast(str, result.text)
+        if self.log_ai_queries:
+            logger.info("💬 Odpowiedź Gemini: %.100s...", response_text)
+        self.activity.record('ai_queries')
+        if cache_key:
+            self.response_cache.put(cache_key, response_text, self.response_cache.ttl_for(cache_command))
+        # Aktualizuj aktywność użytkownika
+        if user_id:
+            self.update_user_activity(user_id, 'ai_query')
+        return response_text
+    
+    async def query_gemini_stream(self, prompt: str, context: Optional[Iterable[Turn]] = None, user_id: Optional[int] = None, chat_id: Optional[int] = None, direct: bool = False) -> AsyncIterator[str]:
+        """Strumieniowe zapytanie do Gemini - zwraca kolejne fragmenty odpowiedzi"""
+        if self.log_ai_queries:
+            logger.info("🔍 Strumieniowe zapytanie do Gemini AI, prompt: %.100s...", prompt)
+        
+        limit_message = self.check_ai_rate_limit(user_id, chat_id)
+        if limit_message:
+            yield limit_message
+            return
+        
+        payload = await self.build_gemini_payload(prompt, context, user_id, chat_id)
+        lane = self.gemini_lane(user_id, chat_id, direct)
+        chunks: asyncio.Queue = asyncio.Queue()  # fragmenty, wyjątek strumienia, na końcu None
+        
+        async def read_model_stream():
+            """Czyta strumień modelu w slocie harmonogramu - slot zwalniany jest, gdy model skończy,
+            niezależnie od tego, jak długo odbiorca edytuje wiadomość w Telegramie"""
+            try:
+                async with self.gemini_scheduler.slot(chat_id or user_id or 0, lane):
+                    async for text in self.model_backend.stream(
+                        payload, lambda: self.build_gemini_payload(prompt, context, user_id, chat_id, use_context_cache=False)
+                    ):
+                        chunks.put_nowait(text)
+            except Exception as e:
+                chunks.put_nowait(e)
+            finally:
+                chunks.put_nowait(None)
+        
+        reader = asyncio.create_task(read_model_stream())
+        received_text = False
+        try:
+            while (item := await chunks.get()) is not None:
+                if isinstance(item, ModelBackendError):
+                    logger.error("❌ Gemini API error (stream): %s - %.500s", item.status, item.error_text)
+                    if not received_text:
+                        yield await self.get_error_message(item.error, {"status": item.status}, user_id)
+                    return
+                if isinstance(item, Exception):
+                    logger.error(f"❌ Error streaming from Gemini: {type(item).__name__}: {item}")
+                    if not received_text:
+                        yield await self.get_error_message("exception", {"error": str(item)}, user_id)
+                    return
+                received_text = True
+                yield item
+        finally:
+            # Odbiorca przerwał (błąd Telegrama, anulowanie) - nie czytamy dalej i oddajemy slot
+            if not reader.done():
+                reader.cancel()
+        
+        if received_text:
+            self.activity.record('ai_queries')
+            if user_id:
+                self.update_user_activity(user_id, 'ai_query')
+        else:
+            logger.error(f"❌ Strumień Gemini zakończony bez tekstu")
+            yield await self.get_error_message("no_candidates", user_id=user_id)
+    
+    async def stream_ai_reply(self, update: Update, prompt: str, user_id: int, chat_id: int, direct: bool = False) -> tuple[str, Optional[Message]]:
+        """Wysyła placeholder i edytuje go kolejnymi fragmentami odpowiedzi (z limitem edycji Telegrama)"""
+        placeholder = None
+        try:
+            placeholder = await update.message.reply_text(self.streaming_config.get('placeholder', '✍️ ...'))
+        except Exception as e:
+            logger.warning(f"⚠️ Nie udało się wysłać placeholdera: {e}")
+        
+        # Telegram pozwala na ~1 edycję/s w prywatnym czacie i ~20 wiadomości/min w grupie
+        is_group = chat_id < 0
+        interval = self.streaming_config.get('edit_interval_group', 3.0) if is_group else self.streaming_config.get('edit_interval_private', 1.0)
+        min_chars = self.streaming_config.get('min_chars_per_edit', 30)
+        
+        loop = asyncio.get_running_loop()
+        next_edit_at = loop.time() + interval
+        shown_length = 0
+        parts = []
+        
+        conversation = await self.conversation_store.get(user_id)
+        stream = self.query_gemini_stream(prompt, conversation.turns, user_id, chat_id, direct)
+        try:
+            async for chunk in stream:
+                parts.append(chunk)
+                now = loop.time()
+                if placeholder is None or now < next_edit_at:
+                    continue
+                
+                # Podgląd to surowy tekst - tagi GIF i formatowanie dopiero w ostatniej edycji
+                preview = ''.join(parts).split('[GIF_TAG', 1)[0].strip()
+                if len(preview) - shown_length < min_chars:
+                    continue
+                
+                next_edit_at = now + interval
+                try:
+                    await placeholder.edit_text(preview[:4000] + " ▌")
+                    shown_length = len(preview)
+                except RetryAfter as e:
+                    retry_after = retry_after_seconds(e)
+                    next_edit_at = now + max(retry_after, interval)
+                    logger.warning(f"⚠️ Limit edycji Telegrama - czekam {retry_after}s")
+                except TelegramError as e:
+                    # Podgląd jest opcjonalny - błąd sieci czy Markdown nie przerywa odpowiedzi
+                    logger.debug(f"Edycja podglądu pominięta: {e}")
+        finally:
+            await stream.aclose()
+        
+        return ''.join(parts), placeholder
+    
+    async def finish_streamed_reply(self, update: Update, message: Message, text: str, media_type: str, media_tag: str, user_id: int):
+        """Ostatnia edycja strumieniowanej odpowiedzi - pełny Markdown + ewentualny GIF"""
+        max_attempts = self.streaming_config.get('final_edit_max_attempts', 5)
+        max_wait = self.streaming_config.get('final_edit_max_wait', 30.0)
+        parse_mode = ParseMode.MARKDOWN
+        waited = 0.0
+        for attempt in range(1, max_attempts + 1):
+            try:
+                await message.edit_text(text[:4096], parse_mode=parse_mode)
+                break
+            except RetryAfter as e:
+                # Ostatnia edycja jest obowiązkowa (inaczej zostaje podgląd z "▌") - czekamy, ale nie w nieskończoność
+                retry_after = retry_after_seconds(e)
+                if attempt == max_attempts or waited + retry_after > max_wait:
+                    logger.warning(f"⚠️ Porzucam ostatnią edycję odpowiedzi po {attempt} próbach (limit Telegrama: {retry_after}s, czekano {waited:.0f}s)")
+                    break
+                waited += retry_after
+                await asyncio.sleep(retry_after)
+            except BadRequest as e:
+                if parse_mode is None:
+                    break  # np. "message is not modified"
+                # Jeśli Markdown nie działa, zostaw treść jako plain text
+                logger.warning(f"⚠️ Błąd Markdown w ostatniej edycji, wysyłam jako plain text: {e}")
+                parse_mode = None
+        
+        # GIF nie może zastąpić edytowanej wiadomości tekstowej - wysyłamy go osobno
+        if media_type == 'gif' and media_tag:
+            if self.rate_limiter.exhausted('giphy', user_id=user_id):
+                logger.info(f"⚠️ Użytkownik {user_id} wysyła za dużo GIF-ów, pomijam GIF")
+                return
+            gif_url = await self.get_giphy_gif(media_tag, user_id)
+            if gif_url and update.message:
+                try:
+                    await self.send_animation(update.message, gif_url)
+                    await asyncio.sleep(0.3)
+                except Exception as e:
+                    logger.error(f"Błąd wysyłania GIF: {e}")
     
     # === FUNKCJE INTERNETOWE ===
     
 
     
-    async def get_weather(self, city: str) -> str:
+    async def get_weather(self, city: str, user_id: Optional[int] = None, chat_id: Optional[int] = None) -> str:
         """Pobieranie pogody z AccuWeather"""
         if not self.accuweather_api_key:
             return "❌ Brak klucza API dla pogody. Dodaj 'accuweather_api_key' do konfiguracji."
         
+        # Znane miasto z niedawno pobranymi warunkami - odpowiedź z pamięci, bez limitu i AccuWeather
+        cached = self.weather_locations.get(city)
+        found, location = cached
+        if found and location is None:
+            return f"❌ Nie znaleziono miasta: {city}"
+        if location:
+            text, needs_refresh = self.weather_conditions.get(location[0])
+            if text is not None:
+                if needs_refresh:
+                    self.schedule_weather_refresh(location)
+                return text
+        
+        limit_message = self.rate_limit_message('weather', user_id, chat_id)
+        if limit_message:
+            return limit_message
+        
+        return await self.fetch_weather(city, cached)
+    
+    async def resolve_weather_location(self, city: str, cached: Optional[tuple] = None) -> list:
+        """[location key, miasto, kraj] - z cache, a przy jego braku z wyszukiwarki AccuWeather
+        (cached - wynik weather_locations.get(city), jeśli wywołujący już go ma; każdy odczyt to jeden hit/miss)"""
+        found, location = cached if cached is not None else self.weather_locations.get(city)
+        if not found:
+            location = await self.single_flight.do('weather_location', place_key(city),
+                                                   lambda: self.search_weather_location(city))
+        if location is None:
+            raise WeatherError(f"❌ Nie znaleziono miasta: {city}")
+        return location
+    
+    async def search_weather_location(self, city: str) -> Optional[list]:
+        """Szuka miasta w AccuWeather i zapamiętuje wynik (także pusty) w cache lokalizacji"""
+        search_params = {
+            'apikey': self.accuweather_api_key,
+            'q': city,
+            'language': 'pl-pl'
+        }
+        session = await self.get_http_session()
+        async with session.get(f"{self.weather_api_url}/locations/v1/cities/search", params=search_params) as response:
+            if response.status != 200:
+                raise WeatherError(f"❌ Błąd wyszukiwania miasta: {response.status}")
+            locations = await response.json()
+        
+        # Weź pierwsze miasto z wyników
+        location = None
+        if locations:
+            location = [locations[0]['Key'], locations[0]['LocalizedName'], locations[0]['Country']['LocalizedName']]
+            self.weather_locations.put(location[1], location)  # także pod nazwą z AccuWeather ("Warszawa")
+        self.weather_locations.put(city, location)
+        self.weather_locations.saver.schedule()
+        return location
+    
+    async def preload_weather_locations(self):
+        """Rozwiązuje w tle lokalizacje najpopularniejszych miast, których jeszcze nie ma w cache"""
+        missing = [(city, cached) for city in self.weather_locations.preload if not (cached := self.weather_locations.get(city))[0]]
+        for city, cached in missing:
+            try:
+                await self.resolve_weather_location(city, cached)
+            except Exception as e:
+                logger.warning(f"⚠️ Nie udało się wczytać lokalizacji '{city}': {e}")
+        if missing:
+            logger.info(f"🌍 Wczytano lokalizacje pogodowe dla {len(missing)} miast")
+    
+    async def fetch_weather(self, city: str, cached: Optional[tuple] = None) -> str:
+        """Pobiera aktualne warunki z AccuWeather (location key z cache lokalizacji; cached - wynik jego odczytu)"""
         try:
-            # AccuWeather wymaga najpierw znalezienia location key
-            search_url = "http://dataservice.accuweather.com/locations/v1/cities/search"
-            search_params = {
-                'apikey': self.accuweather_api_key,
-                'q': city,
-                'language': 'pl-pl'
-            }
-            
-            async with aiohttp.ClientSession() as session:
-                # Najpierw znajdź location key
-                async with session.get(search_url, params=search_params) as search_response:
-                    if search_response.status == 200:
-                        locations = await search_response.json()
-                        
-                        if not locations:
-                            return f"❌ Nie znaleziono miasta: {city}"
-                        
-                        # Weź pierwsze miasto z wyników
-                        location_key = locations[0]['Key']
-                        city_name = locations[0]['LocalizedName']
-                        country = locations[0]['Country']['LocalizedName']
-                        
-                        # Teraz pobierz pogodę
-                        weather_url = f"http://dataservice.accuweather.com/currentconditions/v1/{location_key}"
-                        weather_params = {
-                            'apikey': self.accuweather_api_key,
-                            'language': 'pl-pl',
-                            'details': 'true'
-                        }
-                        
-                        async with session.get(weather_url, params=weather_params) as weather_response:
-                            if weather_response.status == 200:
-                                weather_data = await weather_response.json()
+            location = await self.resolve_weather_location(city, cached)
+            return await self.refresh_weather(location)
+        except WeatherError as e:
+            return str(e)
+        except Exception as e:
+            logger.error(f"Error getting weather: {e}")
+            return f"❌ Błąd podczas pobierania pogody: {str(e)}"
+    
+    async def refresh_weather(self, location: list) -> str:
+        """Pobiera warunki dla lokalizacji i zapisuje gotową odpowiedź w cache
+        (równoczesne pytania o to samo miejsce dzielą jedno zapytanie do AccuWeather)"""
+        text = await self.single_flight.do('weather', location[0], lambda: self.fetch_current_conditions(location))
+        self.weather_conditions.put(location[0], text)
+        return text
+    
+    def schedule_weather_refresh(self, location: list):
+        """Odświeża starzejące się warunki w tle - odpowiedź nie czeka na AccuWeather"""
+        location_key = location[0]
+        task = self.weather_conditions.refreshing.get(location_key)
+        if task is not None and not task.done():
+            return
+        if self.rate_limiter.check('weather'):
+            return  # globalny limit wyczerpany - odświeżymy przy kolejnym pytaniu
+        
+        async def refresh():
+            try:
+                await self.refresh_weather(location)
+            except Exception as e:
+                logger.warning(f"⚠️ Nie udało się odświeżyć pogody dla {location[1]}: {e}")
+            finally:
+                self.weather_conditions.refreshing.pop(location_key, None)
+        
+        self.weather_conditions.refreshing[location_key] = asyncio.create_task(refresh())
+    
+    async def fetch_current_conditions(self, location: list) -> str:
+        """Aktualne warunki z AccuWeather jako gotowa odpowiedź (WeatherError przy błędzie API)"""
+        location_key, city_name, country = location
+        weather_params = {
+            'apikey': self.accuweather_api_key,
+            'language': 'pl-pl',
+            'details': 'true'
+        }
+        
+        session = await self.get_http_session()
+        async with session.get(f"{self.weather_api_url}/currentconditions/v1/{location_key}", params=weather_params) as weather_response:
+            if weather_response.status != 200:
+                raise WeatherError(f"❌ Błąd API pogody: {weather_response.status}")
+            weather_data = await weather_response.json()
+        
+        if not weather_data:
+            raise WeatherError(f"❌ Brak danych pogodowych dla: {city_name}")
+        current = weather_data[0]
+        
+        temp = current['Temperature']['Metric']['Value']
+        feels_like = current['RealFeelTemperature']['Metric']['Value']
+        humidity = current['RelativeHumidity']
+        description = current['WeatherText']
+        wind_speed = current['Wind']['Speed']['Metric']['Value']
+        wind_direction = current['Wind']['Direction']['Localized']
+        
+        # Emoji dla pogody
+        weather_emoji = "🌤️"
+        if "deszcz" in description.lower():
+            weather_emoji = "🌧️"
+        elif "śnieg" in description.lower():
+            weather_emoji = "❄️"
+        elif "burza" in description.lower():
+            weather_emoji = "⛈️"
+        elif "mgła" in description.lower():
+            weather_emoji = "🌫️"
+        elif "słonecznie" in description.lower() or "bezchmurnie" in description.lower():
+            weather_emoji = "☀️"
+        
+        return f"""{weather_emoji} **Pogoda w {city_name}, {country}**
                                 
-                                if weather_data:
-                                    current = weather_data[0]
-                                    
-                                    temp = current['Temperature']['Metric']['Value']
-                                    feels_like = current['RealFeelTemperature']['Metric']['Value']
-                                    humidity = current['RelativeHumidity']
-                                    description = current['WeatherText']
-                                    wind_speed = current['Wind']['Speed']['Metric']['Value']
-                                    wind_direction = current['Wind']['Direction']['Localized']
-                                    
-                                    # Emoji dla pogody
-                                    weather_emoji = "🌤️"
-                                    if "deszcz" in description.lower():
-                                        weather_emoji = "🌧️"
-                                    elif "śnieg" in description.lower():
-                                        weather_emoji = "❄️"
-                                    elif "burza" in description.lower():
-                                        weather_emoji = "⛈️"
-                                    elif "mgła" in description.lower():
-                                        weather_emoji = "🌫️"
-                                    elif "słonecznie" in description.lower() or "bezchmurnie" in description.lower():
-                                        weather_emoji = "☀️"
-                                    
-                                    return f"""{weather_emoji} **Pogoda w {city_name}, {country}**
-                                    
 🌡️ Temperatura: {temp}°C (odczuwalna: {feels_like}°C)
 💨 Wiatr: {wind_speed} km/h ({wind_direction})
 💧 Wilgotność: {humidity}%
 ☁️ Opis: {description}
 ⏰ Aktualizacja: {datetime.now().strftime('%H:%M')}"""
-                                else:
-                                    return f"❌ Brak danych pogodowych dla: {city}"
-                            else:
-                                return f"❌ Błąd API pogody: {weather_response.status}"
-                    else:
-                        return f"❌ Błąd wyszukiwania miasta: {search_response.status}"
-                        
-        except Exception as e:
-            logger.error(f"Error getting weather: {e}")
-            return f"❌ Błąd podczas pobierania pogody: {str(e)}"
     
     def detect_weather_query(self, text: str) -> Optional[str]:
-        """Wykrywa pytania o pogodę"""
-        weather_patterns = [
-            r'pogoda\s+(?:w\s+)?([a-zA-ZąćęłńóśźżĄĆĘŁŃÓŚŹŻ\s]+)',
-            r'jaka\s+(?:jest\s+)?pogoda\s+(?:w\s+)?([a-zA-ZąćęłńóśźżĄĆĘŁŃÓŚŹŻ\s]+)',
-            r'temperatura\s+(?:w\s+)?([a-zA-ZąćęłńóśźżĄĆĘŁŃÓŚŹŻ\s]+)',
-            r'([a-zA-ZąćęłńóśźżĄĆĘŁŃÓŚŹŻ\s]+)\s+pogoda'
-        ]
-        
-        for pattern in weather_patterns:
-            match = re.search(pattern, text.lower())
-            if match:
-                city = match.group(1).strip()
-                if len(city) > 2:  # Minimum 3 znaki
-                    return city
-        return None
+        """Wykrywa pytania o pogodę w znanym mieście (słownik miast i miasta już znalezione w AccuWeather)"""
+        return self.weather_detector.detect(text, self.weather_locations.known)
     
     # === FUNKCJE RSS ===
     
@@ -1085,41 +4143,44 @@ class SmartAIBot:
         """Pobierz nowe artykuły z kanału RSS"""
         try:
             # Pobierz RSS feed
-            async with aiohttp.ClientSession() as session:
-                async with session.get(feed_url) as response:
-                    if response.status == 200:
-                        content = await response.text()
-                        
-                        # Parsuj RSS
-                        feed = feedparser.parse(content)
-                        new_articles = []
+            session = await self.get_http_session()
+            async with session.get(
+                feed_url,
+                headers={'Accept': 'application/rss+xml, application/xml, text/xml, */*'}
+            ) as response:
+                if response.status == 200:
+                    content = await response.text()
+                    
+                    # Parsuj RSS
+                    feed = feedparser.parse(content)
+                    new_articles = []
+                    
+                    for entry in feed.entries[:5]:  # Sprawdź 5 najnowszych
+                        # Generuj unikalny ID artykułu
+                        article_id = f"{feed_name}_{entry.get('id', entry.get('link', ''))}"
                         
-                        for entry in feed.entries[:5]:  # Sprawdź 5 najnowszych
-                            # Generuj unikalny ID artykułu
-                            article_id = f"{feed_name}_{entry.get('id', entry.get('link', ''))}"
+                        # Sprawdź czy to nowy artykuł
+                        if article_id not in self.last_articles.get(feed_name, set()):
+                            article = {
+                                'id': article_id,
+                                'title': entry.get('title', 'Brak tytułu'),
+                                'link': entry.get('link', ''),
+                                'summary': entry.get('summary', 'Brak opisu'),
+                                'published': entry.get('published', ''),
+                                'feed_name': feed_name
+                            }
+                            new_articles.append(article)
                             
-                            # Sprawdź czy to nowy artykuł
-                            if article_id not in self.last_articles.get(feed_name, set()):
-                                article = {
-                                    'id': article_id,
-                                    'title': entry.get('title', 'Brak tytułu'),
-                                    'link': entry.get('link', ''),
-                                    'summary': entry.get('summary', 'Brak opisu'),
-                                    'published': entry.get('published', ''),
-                                    'feed_name': feed_name
-                                }
-                                new_articles.append(article)
-                                
-                                # Dodaj do ostatnich artykułów
-                                if feed_name not in self.last_articles:
-                                    self.last_articles[feed_name] = set()
-                                self.last_articles[feed_name].add(article_id)
-                        
-                        return new_articles
-                    else:
-                        logger.error(f"Błąd pobierania RSS {feed_name}: {response.status}")
-                        return []
-                        
+                            # Dodaj do ostatnich artykułów
+                            if feed_name not in self.last_articles:
+                                self.last_articles[feed_name] = set()
+                            self.last_articles[feed_name].add(article_id)
+                    
+                    return new_articles
+                else:
+                    logger.error(f"Błąd pobierania RSS {feed_name}: {response.status}")
+                    return []
+                    
         except Exception as e:
             logger.error(f"Błąd parsowania RSS {feed_name}: {e}")
             return []
@@ -1258,7 +4319,8 @@ class SmartAIBot:
 • /stats - Moje statystyki wydajności 📊
 • /about - Kim jestem? 🤖
 • /gif [tag] - Test GIF-ów 🎬
-• /top_users - Top 10 aktywnych użytkowników 👥
+• /top_users [dziś|tydzień] [ai] - Top 10 aktywnych użytkowników 👥
+• /latency - Opóźnienia etapów obsługi ⏱️
 
 *🚀 PRZYKŁADY AKCJI:*
 • "Jak ugotować idealne jajka?"
@@ -1303,7 +4365,7 @@ class SmartAIBot:
             return
         
         question = ' '.join(context.args)
-        await self.process_ai_message(update, question)
+        await self.process_ai_message(update, question, direct=True)
     
     async def cmd_web_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Wyszukiwanie w internecie"""
@@ -1328,16 +4390,15 @@ class SmartAIBot:
             return
         
         query = ' '.join(context.args)
-        self.stats['web_queries'] += 1
+        self.activity.record('web_queries')
         
         # Pokaż że bot "pisze"
         await update.message.chat.send_action(ChatAction.TYPING)
         
         # Wyszukaj w internecie - NAPRAWIONE przez przekazanie do AI z web search
         try:
-            # Dodaj aktualną datę do kontekstu (polska strefa czasowa)
-            warsaw_tz = pytz.timezone('Europe/Warsaw')
-            current_datetime = datetime.now(warsaw_tz)
+            # Dodaj aktualną datę do kontekstu (polska strefa czasowa, cache minutowy)
+            current_datetime = self.prompt_builder.now()
             current_date = current_datetime.strftime("%d.%m.%Y")
             current_year = current_datetime.year
             
@@ -1345,7 +4406,7 @@ class SmartAIBot:
             enhanced_query = f"Wyszukaj w internecie i znajdź aktualne informacje na temat: {query}. WAŻNE: Dzisiaj jest {current_date}. Szukaj najnowszych informacji z roku {current_year}, nie starszych niż kilka miesięcy."
             
             # Użyj AI z web search capability
-            result = await self.query_gemini(enhanced_query)
+            result = await self.query_gemini(enhanced_query, cache_command='web')
             
             if result and not result.startswith("❌"):
                 await update.message.reply_text(result[:4000], parse_mode=ParseMode.MARKDOWN)
@@ -1383,13 +4444,13 @@ class SmartAIBot:
             )
         else:
             city = ' '.join(context.args)
-        self.stats['web_queries'] += 1
+        self.activity.record('web_queries')
         
         # Pokaż że bot "pisze"
         await update.message.chat.send_action(ChatAction.TYPING)
         
         # Pobierz pogodę
-        result = await self.get_weather(city)
+        result = await self.get_weather(city, update.effective_user.id if update.effective_user else None, update.message.chat.id)
         await update.message.reply_text(result, parse_mode=ParseMode.MARKDOWN)
     
     async def cmd_news(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1571,8 +4632,7 @@ class SmartAIBot:
             return
         user_id = update.effective_user.id
         
-        if user_id in self.conversation_cache:
-            self.conversation_cache[user_id] = []
+        self.clear_conversation(user_id)
         
         await update.message.reply_text(
             "🧹 **Kontekst wyczyszczony!**\n\n"
@@ -1595,27 +4655,25 @@ class SmartAIBot:
 
 🔥 **WYDAJNOŚĆ:**
 • ⏱️ Działa od: {hours}h {minutes}m
-• 💬 Wiadomości: {self.stats['messages_processed']}
-• 🧠 Zapytania AI: {self.stats['ai_queries']}
-• 🌐 Wyszukiwania: {self.stats['web_queries']}
-• 👥 Aktywne rozmowy: {len(self.conversation_cache)}
+{self.format_activity_stats()}
+{self.format_conversation_store_stats()}
+{self.format_user_profile_stats()}
 • 📰 Subskrybenci RSS: {len(self.rss_subscribers)}
+{self.format_http_pool_stats()}
+{self.format_response_cache_stats()}
+{self.format_single_flight_stats()}
+{self.format_model_backend_stats()}
+{self.format_gemini_client_stats()}
+{self.format_gemini_scheduler_stats()}
+{self.format_rate_limiter_stats()}
 
 👥 **TOP 10 NAJAKTYWNIEJSZYCH UŻYTKOWNIKÓW:**
 """
         
         if top_users:
+            names = await self.user_profiles.resolve(context.bot, [user_id for user_id, _ in top_users])
             for i, (user_id, data) in enumerate(top_users, 1):
-                try:
-                    # Pobierz informacje o użytkowniku
-                    user_info = await context.bot.get_chat(user_id)
-                    username = user_info.username or user_info.first_name or f"Użytkownik {user_id}"
-                    messages = data['messages']
-                    ai_queries = data['ai_queries']
-                    
-                    stats_text += f"{i}. **{username}** - {messages} wiadomości, {ai_queries} AI\n"
-                except:
-                    stats_text += f"{i}. **Użytkownik {user_id}** - {data['messages']} wiadomości, {data['ai_queries']} AI\n"
+                stats_text += f"{i}. **{names[user_id]}** - {data['messages']} wiadomości, {data['ai_queries']} AI\n"
         else:
             stats_text += "Brak danych o aktywności użytkowników\n"
         
@@ -1746,7 +4804,7 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
         
         # Jeśli nie ma w słowniku, użyj AI
         prompt = f"Oceń {text} w stylu Cursor Cwaniak - luzackiego programisty. Bądź kontrowersyjny, użyj humoru i wulgaryzmów, ale nie obrażaj. Maksymalnie 2-3 zdania."
-        response = await self.query_gemini(prompt, user_id=update.effective_user.id)
+        response = await self.query_gemini(prompt, user_id=update.effective_user.id, cache_command='ocen')
         await update.message.reply_text(f"🔥 *Ocena {text}:*\n\n{response}")
 
     async def cmd_pomoz(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1760,7 +4818,7 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
             return
         
         prompt = f"Pomóż z tym problemem programistycznym: {text}. Odpowiedz w stylu Cursor Cwaniak - luzackiego programisty. Bądź pomocny, ale z humorem. Użyj wulgaryzmów dla podkreślenia, ale nie nadużywaj. Maksymalnie 3-4 zdania."
-        response = await self.query_gemini(prompt, user_id=update.effective_user.id)
+        response = await self.query_gemini(prompt, user_id=update.effective_user.id, cache_command='pomoz')
         await update.message.reply_text(f"💻 *Pomoc z kodem:*\n\n{response}")
 
     async def cmd_cursor(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1811,8 +4869,8 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
         gif_url = await self.get_giphy_gif(tag, user_id)
         
         if gif_url:
-            await update.message.reply_animation(
-                animation=gif_url,
+            await self.send_animation(
+                update.message, gif_url,
                 caption=f"🎬 GIF z GIPHY dla tagu: **{tag}**\n\nFajny GIF, co nie? 😎"
             )
         else:
@@ -1820,8 +4878,8 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
             if tag in self.gifs_database:
                 fallback_gif = self.get_random_gif(tag)
                 if fallback_gif:
-                    await update.message.reply_animation(
-                        animation=fallback_gif,
+                    await self.send_animation(
+                        update.message, fallback_gif,
                         caption=f"🎬 GIF (fallback) dla tagu: **{tag}**\n\nGIPHY nie działa, ale mam backup! 😅"
                     )
                 else:
@@ -1864,8 +4922,8 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
         gif_url = await self.get_giphy_gif(query, user_id)
         
         if gif_url:
-            await update.message.reply_animation(
-                animation=gif_url,
+            await self.send_animation(
+                update.message, gif_url,
                 caption=f"🎬 GIF dla: **{query}**\n\nZnaleziony w GIPHY! 🔥"
             )
         else:
@@ -1875,13 +4933,42 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
                 parse_mode=ParseMode.MARKDOWN
             )
 
+    async def cmd_latency(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Percentyle opóźnień per etap (z argumentem 'komendy' - także per komenda)"""
+        if not update.message:
+            return
+        if not self.latency.enabled:
+            await update.message.reply_text("⏱️ Pomiary opóźnień są wyłączone (latency_metrics.enabled w konfiguracji).")
+            return
+        
+        by_command = bool(context.args) and context.args[0] in ('komendy', 'commands')
+        rows = self.latency.summary(by_command)
+        if not rows:
+            await update.message.reply_text("⏱️ Brak pomiarów - poczekaj na trochę ruchu.")
+            return
+        
+        lines = ["⏱️ OPÓŹNIENIA (p50 / p95 / p99, liczba)", ""]
+        for stage, command, count, p50, p95, p99 in rows:
+            label = f"{stage} [{command}]" if by_command else stage
+            lines.append(f"{label}: {p50 * 1000:.0f} / {p95 * 1000:.0f} / {p99 * 1000:.0f} ms ({count})")
+        await update.message.reply_text("\n".join(lines)[:4096])
+    
     async def cmd_top_users(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Komenda do wyświetlania top 10 najbardziej aktywnych użytkowników"""
         if not update.message:
             return
         
+        # Opcjonalne argumenty: okres (dziś / tydzień) i ranking wg zapytań AI
+        args = [arg.lower() for arg in (context.args or [])]
+        window = 'all'
+        if any(arg in ('dzis', 'dziś', 'today') for arg in args):
+            window = 'today'
+        elif any(arg in ('tydzien', 'tydzień', 'week', '7d') for arg in args):
+            window = 'week'
+        metric = 'ai_queries' if 'ai' in args else 'messages'
+        
         # Pobierz top 10 użytkowników
-        top_users = self.get_top_users(10)
+        top_users = self.get_top_users(10, metric, window)
         
         if not top_users:
             await update.message.reply_text(
@@ -1892,39 +4979,29 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
             return
         
         # Przygotuj tekst statystyk
-        stats_text = "📊 **TOP 10 NAJAKTYWNIEJSZYCH UŻYTKOWNIKÓW**\n\n"
+        period = {'all': '', 'today': ' - DZIŚ', 'week': ' - OSTATNIE 7 DNI'}[window]
+        ranking = ' (WG ZAPYTAŃ AI)' if metric == 'ai_queries' else ''
+        stats_text = f"📊 **TOP 10 NAJAKTYWNIEJSZYCH UŻYTKOWNIKÓW{period}{ranking}**\n\n"
         
+        # Nazwy z cache profili - get_chat tylko dla brakujących, równolegle
+        names = await self.user_profiles.resolve(context.bot, [user_id for user_id, _ in top_users])
         for i, (user_id, data) in enumerate(top_users, 1):
-            try:
-                # Pobierz informacje o użytkowniku
-                user_info = await context.bot.get_chat(user_id)
-                username = user_info.username or user_info.first_name or f"Użytkownik {user_id}"
-                messages = data['messages']
-                ai_queries = data['ai_queries']
-                last_activity = data['last_activity']
-                
-                # Oblicz czas od ostatniej aktywności
-                time_diff = datetime.now() - last_activity
-                if time_diff.days > 0:
-                    last_seen = f"{time_diff.days}d temu"
-                elif time_diff.seconds > 3600:
-                    last_seen = f"{time_diff.seconds // 3600}h temu"
-                else:
-                    last_seen = f"{time_diff.seconds // 60}min temu"
-                
-                # Dodaj emoji dla top 3
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                
-                stats_text += f"{medal} **{username}**\n"
-                stats_text += f"   💬 Wiadomości: {messages}\n"
-                stats_text += f"   🧠 AI zapytania: {ai_queries}\n"
-                stats_text += f"   ⏰ Ostatnio: {last_seen}\n\n"
-                
-            except Exception as e:
-                # Fallback jeśli nie można pobrać informacji o użytkowniku
-                stats_text += f"{i}. **Użytkownik {user_id}**\n"
-                stats_text += f"   💬 Wiadomości: {data['messages']}\n"
-                stats_text += f"   🧠 AI zapytania: {data['ai_queries']}\n\n"
+            # Oblicz czas od ostatniej aktywności
+            time_diff = datetime.now() - data['last_activity']
+            if time_diff.days > 0:
+                last_seen = f"{time_diff.days}d temu"
+            elif time_diff.seconds > 3600:
+                last_seen = f"{time_diff.seconds // 3600}h temu"
+            else:
+                last_seen = f"{time_diff.seconds // 60}min temu"
+            
+            # Dodaj emoji dla top 3
+            medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+            
+            stats_text += f"{medal} **{names[user_id]}**\n"
+            stats_text += f"   💬 Wiadomości: {data['messages']}\n"
+            stats_text += f"   🧠 AI zapytania: {data['ai_queries']}\n"
+            stats_text += f"   ⏰ Ostatnio: {last_seen}\n\n"
         
         # Dodaj podsumowanie
         total_messages = sum(data['messages'] for _, data in top_users)
@@ -1945,14 +5022,16 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
         if not update.message or not update.message.text or not update.effective_user:
             return
         
+        routing_started = self.latency.clock()
         user = update.effective_user
         message_text = update.message.text.strip()
         
         # Aktualizuj statystyki
-        self.stats['messages_processed'] += 1
+        self.activity.record('messages')
         
-        # Aktualizuj aktywność użytkownika
+        # Aktualizuj aktywność użytkownika (i jego nazwę do rankingów)
         self.update_user_activity(user.id, 'message')
+        self.user_profiles.remember(user)
         
         # Specjalne reakcje na popularne słowa
         lower_text = message_text.lower()
@@ -1992,15 +5071,17 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
         for trigger, response_func in gratitude_responses.items():
             if trigger in lower_text:
                 response = response_func(user.first_name)
+                self.latency.since('routing', routing_started)
                 await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
                 return
         
         # Sprawdź czy to pytanie o pogodę
         weather_city = self.detect_weather_query(message_text)
         if weather_city:
-            self.stats['web_queries'] += 1
+            self.latency.since('routing', routing_started)
+            self.activity.record('web_queries')
             await update.message.chat.send_action(ChatAction.TYPING)
-            result = await self.get_weather(weather_city)
+            result = await self.get_weather(weather_city, user.id, update.message.chat.id)
             await update.message.reply_text(result, parse_mode=ParseMode.MARKDOWN)
             return
         
@@ -2012,14 +5093,16 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
             "search for", "find me", "look up", "google"
         ]
         
-        if any(trigger in lower_text for trigger in web_triggers):
+        is_web_query = any(trigger in lower_text for trigger in web_triggers)
+        self.latency.since('routing', routing_started)
+        if is_web_query:
             # Usuń trigger z zapytania
             clean_query = message_text
             for trigger in web_triggers:
                 clean_query = clean_query.replace(trigger, "").strip()
             
             if clean_query and len(clean_query) > 2:
-                self.stats['web_queries'] += 1
+                self.activity.record('web_queries')
                 await update.message.chat.send_action(ChatAction.TYPING)
                 
                 # Informuj o wyszukiwaniu
@@ -2027,12 +5110,11 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
                 
                 # NAPRAWIONE - użyj AI z instrukcją wyszukiwania
                 try:
-                    warsaw_tz = pytz.timezone('Europe/Warsaw')
-                    current_datetime = datetime.now(warsaw_tz)
+                    current_datetime = self.prompt_builder.now()
                     current_date = current_datetime.strftime("%d.%m.%Y")
                     current_year = current_datetime.year
                     enhanced_query = f"Wyszukaj w internecie i znajdź aktualne informacje na temat: {clean_query}. WAŻNE: Dzisiaj jest {current_date}. Szukaj najnowszych informacji z roku {current_year}, nie starszych niż kilka miesięcy."
-                    result = await self.query_gemini(enhanced_query)
+                    result = await self.query_gemini(enhanced_query, cache_command='web')
                     
                     if result and not result.startswith("❌"):
                         await update.message.reply_text(result[:4000], parse_mode=ParseMode.MARKDOWN)
@@ -2048,8 +5130,98 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
         # W przeciwnym razie użyj AI
         await self.process_ai_message(update, message_text)
     
-    async def process_ai_message(self, update: Update, message_text: str):
-        """Przetwarzanie wiadomości przez AI"""
+    async def remember_exchange(self, user_id: int, user_text: str, ai_text: str):
+        """Dopisuje wymianę do kontekstu; starsze wiadomości trafiają do podsumowania w tle"""
+        window = self.conversation_window
+        conversation = await self.conversation_store.get(user_id)
+        history = conversation.turns
+        dropped = window.add_exchange(history, user_text, ai_text)
+        self.conversation_store.touch(user_id)
+        if logger.isEnabledFor(logging.DEBUG):  # suma tokenów tylko, gdy log faktycznie powstanie
+            logger.debug("💾 Zapisano do kontekstu użytkownika %s (rozmiar: %d, ~%d tokenów)",
+                         user_id, len(history), sum(turn.tokens for turn in history))
+        
+        if dropped:
+            logger.debug("🗂️ Przycięto kontekst o %d wiadomości dla użytkownika %s", len(dropped), user_id)
+            if window.summarize:
+                self.pending_summary_turns.setdefault(user_id, []).extend(dropped)
+                task = self.summary_tasks.get(user_id)
+                if task is None or task.done():
+                    task = self.summary_tasks[user_id] = asyncio.create_task(self.summarize_context(user_id))
+                    task.add_done_callback(lambda done: self.summary_task_done(user_id, done))
+    
+    def summary_task_done(self, user_id: int, task: asyncio.Task):
+        """Zakończone zadanie nie zostaje w słowniku - pamięć rośnie tylko z aktywnymi użytkownikami"""
+        if self.summary_tasks.get(user_id) is task:
+            del self.summary_tasks[user_id]
+    
+    def forget_pending_summary(self, user_id: int):
+        """Rozmowa wypadła z pamięci - porzuca wiadomości czekające na podsumowanie (po błędzie modelu)"""
+        task = self.summary_tasks.get(user_id)
+        if task is not None and not task.done():
+            return  # trwające podsumowanie samo je odbierze
+        if self.pending_summary_turns.pop(user_id, None):
+            logger.debug("🗂️ Porzucono niepodsumowane wiadomości użytkownika %s (rozmowa wyrzucona z pamięci)", user_id)
+    
+    def requeue_summary_turns(self, user_id: int, turns: List[Turn]):
+        """Nieudane podsumowanie - wiadomości wracają na początek następnej partii (najwyżej max_messages)"""
+        if user_id not in self.conversation_store.hot:
+            return  # rozmowa wypadła z pamięci w trakcie podsumowania - jak w forget_pending_summary
+        pending = turns + self.pending_summary_turns.get(user_id, [])
+        self.pending_summary_turns[user_id] = pending[-self.conversation_window.max_messages:]
+    
+    async def summarize_context(self, user_id: int):
+        """Dokleja wypadające wiadomości do kroczącego podsumowania (poza ścieżką odpowiedzi)"""
+        while self.pending_summary_turns.get(user_id):
+            turns = self.pending_summary_turns.pop(user_id)
+            previous = (await self.conversation_store.get(user_id)).summary
+            transcript = "\n".join(
+                f"{'Bot' if turn.role == ROLE_MODEL else 'Użytkownik'}: {turn.text}" for turn in turns
+            )
+            prompt = (
+                "Streść zwięźle po polsku rozmowę użytkownika z botem, zachowując fakty, imiona, "
+                "ustalenia i otwarte wątki. Odpowiedz samym streszczeniem.\n\n"
+                f"Dotychczasowe streszczenie: {previous or 'brak'}\n\nNowe wiadomości:\n{transcript}"
+            )
+            payload = {
+                "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                "generationConfig": {
+                    "temperature": 0.2,
+                    "maxOutputTokens": self.conversation_window.summary_max_tokens
+                }
+            }
+            async def same_payload() -> dict:
+                return payload
+            
+            try:
+                async with self.gemini_scheduler.slot(user_id, LANE_BACKGROUND):
+                    result = await self.model_backend.generate(payload, same_payload)
+                if result.error:
+                    logger.warning(f"⚠️ Nie udało się podsumować kontekstu ({result.status}: {result.error})")
+                    self.requeue_summary_turns(user_id, turns)
+                    return
+                summary = cast(str, result.text).strip()
+            except Exception as e:
+                logger.warning(f"⚠️ Błąd podsumowania kontekstu: {e}")
+                self.requeue_summary_turns(user_id, turns)
+                return
+            # Wyczyszczenie kontekstu anuluje to zadanie, więc rozmowa wciąż jest aktualna
+            if summary:
+                conversation = await self.conversation_store.get(user_id)
+                conversation.summary = summary
+                self.conversation_store.touch(user_id)
+                logger.info(f"📝 Zaktualizowano podsumowanie rozmowy użytkownika {user_id}")
+    
+    def clear_conversation(self, user_id: int):
+        """Czyści historię, podsumowanie i oczekujące podsumowania użytkownika"""
+        self.conversation_store.clear(user_id)
+        self.pending_summary_turns.pop(user_id, None)
+        task = self.summary_tasks.pop(user_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+    
+    async def process_ai_message(self, update: Update, message_text: str, direct: bool = False):
+        """Przetwarzanie wiadomości przez AI (direct - bezpośrednia komenda, wyższy priorytet w grupie)"""
         if not update.message or not update.effective_user:
             logger.warning("❌ Brak update.message lub effective_user")
             return
@@ -2057,14 +5229,14 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
         user_id = update.effective_user.id
         user_name = update.effective_user.first_name
         
-        logger.info(f"👤 Użytkownik {user_name} (ID: {user_id}) wysłał wiadomość: {message_text[:50]}...")
+        if self.log_user_messages:
+            logger.info("👤 Użytkownik %s (ID: %s) wysłał wiadomość: %.50s...", user_name, user_id, message_text)
         
         # Pokaż że bot "pisze"
         await update.message.chat.send_action(ChatAction.TYPING)
         
-        # Pobierz kontekst rozmowy
-        if user_id not in self.conversation_cache:
-            self.conversation_cache[user_id] = []
+        # Pobierz kontekst rozmowy (z pamięci lub z bazy)
+        conversation = await self.conversation_store.get(user_id)
         
         # Sprawdź czy to przywitanie lub pożegnanie
         greeting_words = ["cześć", "czesc", "hej", "hello", "siema", "witaj", "dzień dobry", "dobry wieczór"]
@@ -2086,23 +5258,22 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
             enhanced_prompt = f"Użytkownik {user_name} pisze: {message_text}"
         
         # Zapytaj AI
-        logger.info(f"🧠 Wysyłam zapytanie do AI dla użytkownika {user_name}")
+        logger.debug("🧠 Wysyłam zapytanie do AI dla użytkownika %s", user_name)
         chat_id = update.message.chat.id
-        ai_response = await self.query_gemini(enhanced_prompt, self.conversation_cache[user_id], user_id, chat_id)
-        logger.info(f"🤖 Otrzymano odpowiedź AI: {ai_response[:100]}...")
-        
-        # Zapisz do kontekstu
-        self.conversation_cache[user_id].append({"role": "user", "text": message_text})
-        self.conversation_cache[user_id].append({"role": "assistant", "text": ai_response})
-        logger.info(f"💾 Zapisano do kontekstu użytkownika {user_id} (rozmiar: {len(self.conversation_cache[user_id])})")
+        streamed_message = None
+        if self.streaming_enabled:
+            # Tryb strumieniowy - placeholder edytowany w trakcie generowania
+            ai_response, streamed_message = await self.stream_ai_reply(update, enhanced_prompt, user_id, chat_id, direct)
+        else:
+            ai_response = await self.query_gemini(enhanced_prompt, conversation.turns, user_id, chat_id, direct=direct)
+        if self.log_ai_queries:
+            logger.info("🤖 Otrzymano odpowiedź AI: %.100s...", ai_response)
         
-        # Ogranicz historię (z konfiguracji)
-        max_context = self.settings.get('max_context_messages', 10) * 2  # x2 bo user+assistant
-        if len(self.conversation_cache[user_id]) > max_context:
-            self.conversation_cache[user_id] = self.conversation_cache[user_id][-max_context:]
-            logger.info(f"🗂️ Przycięto kontekst do {max_context//2} wymian dla użytkownika {user_id}")
+        # Zapisz do kontekstu (przycięte do budżetu tokenów)
+        await self.remember_exchange(user_id, message_text, ai_response)
         
                 # Parsuj multimedia z odpowiedzi
+        postprocess_started = self.latency.clock()
         clean_text, media_type, media_tag = self.parse_media_tags(ai_response)
         
         # Automatycznie dodaj emotki do odpowiedzi jeśli ich nie ma
@@ -2111,11 +5282,17 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
         
         # Sanityzuj odpowiedź przed wysłaniem
         sanitized_response = self.sanitize_markdown(clean_text)
+        self.latency.since('parse_sanitize', postprocess_started)
+        
+        # W trybie strumieniowym tylko ostatnia edycja dostaje pełne formatowanie
+        if streamed_message is not None:
+            await self.finish_streamed_reply(update, streamed_message, sanitized_response, media_type, media_tag, user_id)
+            return
 
         # Wyślij multimedia jeśli są dostępne (z ograniczeniem)
         if media_type == 'gif' and media_tag:
             # Sprawdź czy użytkownik nie wysyła za dużo GIF-ów
-            if user_id in self.giphy_request_count and self.giphy_request_count[user_id] > 10:
+            if self.rate_limiter.exhausted('giphy', user_id=user_id):
                 # Jeśli za dużo GIF-ów, wyślij tylko tekst
                 logger.info(f"⚠️ Użytkownik {user_id} wysyła za dużo GIF-ów, wysyłam tylko tekst")
                 try:
@@ -2130,8 +5307,8 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
             gif_url = await self.get_giphy_gif(media_tag, user_id)
             if gif_url:
                 try:
-                    await update.message.reply_animation(
-                        animation=gif_url,
+                    await self.send_animation(
+                        update.message, gif_url,
                         caption=sanitized_response,
                         parse_mode=ParseMode.MARKDOWN
                     )
@@ -2265,7 +5442,9 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
                     parse_mode=ParseMode.MARKDOWN
                 )
                 # Pobierz pogodę dla Warszawy
-                weather_result = await self.get_weather("Warszawa")
+                weather_result = await self.get_weather(
+                    "Warszawa", update.effective_user.id if update.effective_user else None, query.message.chat.id
+                )
                 await query.message.reply_text(weather_result, parse_mode=ParseMode.MARKDOWN)
         
         elif query.data == "back_to_start":
@@ -2321,8 +5500,7 @@ Zero inwigilacji! Twoje rozmowy zostają między nami.
             # Wyczyść kontekst rozmowy
             if update.effective_user:
                 user_id = update.effective_user.id
-                if user_id in self.conversation_cache:
-                    self.conversation_cache[user_id] = []
+                self.clear_conversation(user_id)
                 
                 if query.message:
                     await query.message.reply_text(
@@ -2446,11 +5624,17 @@ Twoje rozmowy są bezpieczne. Nie zapisuję danych osobowych.
 
 🔥 **WYDAJNOŚĆ:**
 • ⏱️ Działa od: {hours}h {minutes}m
-• 💬 Wiadomości: {self.stats['messages_processed']}
-• 🧠 Zapytania AI: {self.stats['ai_queries']}
-• 🌐 Wyszukiwania: {self.stats['web_queries']}
-• 👥 Aktywne rozmowy: {len(self.conversation_cache)}
+{self.format_activity_stats()}
+{self.format_conversation_store_stats()}
+{self.format_user_profile_stats()}
 • 📰 Subskrybenci RSS: {len(self.rss_subscribers)}
+{self.format_http_pool_stats()}
+{self.format_response_cache_stats()}
+{self.format_single_flight_stats()}
+{self.format_model_backend_stats()}
+{self.format_gemini_client_stats()}
+{self.format_gemini_scheduler_stats()}
+{self.format_rate_limiter_stats()}
 
 ⚡ **MOŻLIWOŚCI:**
 • 🚀 Czas odpowiedzi: <2s
@@ -2484,37 +5668,25 @@ Twoje rozmowy są bezpieczne. Nie zapisuję danych osobowych.
             # Przygotuj tekst statystyk
             stats_text = "📊 **TOP 10 NAJAKTYWNIEJSZYCH UŻYTKOWNIKÓW**\n\n"
             
+            # Nazwy z cache profili - get_chat tylko dla brakujących, równolegle
+            names = await self.user_profiles.resolve(context.bot, [user_id for user_id, _ in top_users])
             for i, (user_id, data) in enumerate(top_users, 1):
-                try:
-                    # Pobierz informacje o użytkowniku
-                    user_info = await context.bot.get_chat(user_id)
-                    username = user_info.username or user_info.first_name or f"Użytkownik {user_id}"
-                    messages = data['messages']
-                    ai_queries = data['ai_queries']
-                    last_activity = data['last_activity']
-                    
-                    # Oblicz czas od ostatniej aktywności
-                    time_diff = datetime.now() - last_activity
-                    if time_diff.days > 0:
-                        last_seen = f"{time_diff.days}d temu"
-                    elif time_diff.seconds > 3600:
-                        last_seen = f"{time_diff.seconds // 3600}h temu"
-                    else:
-                        last_seen = f"{time_diff.seconds // 60}min temu"
-                    
-                    # Dodaj emoji dla top 3
-                    medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                    
-                    stats_text += f"{medal} **{username}**\n"
-                    stats_text += f"   💬 Wiadomości: {messages}\n"
-                    stats_text += f"   🧠 AI zapytania: {ai_queries}\n"
-                    stats_text += f"   ⏰ Ostatnio: {last_seen}\n\n"
-                    
-                except Exception as e:
-                    # Fallback jeśli nie można pobrać informacji o użytkowniku
-                    stats_text += f"{i}. **Użytkownik {user_id}**\n"
-                    stats_text += f"   💬 Wiadomości: {data['messages']}\n"
-                    stats_text += f"   🧠 AI zapytania: {data['ai_queries']}\n\n"
+                # Oblicz czas od ostatniej aktywności
+                time_diff = datetime.now() - data['last_activity']
+                if time_diff.days > 0:
+                    last_seen = f"{time_diff.days}d temu"
+                elif time_diff.seconds > 3600:
+                    last_seen = f"{time_diff.seconds // 3600}h temu"
+                else:
+                    last_seen = f"{time_diff.seconds // 60}min temu"
+                
+                # Dodaj emoji dla top 3
+                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+                
+                stats_text += f"{medal} **{names[user_id]}**\n"
+                stats_text += f"   💬 Wiadomości: {data['messages']}\n"
+                stats_text += f"   🧠 AI zapytania: {data['ai_queries']}\n"
+                stats_text += f"   ⏰ Ostatnio: {last_seen}\n\n"
             
             # Dodaj podsumowanie
             total_messages = sum(data['messages'] for _, data in top_users)
@@ -2637,17 +5809,39 @@ Twoje rozmowy są bezpieczne. Nie zapisuję danych osobowych.
         print("=" * 50)
         
         try:
-            # Uruchom RSS scheduler po starcie aplikacji
-            if self.rss_enabled:
-                async def post_init(application):
+            # Po starcie aplikacji: współdzielony klient HTTP i RSS scheduler
+            async def post_init(application):
+                await self.get_http_session()
+                self.conversation_store.start()
+                self.activity.start()
+                self.metrics_exporter.start()
+                if self.accuweather_api_key and self.weather_locations.preload:
+                    self.weather_preload_task = asyncio.create_task(self.preload_weather_locations())
+                if self.rss_enabled:
                     self.start_rss_scheduler()
-                
-                self.application.post_init = post_init
+            
+            # Przy wyłączaniu: zatrzymaj scheduler i zamknij pulę połączeń
+            async def post_shutdown(application):
+                if self.scheduler.running:
+                    self.scheduler.shutdown(wait=False)
+                if self.http_session is not None and not self.http_session.closed:
+                    await self.context_cache.delete(self.http_session)
+                await self.close_http_session()
+                self.response_cache.save()
+                await self.conversation_store.close()
+                await self.gif_pools.saver.close()
+                await self.animation_ids.saver.close()
+                await self.weather_locations.saver.close()
+                await self.activity.close()
+                await self.metrics_exporter.close()
+            
+            self.application.post_init = post_init
+            self.application.post_shutdown = post_shutdown
             
             # Uruchom bot z podstawowymi ustawieniami polling
             self.application.run_polling(
                 drop_pending_updates=True,
-                allowed_updates=['message', 'callback_query']
+                allowed_updates=['message', 'callback_query', 'chat_member']
             )
         except Exception as e:
             error_msg = str(e)
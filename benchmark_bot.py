@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark obsługi wiadomości offline - bez Telegrama i bez Gemini
+Bot działa na atrapie modelu (model_backend.type = fake), a wiadomości
+trafiają bezpośrednio do handle_message jako sztuczne update'y.
+
+Przykład:
+    python benchmark_bot.py --messages 5000 --concurrency 500 --latency-ms 800
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import random
+import time
+
+BOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SmartAI Bot.py")
+
+SAMPLE_MESSAGES = [
+    "Jak tam, co słychać?",
+    "Wytłumacz mi blockchain prostymi słowami",
+    "Napisz krótki wiersz o kawie",
+    "Co sądzisz o poniedziałkach?",
+    "Daj jakiś dobry pomysł na weekend",
+    "Dlaczego niebo jest niebieskie?",
+]
+
+
+class FakeChat:
+    """Czat przyjmujący akcje bez wysyłania czegokolwiek"""
+
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+    async def send_action(self, *args, **kwargs):
+        pass
+
+
+class FakeMessage:
+    """Wiadomość zliczająca odpowiedzi bota zamiast wysyłać je do Telegrama"""
+
+    def __init__(self, text: str, chat: FakeChat, counters: dict):
+        self.text = text
+        self.chat = chat
+        self.message_id = 1
+        self.counters = counters
+
+    async def reply_text(self, text, **kwargs):
+        self.counters['replies'] += 1
+        return FakeMessage(text, self.chat, self.counters)
+
+    async def edit_text(self, text, **kwargs):
+        self.counters['edits'] += 1
+        self.text = text
+        return self
+
+    async def reply_animation(self, *args, **kwargs):
+        self.counters['animations'] += 1
+        return self
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = f"Tester{user_id}"
+        self.username = f"tester{user_id}"
+
+
+class FakeUpdate:
+    def __init__(self, text: str, user_id: int, chat_id: int, counters: dict):
+        self.message = FakeMessage(text, FakeChat(chat_id), counters)
+        self.effective_user = FakeUser(user_id)
+        self.callback_query = None
+
+
+def load_bot_module():
+    """Ładuje 'SmartAI Bot.py' (nazwa ze spacją - zwykły import nie zadziała)"""
+    spec = importlib.util.spec_from_file_location("smartai_bot", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def run_benchmark(args):
+    module = load_bot_module()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with open('bot_config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    config['bot_token'] = config.get('bot_token') or '123456:BENCHMARK'
+    config['giphy_enabled'] = False
+    config['limits'] = {}  # bez limitów - mierzymy przepustowość, nie rate limiting
+    config.setdefault('streaming', {})['enabled'] = args.stream
+    config.setdefault('response_cache', {})['persist'] = False
+    config.setdefault('conversation_store', {})['enabled'] = False
+    config.setdefault('activity_stats', {})['persist'] = False
+    config.setdefault('logging', {}).update({'log_ai_queries': False, 'log_user_messages': False, 'log_level': 'WARNING'})
+    config['model_backend'] = {
+        'type': 'fake',
+        'fake': {
+            'seed': args.seed,
+            'latency_ms': {'distribution': args.distribution, 'median': args.latency_ms, 'sigma': args.sigma,
+                           'min': args.latency_ms / 2, 'max': args.latency_ms * 4},
+            'error_rate': args.error_rate,
+            'output_tokens': [args.min_tokens, args.max_tokens],
+            'stream_chunk_delay_ms': 0 if not args.stream else 20,
+        }
+    }
+    config.setdefault('gemini_config', {}).setdefault('scheduler', {})['max_concurrent'] = args.concurrency
+
+    bot = module.SmartAIBot(config)
+    bot.giphy_enabled = False
+    counters = {'replies': 0, 'edits': 0, 'animations': 0}
+    rng = random.Random(args.seed)
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one_message(index: int):
+        user_id = rng.randint(1, args.users)
+        chat_id = user_id if rng.random() < 0.5 else -rng.randint(1, max(1, args.users // 10))
+        update = FakeUpdate(rng.choice(SAMPLE_MESSAGES), user_id, chat_id, counters)
+        async with semaphore:
+            started = time.perf_counter()
+            await bot.handle_message(update, None)
+            latencies.append(time.perf_counter() - started)
+
+    print(f"🚀 Benchmark: {args.messages} wiadomości, równolegle {args.concurrency}, "
+          f"atrapa modelu ~{args.latency_ms} ms ({args.distribution}), błędy {args.error_rate:.0%}")
+    started = time.perf_counter()
+    await asyncio.gather(*(one_message(i) for i in range(args.messages)))
+    elapsed = time.perf_counter() - started
+
+    backend = bot.model_backend.stats()
+    print(f"\n✅ Gotowe w {elapsed:.2f}s - {args.messages / elapsed:.0f} wiadomości/s")
+    print(f"⏱️ handle_message: p50 {percentile(latencies, 0.5) * 1000:.0f} ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, p99 {percentile(latencies, 0.99) * 1000:.0f} ms")
+    print(f"🧠 Backend: {backend['calls']} wywołań, {backend['errors']} błędów, "
+          f"tokeny {backend['input_tokens']}/{backend['output_tokens']}")
+    print(f"📨 Odpowiedzi: {counters['replies']}, edycje: {counters['edits']}, GIF-y: {counters['animations']}")
+    await bot.conversation_store.close()
+    await bot.close_http_session()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bota na atrapie modelu")
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=800)
+    parser.add_argument('--distribution', choices=['fixed', 'uniform', 'lognormal'], default='lognormal')
+    parser.add_argument('--sigma', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--min-tokens', type=int, default=20)
+    parser.add_argument('--max-tokens', type=int, default=120)
+    parser.add_argument('--stream', action='store_true', help="tryb strumieniowy (edycje wiadomości)")
+    parser.add_argument('--seed', type=int, default=42)
+    asyncio.run(run_benchmark(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
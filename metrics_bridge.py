@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Most metryk między procesem bota a serwerem HTTP (render_server.py / server.py)
+Bot co kilka sekund zapisuje gotowy tekst w formacie Prometheus do pliku w pamięci
+współdzielonej (/dev/shm, bez niej - katalog tymczasowy). Serwer HTTP tylko czyta
+ten plik, więc /metrics nie dotyka pętli zdarzeń bota.
+"""
+
+import json
+import os
+import tempfile
+import time
+from typing import Optional
+
+# Wspólna ścieżka dla obu procesów (serwer HTTP ustawia ją w share_metrics_file przed uruchomieniem bota)
+METRICS_FILE_ENV = 'SMARTAI_METRICS_FILE'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def metrics_file_path(configured: str = '') -> str:
+    """Ścieżka pliku z metrykami: zmienna środowiskowa, konfiguracja, potem /dev/shm"""
+    path = os.environ.get(METRICS_FILE_ENV) or configured
+    if path:
+        return path
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'smartai_bot_metrics.prom')
+
+
+def share_metrics_file(config_file: str = 'bot_config.json') -> str:
+    """Ustala ścieżkę metryk po stronie serwera HTTP (z metrics_export.file w konfiguracji bota)
+    i eksportuje ją w zmiennej środowiskowej - bot uruchomiony jako proces potomny pisze tam, skąd serwer czyta"""
+    configured = ''
+    try:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            configured = json.load(f).get('metrics_export', {}).get('file', '')
+    except (OSError, ValueError):
+        pass
+    path = metrics_file_path(configured)
+    os.environ[METRICS_FILE_ENV] = path
+    return path
+
+
+def write_metrics(text: str, path: Optional[str] = None):
+    """Zapisuje metryki atomowo - czytelnik widzi zawsze pełną migawkę"""
+    path = path or metrics_file_path()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def read_metrics(path: Optional[str] = None) -> Optional[str]:
+    """Ostatnia migawka metryk + wiek migawki (None, gdy bot jeszcze nic nie opublikował)"""
+    path = path or metrics_file_path()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        age = max(0.0, time.time() - os.path.getmtime(path))
+    except OSError:
+        return None
+    return (f"{text}# HELP smartai_metrics_age_seconds Wiek migawki metryk opublikowanej przez bota\n"
+            f"# TYPE smartai_metrics_age_seconds gauge\n"
+            f"smartai_metrics_age_seconds {age:.3f}\n")
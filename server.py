@@ -12,6 +12,7 @@ import signal
 import sys
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import json
+from metrics_bridge import PROMETHEUS_CONTENT_TYPE, read_metrics, share_metrics_file
 
 class HealthCheckHandler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -31,6 +32,21 @@ class HealthCheckHandler(BaseHTTPRequestHandler):
             }
             self.wfile.write(json.dumps(response).encode())
             print(f"✅ Health check OK - {self.path}")
+        elif self.path == '/metrics':
+            # Migawka opublikowana przez proces bota - odczyt pliku, bez kontaktu z botem
+            metrics = read_metrics()
+            if metrics is None:
+                self.send_response(503)
+                self.end_headers()
+                self.wfile.write(b'Metrics not published yet')
+                return
+            body = metrics.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-type', PROMETHEUS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+            self.end_headers()
+            self.wfile.write(body)
         else:
             self.send_response(404)
             self.end_headers()
@@ -65,6 +81,10 @@ def main():
     port = int(os.environ.get('PORT', 10000))
     
     try:
+        # Wspólny plik metryk - bot (proces potomny) dziedziczy ścieżkę przez zmienną środowiskową
+        metrics_path = share_metrics_file()
+        print(f"📡 Plik metryk: {metrics_path}")
+        
         # Uruchom bota w osobnym wątku (nie daemon)
         bot_thread = threading.Thread(target=start_bot)
         bot_thread.daemon = False
@@ -80,6 +100,7 @@ def main():
         
         print(f"🌐 Serwer HTTP uruchomiony na 0.0.0.0:{port}")
         print(f"🔗 Health check: http://0.0.0.0:{port}/health")
+        print(f"📡 Metryki: http://0.0.0.0:{port}/metrics")
         print(f"⏱️ Timeout: {server.timeout} sekund")
         print(f"🔄 Render mode: {os.environ.get('RENDER', 'false')}")
         
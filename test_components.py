@@ -0,0 +1,1533 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Testy komponentów bota bez Telegrama i sieci - struktury danych i ich przypadki brzegowe
+Uruchomienie: python -m pytest -q test_components.py (albo python test_components.py)
+"""
+
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+BOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SmartAI Bot.py")
+
+
+def load_bot_module():
+    """Ładuje 'SmartAI Bot.py' (nazwa ze spacją - zwykły import nie zadziała)"""
+    spec = importlib.util.spec_from_file_location("smartai_bot", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+bot = load_bot_module()
+
+
+class FakeClock:
+    """Podmienia moduł time w bocie - testy przesuwają czas bez czekania"""
+
+    def __init__(self, start: float = 1_000_000.0):
+        self.now = start
+        self.saved = bot.time
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(self.saved, name)
+
+    def __enter__(self):
+        bot.time = self
+        return self
+
+    def __exit__(self, *exc):
+        bot.time = self.saved
+
+
+# === CACHE ODPOWIEDZI AI ===
+
+def test_response_cache_expires_entries():
+    with FakeClock() as clock:
+        cache = bot.ResponseCache({'enabled': True})
+        cache.put('k', "odpowiedź", ttl=60)
+        clock.advance(59)
+        assert cache.get('k') == "odpowiedź"
+        clock.advance(1)
+        assert cache.get('k') is None
+        assert not cache.entries and cache.size_bytes == 0
+        cache.put('zero', "nie zapisuj", ttl=0)
+        assert cache.get('zero') is None
+        assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = bot.ResponseCache({'enabled': True, 'max_entries': 2})
+    cache.put('a', "1", 60)
+    cache.put('b', "2", 60)
+    assert cache.get('a') == "1"  # 'b' staje się najdawniej używanym
+    cache.put('c', "3", 60)
+    assert list(cache.entries) == ['a', 'c']
+
+
+def test_response_cache_respects_memory_limit():
+    cache = bot.ResponseCache({'enabled': True, 'max_memory_mb': 100 / (1024 * 1024)})
+    cache.put('a', "x" * 40, 60)
+    cache.put('b', "y" * 40, 60)
+    cache.put('c', "z" * 40, 60)
+    assert list(cache.entries) == ['b', 'c']
+    assert cache.size_bytes == 2 * (1 + 40)
+    cache.put('b', "krótko", 60)  # nadpisanie nie liczy starej wersji
+    assert cache.size_bytes == (1 + 40) + (1 + len("krótko".encode("utf-8")))
+
+
+def test_response_cache_key_normalizes_prompt():
+    config = {'temperature': 0.8}
+    key = bot.ResponseCache.make_key("Oceń  MÓJ pomysł", 'gemini', config)
+    assert key == bot.ResponseCache.make_key("  oceń mój   pomysł ", 'gemini', config)
+    assert key != bot.ResponseCache.make_key("oceń mój pomysł", 'gemini-pro', config)
+    assert key != bot.ResponseCache.make_key("oceń mój pomysł", 'gemini', {'temperature': 0.2})
+
+
+# === DEDUPLIKACJA RÓWNOCZESNYCH ZAPYTAŃ ===
+
+def test_single_flight_shares_result():
+    async def scenario():
+        flight = bot.SingleFlight()
+        calls = []
+
+        async def factory():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "wynik"
+
+        results = await asyncio.gather(*(flight.do('gemini', 'klucz', factory) for _ in range(5)))
+        assert results == ["wynik"] * 5
+        assert len(calls) == 1
+        assert flight.stats() == {'gemini': {'calls': 1, 'saved': 4}}
+        assert not flight.in_flight
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_shares_exception():
+    async def scenario():
+        flight = bot.SingleFlight()
+
+        async def factory():
+            await asyncio.sleep(0.01)
+            raise ValueError("błąd upstream")
+
+        results = await asyncio.gather(*(flight.do('giphy', 'k', factory) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert not flight.in_flight
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_leader_cancel_does_not_cancel_followers():
+    async def scenario():
+        flight = bot.SingleFlight()
+        calls = []
+
+        async def factory():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return len(calls)
+
+        leader = asyncio.create_task(flight.do('weather', 'warszawa', factory))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(flight.do('weather', 'warszawa', factory)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*followers)
+        assert leader.cancelled()
+        assert results == [2, 2, 2]  # jeden z czekających powtórzył zapytanie, reszta dostała jego wynik
+        assert len(calls) == 2
+        assert not flight.in_flight
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_follower_cancel_keeps_leader():
+    async def scenario():
+        flight = bot.SingleFlight()
+
+        async def factory():
+            await asyncio.sleep(0.02)
+            return "ok"
+
+        leader = asyncio.create_task(flight.do('membership', 1, factory))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do('membership', 1, factory))
+        await asyncio.sleep(0.005)
+        follower.cancel()
+        assert await leader == "ok"
+        assert follower.cancelled()
+
+    asyncio.run(scenario())
+
+
+# === LIMITY ZAPYTAŃ ===
+
+def test_rate_limiter_burst_then_refill():
+    with FakeClock() as clock:
+        limiter = bot.RateLimiter({'ai_requests_per_user_per_hour': 60, 'ai_burst_per_user': 3})
+        assert all(limiter.check('ai', user_id=1) is None for _ in range(3))
+        scope, wait = limiter.check('ai', user_id=1)
+        assert scope == 'user' and abs(wait - 60) < 1e-6
+        assert limiter.check('ai', user_id=2) is None  # inny użytkownik ma własny kubełek
+        clock.advance(60)
+        assert limiter.check('ai', user_id=1) is None
+        assert limiter.check('ai', user_id=1) is not None
+        assert limiter.stats()['rejected']['ai'] == 2
+
+
+def test_rate_limiter_rejection_consumes_no_tokens():
+    with FakeClock():
+        limiter = bot.RateLimiter({
+            'ai_requests_per_user_per_hour': 60, 'ai_burst_per_user': 1,
+            'ai_requests_per_chat_per_hour': 60, 'ai_burst_per_chat': 5,
+        })
+        assert limiter.check('ai', user_id=1, chat_id=10) is None
+        assert limiter.check('ai', user_id=1, chat_id=10)[0] == 'user'
+        chat_bucket = limiter.buckets[('ai', 'chat')]
+        assert chat_bucket.tokens(10, bot.time.monotonic()) == 4
+
+
+def test_rate_limiter_exhausted_does_not_consume():
+    with FakeClock():
+        limiter = bot.RateLimiter({'weather_requests_global_per_hour': 60, 'weather_burst_global': 1})
+        for _ in range(3):
+            assert not limiter.exhausted('weather')
+        assert limiter.check('weather') is None
+        assert limiter.exhausted('weather')
+        # Rodzaj bez skonfigurowanego limitu nigdy nie jest wyczerpany
+        assert not limiter.exhausted('giphy') and limiter.check('giphy') is None
+
+
+def test_token_bucket_evicts_idle_and_bounds_keys():
+    bucket = bot.TokenBucket(per_hour=3600, burst=2, max_keys=3)  # pełne napełnienie po 2 s
+    bucket.consume('idle', 0.0)
+    bucket.consume('active', 5.0)
+    assert 'idle' not in bucket.buckets
+    assert bucket.tokens('idle', 5.0) == bucket.capacity  # usunięcie bezstratne
+    for key in range(10):
+        bucket.consume(key, 5.0)
+        assert len(bucket.buckets) <= bucket.max_keys
+    assert list(bucket.buckets) == [7, 8, 9]
+
+
+# === OKNO KONTEKSTU ROZMOWY ===
+
+def test_window_ring_buffer_drops_oldest_exchange():
+    window = bot.ConversationWindow({}, max_messages=4)
+    history = window.new_history()
+    for i in range(2):
+        assert window.add_exchange(history, f"pytanie {i}", f"odpowiedź {i}") == []
+    dropped = window.add_exchange(history, "pytanie 2", "odpowiedź 2")
+    assert [turn.text for turn in dropped] == ["pytanie 0", "odpowiedź 0"]
+    assert [turn.text for turn in history] == ["pytanie 1", "odpowiedź 1", "pytanie 2", "odpowiedź 2"]
+
+
+def test_window_trims_to_token_budget_and_starts_with_user():
+    window = bot.ConversationWindow({'token_budget': 20, 'chars_per_token': 4}, max_messages=10)
+    history = window.new_history()
+    window.add_exchange(history, "a" * 40, "ok")  # 14 + 4 tokeny
+    dropped = window.add_exchange(history, "hi", "b" * 16)  # 4 + 8 tokenów
+    # Sam budżet zostawiłby osieroconą odpowiedź modelu na początku historii
+    assert [turn.role for turn in dropped] == [bot.ROLE_USER, bot.ROLE_MODEL]
+    assert [turn.text for turn in history] == ["hi", "b" * 16]
+    assert sum(turn.tokens for turn in history) <= window.token_budget
+
+
+def test_window_truncates_long_turns():
+    window = bot.ConversationWindow({'max_turn_tokens': 10, 'chars_per_token': 4}, max_messages=10)
+    turn = window.make_turn(bot.ROLE_USER, "x" * 100)
+    assert turn.text == "x" * 40 + "…"
+    assert turn.tokens == window.estimate_tokens(turn.text)
+    assert window.make_turn(bot.ROLE_USER, "x" * 40).text == "x" * 40
+
+
+def test_turn_rows_round_trip_and_legacy_format():
+    turn = bot.Turn.from_row(bot.Turn(bot.ROLE_MODEL, "cześć", 5).to_row())
+    assert (turn.role, turn.text, turn.tokens) == (bot.ROLE_MODEL, "cześć", 5)
+    legacy = bot.Turn.from_row({"role": "assistant", "text": "stary zapis", "tokens": 7})
+    assert (legacy.role, legacy.text, legacy.tokens) == (bot.ROLE_MODEL, "stary zapis", 7)
+    assert bot.Turn.from_row({"role": "user", "text": "hej", "tokens": 4}).role == bot.ROLE_USER
+
+
+# === MAGAZYN ROZMÓW ===
+
+def make_store(path, **config):
+    window = bot.ConversationWindow({}, max_messages=10)
+    return bot.ConversationStore({'file': path, **config}, window)
+
+
+def test_conversation_store_persists_and_reloads():
+    async def scenario():
+        path = os.path.join(tempfile.mkdtemp(), 'conversations.db')
+        store = make_store(path)
+        conversation = await store.get(1)
+        store.window.add_exchange(conversation.turns, "jak się masz?", "świetnie")
+        conversation.summary = "powitanie"
+        store.touch(1)
+        await store.close()
+
+        reopened = make_store(path)
+        conversation = await reopened.get(1)
+        assert [turn.text for turn in conversation.turns] == ["jak się masz?", "świetnie"]
+        assert conversation.summary == "powitanie" and reopened.loads == 1
+        assert len((await reopened.get(2)).turns) == 0
+        await reopened.close()
+
+    asyncio.run(scenario())
+
+
+def test_conversation_store_evicted_changes_wait_for_flush():
+    async def scenario():
+        path = os.path.join(tempfile.mkdtemp(), 'conversations.db')
+        with FakeClock() as clock:
+            store = make_store(path, max_hot_users=1, idle_ttl_minutes=1)
+            conversation = await store.get(1)
+            store.window.add_exchange(conversation.turns, "pierwszy", "tak")
+            store.touch(1)
+            await store.get(2)
+            # Wyrzucona z pamięci, ale niezapisana - wraca z dirty bez odczytu z bazy
+            assert 1 not in store.hot and 1 in store.dirty
+            loads = store.loads
+            assert store.peek(1) is conversation and store.loads == loads
+            await store.flush()
+            assert not store.dirty and store.written == 1
+
+            clock.advance(61)
+            store.evict()
+            assert len(store) == 0 and store.evictions == 3
+            reloaded = await store.get(1)
+            assert reloaded is not conversation
+            assert [turn.text for turn in reloaded.turns] == ["pierwszy", "tak"]
+            await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_conversation_store_clear_deletes_from_disk():
+    async def scenario():
+        path = os.path.join(tempfile.mkdtemp(), 'conversations.db')
+        store = make_store(path)
+        conversation = await store.get(1)
+        store.window.add_exchange(conversation.turns, "zapamiętaj", "ok")
+        store.touch(1)
+        await store.flush()
+        store.clear(1)
+        assert store.dirty == {1: None}
+        # Wyczyszczona rozmowa jest pusta od razu, bez sięgania po starą wersję z dysku
+        loads = store.loads
+        assert len((await store.get(1)).turns) == 0 and store.loads == loads
+        await store.close()
+
+        reopened = make_store(path)
+        assert len((await reopened.get(1)).turns) == 0
+        await reopened.close()
+
+    asyncio.run(scenario())
+
+
+# === RANKING UŻYTKOWNIKÓW ===
+
+class FakeToday:
+    """Podmienia datetime w bocie - test sam przestawia bieżący dzień"""
+
+    def __init__(self, day):
+        self.saved = bot.datetime
+        clock = self
+
+        class FakeDateTime(self.saved):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.saved.combine(clock.day, clock.saved.min.time(), tz)
+
+        self.day = day
+        self.fake = FakeDateTime
+
+    def advance(self, days: int):
+        self.day += bot.timedelta(days=days)
+
+    def __enter__(self):
+        bot.datetime = self.fake
+        return self
+
+    def __exit__(self, *exc):
+        bot.datetime = self.saved
+
+
+def test_topk_matches_full_sort():
+    import random
+    rng = random.Random(7)
+    top = bot.TopK(5)
+    scores = {}
+    for _ in range(2000):
+        key = rng.randrange(40)
+        scores[key] = scores.get(key, 0) + rng.randint(1, 3)
+        top.update(key, scores[key])
+        expected = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:5]
+        assert top.top(5) == expected
+    assert len(top.scores) == 5 and top.top(2) == expected[:2]
+
+
+def test_leaderboard_rolls_days_and_week():
+    import datetime as dt
+    with FakeToday(dt.date(2026, 3, 2)) as today:
+        board = bot.Leaderboard(size=10, days=7)
+        for count in range(1, 4):
+            board.record(1, 'messages', count)
+        board.record(2, 'messages', 1)
+        assert board.top('today') == [(1, 3), (2, 1)]
+
+        today.advance(1)
+        assert board.top('today') == []
+        board.record(2, 'messages', 2)
+        board.record(2, 'messages', 3)
+        assert board.top('today') == [(2, 2)]
+        assert board.top('week') == [(1, 3), (2, 3)]
+
+        # Pierwszy dzień wypada z okna 7 dni - razem z jedynymi wiadomościami użytkownika 1
+        today.advance(6)
+        assert board.top('week') == [(2, 2)]
+        assert board.counts('week', 1) == {'messages': 0, 'ai_queries': 0}
+        assert 1 not in board.week_counts
+        assert board.top('all') == [(1, 3), (2, 3)]
+
+
+# === STATYSTYKI W CZASIE ===
+
+DAY_START = 86400 * 20000  # początek doby - kubełki wszystkich rozdzielczości wyrównane
+
+
+def test_activity_windows_pick_resolution():
+    with FakeClock(DAY_START) as clock:
+        stats = bot.ActivityStats({'persist': False})
+        stats.record('messages', 2)
+        stats.record('errors', 0)  # zero nie dotyka kubełków
+        clock.advance(120)
+        stats.record('messages', 3)
+        assert stats.window('messages', 60) == 3
+        assert stats.window('messages', 180) == 5
+        assert stats.window('messages', 86400) == 5  # z kubełków godzinowych
+        assert stats.window('messages', 90) == 0  # okno niewyrównane do żadnej rozdzielczości
+        assert stats.total('messages') == 5 and stats.total('errors') == 0
+        assert stats.trend('messages', 120) == "↑ 50%"
+        assert stats.trend('gifs', 120) == "bez zmian"
+        assert stats.trend('messages', 60) == "nowe"
+
+
+def test_activity_ring_ignores_stale_slots():
+    with FakeClock(DAY_START) as clock:
+        stats = bot.ActivityStats({'persist': False})
+        stats.record('messages', 5)
+        clock.advance(180 * 60)  # pełny obieg pierścienia minutowego - ten sam indeks kubełka
+        assert stats.window('messages', 60) == 0
+        stats.record('messages', 1)
+        assert stats.window('messages', 60) == 1
+        assert stats.window('messages', 180 * 60) == 1
+        assert stats.window('messages', 4 * 3600) == 6
+        assert stats.total('messages') == 6
+
+
+def test_activity_snapshot_round_trip():
+    path = os.path.join(tempfile.mkdtemp(), 'activity_stats.json')
+    with FakeClock(DAY_START) as clock:
+        stats = bot.ActivityStats({'file': path})
+        stats.record('messages', 4)
+        stats.record('output_tokens', 120)
+        asyncio.run(stats.save())
+
+        clock.advance(60)
+        restored = bot.ActivityStats({'file': path})
+        restored.load()
+        assert restored.total('messages') == 4 and restored.total('output_tokens') == 120
+        assert restored.window('messages', 120) == 4
+        assert restored.first_start == DAY_START
+
+        # Inny zestaw metryk - sumy przepisane po nazwach, kubełki pominięte
+        with open(path, 'r', encoding='utf-8') as f:
+            stored = json.load(f)
+        stored['metrics'] = ['messages', 'legacy_metric']
+        stored['totals'] = [9, 1]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(stored, f)
+        migrated = bot.ActivityStats({'file': path})
+        migrated.load()
+        assert migrated.total('messages') == 9 and migrated.total('output_tokens') == 0
+        assert migrated.window('messages', 120) == 0
+
+
+# === CZŁONKOSTWO W KANALE ===
+
+def test_membership_cache_ttls_per_outcome():
+    with FakeClock() as clock:
+        cache = bot.MembershipCache({'ttl_minutes': 10, 'negative_ttl_minutes': 2, 'error_ttl_seconds': 30})
+        cache.put(1, True)
+        cache.put(2, False)
+        cache.put_error(3)
+        assert (cache.get(1), cache.get(2), cache.get(3)) == (True, False, False)
+        clock.advance(30)
+        assert cache.get(3) is None  # błąd pamiętany najkrócej
+        clock.advance(90)
+        assert cache.get(2) is None and cache.get(1) is True
+        clock.advance(480)
+        assert cache.get(1) is None
+        assert cache.stats()['errors'] == 1 and cache.stats()['misses'] == 3
+
+
+def test_membership_cache_update_and_lru_bound():
+    cache = bot.MembershipCache({'max_entries': 2})
+    cache.put_error(1)
+    cache.update(1, True)  # update chat_member zastępuje wpis po błędzie od razu
+    assert cache.get(1) is True and cache.invalidations == 1
+    cache.put(2, True)
+    cache.get(1)
+    cache.put(3, False)
+    assert list(cache.entries) == [1, 3]
+
+
+# === PULE GIF-ÓW GIPHY ===
+
+def test_gif_pools_refresh_and_max_age():
+    with FakeClock() as clock:
+        pools = bot.GifPools({'pool_refresh_hours': 1, 'pool_max_age_hours': 3, 'persist_pools': False})
+        assert pools.get("kot") == (None, True)
+        pools.put("Kot  ", ["a.gif", "b.gif"])
+        assert pools.get("  KOT") == (["a.gif", "b.gif"], False)
+        clock.advance(3600)
+        assert pools.get("kot") == (["a.gif", "b.gif"], True)  # serwowana, odświeżenie w tle
+        clock.advance(2 * 3600)
+        assert pools.get("kot") == (None, True)
+        assert pools.stale("kot") == ["a.gif", "b.gif"]  # awaryjnie mimo wieku
+
+
+def test_gif_pools_lru_bound_and_persistence():
+    path = os.path.join(tempfile.mkdtemp(), 'giphy_pools.json')
+    with FakeClock() as clock:
+        config = {'max_pools': 2, 'pool_max_age_hours': 1, 'pools_file': path}
+        pools = bot.GifPools(config)
+        pools.put("pies", ["pies.gif"])
+        pools.put("kot", ["kot.gif"])
+        clock.advance(3000)
+        pools.get("pies")
+        pools.put("żółw", ["żółw.gif"])
+        assert list(pools.pools) == ["pies", "żółw"]
+        pools.save()
+
+        clock.advance(1000)  # pula "pies" przekroczyła max_age - nie wraca z dysku
+        restored = bot.GifPools(config)
+        restored.load()
+        assert list(restored.pools) == ["żółw"] and restored.stale("żółw") == ["żółw.gif"]
+
+
+def test_background_saver_serializes_and_coalesces_saves():
+    import threading
+    import time as real_time
+
+    async def scenario():
+        state = {'running': 0, 'overlaps': 0, 'calls': 0}
+        lock = threading.Lock()
+
+        def slow_save():
+            with lock:
+                state['calls'] += 1
+                state['running'] += 1
+                state['overlaps'] += state['running'] > 1
+            real_time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+
+        saver = bot.BackgroundSaver(slow_save)
+        saver.schedule()
+        await asyncio.sleep(0.01)
+        for _ in range(5):
+            saver.schedule()  # w trakcie zapisu - jeden wspólny kolejny zapis
+        await saver.task
+        assert state == {'running': 0, 'overlaps': 0, 'calls': 2}
+
+        saver.schedule()
+        await saver.close()  # czeka na trwający zapis, potem zapisuje ostatni stan
+        assert state['calls'] == 4 and state['overlaps'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_refresh_gif_pool_persists_pool():
+    async def scenario():
+        smart_bot = make_bot()
+        smart_bot.gif_pools.persist = True
+        smart_bot.gif_pools.file = os.path.join(tempfile.mkdtemp(), 'giphy_pools.json')
+
+        async def search_giphy(query):
+            return ["kot.gif"]
+
+        smart_bot.search_giphy = search_giphy
+        assert await smart_bot.refresh_gif_pool("kot") == ["kot.gif"]
+        await smart_bot.gif_pools.saver.task
+        with open(smart_bot.gif_pools.file, 'r', encoding='utf-8') as f:
+            assert [(key, urls) for key, _, urls in json.load(f)] == [("kot", ["kot.gif"])]
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+# === FILE_ID ANIMACJI ===
+
+class AnimationMessage:
+    """Wiadomość, na którą bot odpowiada GIF-em - Telegram nadaje kolejne file_id"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def reply_animation(self, animation, **kwargs):
+        self.sent.append(animation)
+        return type('Sent', (), {'animation': type('Animation', (), {'file_id': f"id-{len(self.sent)}"})()})()
+
+
+def test_animation_file_ids_saved_once_at_a_time():
+    async def scenario():
+        smart_bot = make_bot()
+        ids = smart_bot.animation_ids
+        ids.file = os.path.join(tempfile.mkdtemp(), 'animation_file_ids.json')
+        ids.save_every = 1
+        message = AnimationMessage()
+        for url in ("a.gif", "b.gif", "c.gif"):
+            await smart_bot.send_animation(message, url)  # każdy upload prosi o zapis
+        await ids.saver.task
+        with open(ids.file, 'r', encoding='utf-8') as f:
+            assert json.load(f) == [["a.gif", "id-1"], ["b.gif", "id-2"], ["c.gif", "id-3"]]
+
+        await smart_bot.send_animation(message, "a.gif")
+        assert message.sent[-1] == "id-1" and ids.reused == 1
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+# === HARMONOGRAM ZAPYTAŃ GEMINI ===
+
+async def hold_slot(scheduler, chat_key, lane, order, release):
+    async with scheduler.slot(chat_key, lane):
+        order.append((chat_key, lane))
+        await release.wait()
+
+
+def test_scheduler_limits_concurrency():
+    async def scenario():
+        scheduler = bot.GeminiScheduler({'max_concurrent': 2})
+        order, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(hold_slot(scheduler, chat, bot.LANE_DIRECT, order, release)) for chat in range(5)]
+        await asyncio.sleep(0.01)
+        assert scheduler.active == 2 and len(order) == 2
+        assert scheduler.stats()['lanes']['direct']['queued'] == 3
+        release.set()
+        await asyncio.gather(*tasks)
+        assert scheduler.active == 0 and len(order) == 5
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_serves_higher_priority_lane_first():
+    async def scenario():
+        scheduler = bot.GeminiScheduler({'max_concurrent': 1})
+        order, release = [], asyncio.Event()
+        blocker = asyncio.create_task(hold_slot(scheduler, 0, bot.LANE_DIRECT, order, release))
+        await asyncio.sleep(0)
+        waiting = []
+        for lane in (bot.LANE_BACKGROUND, bot.LANE_AMBIENT, bot.LANE_ADMIN):
+            waiting.append(asyncio.create_task(hold_slot(scheduler, 1, lane, order, release)))
+            await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, *waiting)
+        assert [lane for _, lane in order] == [bot.LANE_DIRECT, bot.LANE_ADMIN, bot.LANE_AMBIENT, bot.LANE_BACKGROUND]
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_is_fair_between_chats():
+    async def scenario():
+        scheduler = bot.GeminiScheduler({'max_concurrent': 1})
+        order, release = [], asyncio.Event()
+        blocker = asyncio.create_task(hold_slot(scheduler, 0, bot.LANE_DIRECT, order, release))
+        await asyncio.sleep(0)
+        # Zalany czat 'A' (3 zapytania) nie wypycha czatu 'B', który przyszedł później
+        waiting = []
+        for chat in (1, 1, 1, 2):
+            waiting.append(asyncio.create_task(hold_slot(scheduler, chat, bot.LANE_DIRECT, order, release)))
+            await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, *waiting)
+        assert [chat for chat, _ in order] == [0, 1, 2, 1, 1]
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_cancelled_waiter_does_not_leak_slot():
+    async def scenario():
+        scheduler = bot.GeminiScheduler({'max_concurrent': 1})
+        order, release = [], asyncio.Event()
+        blocker = asyncio.create_task(hold_slot(scheduler, 0, bot.LANE_DIRECT, order, release))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(hold_slot(scheduler, 1, bot.LANE_DIRECT, order, release))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        await blocker
+        assert scheduler.active == 0
+        await asyncio.wait_for(hold_slot(scheduler, 2, bot.LANE_DIRECT, order, release), 1)
+        assert [chat for chat, _ in order] == [0, 2]
+
+    asyncio.run(scenario())
+
+
+# === BACKENDY MODELU ===
+
+class FakeGeminiResponse:
+    """Odpowiedź aiohttp z zadanymi liniami SSE (albo ciałem JSON)"""
+
+    def __init__(self, lines=(), status=200, body=b''):
+        self.status = status
+        self.lines = lines
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    def content(self):
+        async def iterate():
+            for line in self.lines:
+                yield line
+        return iterate()
+
+    async def text(self):
+        return self.body.decode('utf-8')
+
+    async def json(self):
+        return json.loads(self.body)
+
+
+def make_gemini_backend(response):
+    async def post(method, payload, build_inline_payload):
+        return response
+    return bot.GeminiRestBackend({}, post, lambda *args: None)
+
+
+def sse(text):
+    return ("data: " + json.dumps({'candidates': [{'content': {'parts': [{'text': text}]}}]}) + "\n").encode('utf-8')
+
+
+async def consume(iterator, limit=None):
+    chunks = []
+    async for chunk in iterator:
+        chunks.append(chunk)
+        if limit is not None and len(chunks) >= limit:
+            break
+    return chunks
+
+
+def test_model_backend_is_abstract():
+    try:
+        bot.ModelBackend({})
+    except TypeError:
+        return
+    raise AssertionError("ModelBackend powinien być abstrakcyjny")
+
+
+def test_gemini_stream_records_success():
+    backend = make_gemini_backend(FakeGeminiResponse([sse("Siema"), b"\n", sse(" stary")]))
+    assert asyncio.run(consume(backend.stream({}, None))) == ["Siema", " stary"]
+    assert (backend.calls, backend.errors) == (1, 0)
+
+
+def test_gemini_stream_records_broken_stream():
+    backend = make_gemini_backend(FakeGeminiResponse([sse("Siema"), b"data: {niepoprawny json\n"]))
+    try:
+        asyncio.run(consume(backend.stream({}, None)))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("oczekiwany błąd JSON")
+    assert (backend.calls, backend.errors) == (1, 1)
+
+
+def test_gemini_stream_records_empty_stream_as_error():
+    backend = make_gemini_backend(FakeGeminiResponse([b": keep-alive\n"]))
+    assert asyncio.run(consume(backend.stream({}, None))) == []
+    assert (backend.calls, backend.errors) == (1, 1)
+
+
+def test_gemini_stream_records_abandoned_consumer():
+    async def scenario():
+        backend = make_gemini_backend(FakeGeminiResponse([sse("a"), sse("b"), sse("c")]))
+        stream = backend.stream({}, None)
+        assert await consume(stream, limit=1) == ["a"]
+        await stream.aclose()
+        return backend
+
+    backend = asyncio.run(scenario())
+    assert (backend.calls, backend.errors) == (1, 0)
+
+
+def test_gemini_stream_records_http_error():
+    backend = make_gemini_backend(FakeGeminiResponse(status=429, body=b'quota'))
+    try:
+        asyncio.run(consume(backend.stream({}, None)))
+    except bot.ModelBackendError as e:
+        assert e.error == "rate_limit"
+    else:
+        raise AssertionError("oczekiwany ModelBackendError")
+    assert (backend.calls, backend.errors) == (1, 1)
+
+
+def test_gemini_generate_records_bad_json():
+    backend = make_gemini_backend(FakeGeminiResponse(body=b'<html>'))
+    try:
+        asyncio.run(backend.generate({}, None))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("oczekiwany błąd JSON")
+    assert (backend.calls, backend.errors) == (1, 1)
+
+
+def test_fake_backend_is_deterministic():
+    config = {'seed': 7, 'latency_ms': {'distribution': 'fixed', 'median': 0}}
+    first = asyncio.run(bot.FakeModelBackend(config).generate({'contents': []}, None))
+    second = asyncio.run(bot.FakeModelBackend(config).generate({'contents': []}, None))
+    assert first.text == second.text and first.output_tokens == second.output_tokens
+
+
+# === STRUMIENIOWANIE ODPOWIEDZI ===
+
+def make_bot(**overrides):
+    """Bot na atrapie modelu, bez zapisu na dysk i bez limitów"""
+    with open(os.path.join(os.path.dirname(BOT_FILE), 'bot_config.json'), 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    config['bot_token'] = '123456:TEST'
+    config['limits'] = {}
+    config.setdefault('response_cache', {})['persist'] = False
+    config.setdefault('conversation_store', {})['enabled'] = False
+    config.setdefault('activity_stats', {})['persist'] = False
+    config['model_backend'] = {'type': 'fake', 'fake': {
+        'latency_ms': {'distribution': 'fixed', 'median': 0}, 'output_tokens': [40, 40],
+        'stream_chunk_tokens': 4, 'stream_chunk_delay_ms': 5
+    }}
+    config.update(overrides)
+    return bot.SmartAIBot(config)
+
+
+def test_stream_releases_scheduler_slot_before_slow_consumer_finishes():
+    async def scenario():
+        smart_bot = make_bot()
+        stream = smart_bot.query_gemini_stream("hej", None, 1, 1)
+        chunks = [await stream.__anext__()]
+        await asyncio.sleep(0.2)  # odbiorca "edytuje wiadomość", model w tym czasie kończy
+        assert smart_bot.gemini_scheduler.active == 0
+        chunks += [chunk async for chunk in stream]
+        assert len(chunks) == 11  # 40 słów + emotka po 4 słowa
+        assert smart_bot.model_backend.calls == 1
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_stream_abandoned_by_consumer_releases_slot():
+    async def scenario():
+        smart_bot = make_bot()
+        smart_bot.model_backend.chunk_delay = 1.0
+        stream = smart_bot.query_gemini_stream("hej", None, 1, 1)
+        await stream.__anext__()
+        assert smart_bot.gemini_scheduler.active == 1
+        await stream.aclose()
+        await asyncio.sleep(0)
+        assert smart_bot.gemini_scheduler.active == 0
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+class EditedMessage:
+    """Wiadomość, której edycje kończą się kolejno zadanymi wyjątkami"""
+
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.edits = []
+
+    async def edit_text(self, text, parse_mode=None, **kwargs):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.edits.append((text, parse_mode))
+
+
+def test_final_streamed_edit_retries_until_success():
+    from telegram.error import BadRequest, RetryAfter
+
+    async def scenario():
+        smart_bot = make_bot()
+        message = EditedMessage([RetryAfter(0), RetryAfter(0), RetryAfter(0)])
+        await smart_bot.finish_streamed_reply(None, message, "*gotowe*", 'none', '', 1)
+        assert message.edits == [("*gotowe*", bot.ParseMode.MARKDOWN)]
+
+        message = EditedMessage([BadRequest("Can't parse entities"), RetryAfter(0)])
+        await smart_bot.finish_streamed_reply(None, message, "*gotowe", 'none', '', 1)
+        assert message.edits == [("*gotowe", None)]
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_final_streamed_edit_gives_up_on_sustained_retry_after():
+    from telegram.error import RetryAfter
+
+    async def scenario():
+        smart_bot = make_bot()
+        message = EditedMessage([RetryAfter(0)] * 10)
+        await smart_bot.finish_streamed_reply(None, message, "*gotowe*", 'none', '', 1)
+        assert message.edits == [] and len(message.failures) == 10 - smart_bot.streaming_config['final_edit_max_attempts']
+
+        # Limit dłuższy niż pozostały budżet czekania - bez spania, od razu rezygnacja
+        smart_bot.streaming_config['final_edit_max_wait'] = 0.5
+        message = EditedMessage([RetryAfter(1), RetryAfter(1)])
+        await smart_bot.finish_streamed_reply(None, message, "*gotowe*", 'none', '', 1)
+        assert message.edits == [] and len(message.failures) == 1
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+# === ODPORNOŚĆ KLIENTA GEMINI ===
+
+def test_circuit_breaker_opens_and_allows_one_trial():
+    with FakeClock() as clock:
+        breaker = bot.CircuitBreaker(failure_threshold=2, cooldown=30)
+        breaker.record_failure()
+        assert breaker.state == 'closed' and breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == 'open' and not breaker.allow()
+        clock.advance(30)
+        assert breaker.state == 'half_open'
+        assert breaker.allow() and not breaker.allow()  # tylko jedno próbne zapytanie
+        breaker.record_failure()  # nieudana próba - znowu pełny cooldown
+        assert breaker.state == 'open' and breaker.times_opened == 2
+        clock.advance(30)
+        assert breaker.allow()
+        breaker.record_success()
+        assert breaker.state == 'closed' and breaker.allow() and breaker.allow()
+
+
+def test_post_gemini_cancelled_trial_releases_breaker():
+    async def scenario():
+        smart_bot = make_bot()
+        started = asyncio.Event()
+
+        async def send_gemini(method, model, payload, build_inline_payload):
+            started.set()
+            await asyncio.Event().wait()  # zapytanie wisi, aż odbiorca zrezygnuje
+
+        smart_bot.send_gemini = send_gemini
+        with FakeClock() as clock:
+            breaker = smart_bot.gemini_breaker(smart_bot.gemini_config['model'])
+            for _ in range(breaker.failure_threshold):
+                breaker.record_failure()
+            clock.advance(breaker.cooldown)
+            request = asyncio.create_task(smart_bot.post_gemini('generateContent', {}, None))
+            await started.wait()
+            assert breaker.trial_in_progress
+            request.cancel()
+            try:
+                await request
+            except asyncio.CancelledError:
+                pass
+            assert breaker.state == 'half_open' and not breaker.trial_in_progress
+            assert breaker.allow()
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+class FakePostResponse:
+    """Odpowiedź session.post - pamięta, czy połączenie wróciło do puli"""
+
+    def __init__(self, status=200, headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self.released = False
+
+    async def read(self):
+        return b''
+
+    def release(self):
+        self.released = True
+
+
+def make_resilient_bot(**resilience):
+    smart_bot = make_bot()
+    smart_bot.gemini_resilience.update({'backoff_base': 0.001, 'backoff_max': 0.001, **resilience})
+    return smart_bot
+
+
+def test_post_gemini_retries_then_succeeds():
+    async def scenario():
+        smart_bot = make_resilient_bot(max_retries=2)
+        statuses = [503, 500, 200]
+
+        async def send_gemini(method, model, payload, build_inline_payload):
+            return FakePostResponse(statuses.pop(0))
+
+        smart_bot.send_gemini = send_gemini
+        response = await smart_bot.post_gemini('generateContent', {}, None)
+        assert response.status == 200 and smart_bot.gemini_client_stats['retries'] == 2
+        assert smart_bot.gemini_breaker(smart_bot.gemini_config['model']).failures == 0
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_post_gemini_long_retry_after_switches_to_fallback():
+    async def scenario():
+        smart_bot = make_resilient_bot(max_retries=2, max_retry_after=20)
+        smart_bot.gemini_config['fallback_model'] = 'zapasowy'
+        calls = []
+
+        async def send_gemini(method, model, payload, build_inline_payload):
+            calls.append(model)
+            if model == 'zapasowy':
+                return FakePostResponse(200)
+            return FakePostResponse(429, {'Retry-After': '60'})
+
+        smart_bot.send_gemini = send_gemini
+        response = await smart_bot.post_gemini('generateContent', {}, None)
+        assert response.status == 200 and calls == [smart_bot.gemini_config['model'], 'zapasowy']
+        assert smart_bot.gemini_client_stats['fallbacks'] == 1 and smart_bot.gemini_client_stats['retries'] == 0
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_post_gemini_raises_last_connection_error():
+    async def scenario():
+        smart_bot = make_resilient_bot(max_retries=1)
+
+        async def send_gemini(method, model, payload, build_inline_payload):
+            raise aiohttp.ClientConnectionError("brak sieci")
+
+        smart_bot.send_gemini = send_gemini
+        try:
+            await smart_bot.post_gemini('generateContent', {}, None)
+            assert False, "oczekiwano ClientConnectionError"
+        except aiohttp.ClientConnectionError:
+            pass
+        assert smart_bot.gemini_breaker(smart_bot.gemini_config['model']).failures == 2
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+class FakeSession:
+    """session.post z zadanym opóźnieniem kolejnych zapytań; liczy anulowane"""
+
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.responses = []
+        self.cancelled = 0
+
+    async def post(self, url, json=None, timeout=None):
+        delay = self.delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        response = FakePostResponse(200)
+        self.responses.append(response)
+        return response
+
+
+def make_hedging_bot():
+    smart_bot = make_resilient_bot(hedge_enabled=True, hedge_min_samples=1)
+    smart_bot.gemini_latency['model'] = bot.LatencyWindow()
+    smart_bot.gemini_latency['model'].add(0.05)
+    return smart_bot
+
+
+def test_hedged_post_takes_faster_request():
+    async def scenario():
+        smart_bot = make_hedging_bot()
+        session = FakeSession([1.0, 0.0])
+        response = await smart_bot.hedged_post(session, 'url', {}, 'model')
+        assert response is session.responses[0] and smart_bot.gemini_client_stats['hedge_wins'] == 1
+        await asyncio.sleep(0)
+        assert session.cancelled == 1  # wolniejsze zapytanie anulowane
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_hedged_post_cancelled_caller_abandons_requests():
+    async def scenario():
+        smart_bot = make_hedging_bot()
+        session = FakeSession([1.0, 1.0])
+        request = asyncio.create_task(smart_bot.hedged_post(session, 'url', {}, 'model'))
+        await asyncio.sleep(0.1)
+        assert smart_bot.gemini_client_stats['hedged'] == 1
+        request.cancel()
+        try:
+            await request
+        except asyncio.CancelledError:
+            pass
+        await asyncio.sleep(0)
+        assert session.cancelled == 2 and not session.responses
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_abandon_posts_releases_late_response():
+    async def scenario():
+        response = FakePostResponse(200)
+
+        async def post():
+            return response
+
+        task = asyncio.ensure_future(post())
+        await asyncio.sleep(0)  # odpowiedź przyszła, zanim ktokolwiek ją odebrał
+        bot.abandon_posts({task})
+        await asyncio.sleep(0)
+        assert response.released
+
+    asyncio.run(scenario())
+
+
+# === CACHE KONTEKSTU GEMINI ===
+
+class FakeGeminiServer:
+    """Lokalny zastępca API Gemini (aiohttp) - cachedContents i generateContent"""
+
+    def __init__(self, create_status=200, reject_cached_status=None):
+        self.create_status = create_status
+        self.reject_cached_status = reject_cached_status
+        self.created = 0
+        self.patched = []
+        self.generate_payloads = []
+        self.server = None
+
+    async def create_cache(self, request):
+        if self.create_status != 200:
+            return web.json_response({'error': {'message': 'za krótki prompt'}}, status=self.create_status)
+        self.created += 1
+        return web.json_response({'name': f'cachedContents/{self.created}'})
+
+    async def patch_cache(self, request):
+        self.patched.append((request.match_info['name'], (await request.json())['ttl']))
+        return web.json_response({})
+
+    async def generate(self, request):
+        payload = await request.json()
+        self.generate_payloads.append(payload)
+        if 'cachedContent' in payload and self.reject_cached_status:
+            return web.json_response({'error': {'message': 'CachedContent not found'}}, status=self.reject_cached_status)
+        return web.json_response({'candidates': [{'content': {'parts': [{'text': 'ok'}]}}]})
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post('/v1beta/cachedContents', self.create_cache)
+        app.router.add_patch('/v1beta/cachedContents/{name}', self.patch_cache)
+        app.router.add_post('/v1beta/models/{call}', self.generate)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return str(self.server.make_url('/v1beta'))
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+
+def test_context_cache_creates_and_refreshes_before_ttl():
+    async def scenario():
+        fake = FakeGeminiServer()
+        async with fake as base_url, aiohttp.ClientSession() as session:
+            with FakeClock() as clock:
+                config = {'enabled': True, 'ttl_seconds': 100, 'refresh_before_expiry': 30}
+                cache = bot.GeminiContextCache(config, base_url, 'KLUCZ', 'gemini-test', 'osobowość')
+                assert cache.current_name(session) is None  # pierwsze zapytanie nie czeka na rejestrację
+                await cache._refresh_task
+                assert cache.name == 'cachedContents/1' and fake.created == 1
+
+                clock.advance(60)
+                assert cache.current_name(session) == 'cachedContents/1'
+                assert cache._refresh_task.done() and not fake.patched
+
+                clock.advance(15)  # 25 s do wygaśnięcia - odświeżenie w tle, cache nadal używany
+                assert cache.current_name(session) == 'cachedContents/1'
+                await cache._refresh_task
+                assert fake.patched == [('1', '100s')] and fake.created == 1
+                assert cache.expires_at == clock.now + 100
+                assert (cache.cached_requests, cache.inline_requests) == (2, 1)
+
+    asyncio.run(scenario())
+
+
+def test_context_cache_creation_failure_falls_back_to_inline():
+    async def scenario():
+        fake = FakeGeminiServer(create_status=400)
+        async with fake as base_url, aiohttp.ClientSession() as session:
+            with FakeClock() as clock:
+                config = {'enabled': True, 'retry_after_failure': 600}
+                cache = bot.GeminiContextCache(config, base_url, 'KLUCZ', 'gemini-test', 'osobowość')
+                cache.current_name(session)
+                await cache._refresh_task
+                failed_task = cache._refresh_task
+                assert cache.name is None and cache.disabled_until == clock.now + 600
+                clock.advance(599)
+                assert cache.current_name(session) is None and cache._refresh_task is failed_task
+                clock.advance(1)
+                cache.current_name(session)
+                assert cache._refresh_task is not failed_task
+                await cache._refresh_task
+
+    asyncio.run(scenario())
+
+
+def test_send_gemini_retries_inline_when_cache_rejected():
+    async def scenario():
+        for status in (400, 403, 404):
+            fake = FakeGeminiServer(reject_cached_status=status)
+            async with fake as base_url:
+                smart_bot = make_bot()
+                smart_bot.gemini_base_url = base_url
+                smart_bot.context_cache.name = 'cachedContents/1'
+
+                async def build_inline_payload():
+                    return {'contents': [{'role': 'user', 'parts': [{'text': 'osobowość + pytanie'}]}]}
+
+                payload = {'cachedContent': 'cachedContents/1', 'contents': []}
+                response = await smart_bot.send_gemini('generateContent', 'gemini-test', payload, build_inline_payload)
+                assert response.status == 200
+                response.release()
+                assert [('cachedContent' in sent) for sent in fake.generate_payloads] == [True, False]
+                assert smart_bot.context_cache.name is None
+                assert smart_bot.context_cache.disabled_until > bot.time.monotonic()
+                await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_send_gemini_keeps_cache_on_server_error():
+    async def scenario():
+        fake = FakeGeminiServer(reject_cached_status=503)
+        async with fake as base_url:
+            smart_bot = make_bot()
+            smart_bot.gemini_base_url = base_url
+            smart_bot.context_cache.name = 'cachedContents/1'
+            payload = {'cachedContent': 'cachedContents/1', 'contents': []}
+            response = await smart_bot.send_gemini('generateContent', 'gemini-test', payload, None)
+            # Błąd przejściowy nie świadczy o cache - ponowienie zostawiamy post_gemini
+            assert response.status == 503 and len(fake.generate_payloads) == 1
+            response.release()
+            assert smart_bot.context_cache.name == 'cachedContents/1'
+            await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+# === PODSUMOWANIA ROZMÓW ===
+
+def make_summarizing_bot():
+    smart_bot = make_bot()
+    smart_bot.conversation_window.max_messages = 2  # każda kolejna wymiana wypycha poprzednią
+    return smart_bot
+
+
+async def finish_summaries(smart_bot):
+    await asyncio.gather(*smart_bot.summary_tasks.values())
+    await asyncio.sleep(0)  # callbacki zakończonych zadań
+
+
+def test_summary_task_is_forgotten_when_done():
+    async def scenario():
+        smart_bot = make_summarizing_bot()
+        await smart_bot.remember_exchange(1, "pytanie 1", "odpowiedź 1")
+        await smart_bot.remember_exchange(1, "pytanie 2", "odpowiedź 2")
+        assert 1 in smart_bot.summary_tasks
+        await finish_summaries(smart_bot)
+        assert smart_bot.summary_tasks == {} and smart_bot.pending_summary_turns == {}
+        assert (await smart_bot.conversation_store.get(1)).summary
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_failed_summary_requeues_turns_for_next_batch():
+    async def scenario():
+        smart_bot = make_summarizing_bot()
+        generate = smart_bot.model_backend.generate
+        prompts = []
+
+        async def failing_generate(payload, build_inline_payload):
+            return bot.ModelResponse(status=503, error='server_error')
+
+        async def recording_generate(payload, build_inline_payload):
+            prompts.append(payload['contents'][0]['parts'][0]['text'])
+            return await generate(payload, build_inline_payload)
+
+        smart_bot.model_backend.generate = failing_generate
+        await smart_bot.remember_exchange(1, "pytanie 1", "odpowiedź 1")
+        await smart_bot.remember_exchange(1, "pytanie 2", "odpowiedź 2")
+        await finish_summaries(smart_bot)
+        assert [turn.text for turn in smart_bot.pending_summary_turns[1]] == ["pytanie 1", "odpowiedź 1"]
+
+        smart_bot.model_backend.generate = recording_generate
+        await smart_bot.remember_exchange(1, "pytanie 3", "odpowiedź 3")
+        await finish_summaries(smart_bot)
+        assert len(prompts) == 1 and "pytanie 1" in prompts[0] and "pytanie 2" in prompts[0]
+        assert smart_bot.pending_summary_turns == {} and smart_bot.summary_tasks == {}
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_evicted_conversation_drops_pending_summary():
+    async def scenario():
+        smart_bot = make_summarizing_bot()
+
+        async def failing_generate(payload, build_inline_payload):
+            raise RuntimeError("model niedostępny")
+
+        smart_bot.model_backend.generate = failing_generate
+        await smart_bot.remember_exchange(1, "pytanie 1", "odpowiedź 1")
+        await smart_bot.remember_exchange(1, "pytanie 2", "odpowiedź 2")
+        await finish_summaries(smart_bot)
+        assert 1 in smart_bot.pending_summary_turns
+        smart_bot.conversation_store.max_hot_users = 0
+        smart_bot.conversation_store.evict()
+        assert smart_bot.pending_summary_turns == {}
+        await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+# === EKSPORT METRYK ===
+
+def test_shared_metrics_file_follows_bot_config():
+    import metrics_bridge
+    workdir = tempfile.mkdtemp()
+    config_file = os.path.join(workdir, 'bot_config.json')
+    metrics_file = os.path.join(workdir, 'custom.prom')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        json.dump({'metrics_export': {'file': metrics_file}}, f)
+    previous = os.environ.pop(metrics_bridge.METRICS_FILE_ENV, None)
+    try:
+        assert metrics_bridge.share_metrics_file(config_file) == metrics_file
+        # Bot dziedziczy zmienną - nawet z inną ścieżką w swojej konfiguracji pisze do pliku serwera
+        exporter = bot.MetricsExporter({'file': '/inna/sciezka.prom'}, lambda: "smartai_up 1\n")
+        assert exporter.file == metrics_file
+        asyncio.run(exporter.publish())
+        assert metrics_bridge.read_metrics().startswith("smartai_up 1\n")
+    finally:
+        os.environ.pop(metrics_bridge.METRICS_FILE_ENV, None)
+        if previous is not None:
+            os.environ[metrics_bridge.METRICS_FILE_ENV] = previous
+
+
+# === POGODA ===
+
+def test_normalize_place():
+    assert bot.normalize_place('  ŁÓDŹ ') == 'lodz'
+    assert bot.normalize_place('Kraków!') == 'krakow'
+    assert bot.normalize_place('Bielsko-Biała') == 'bielsko-biala'
+    assert bot.place_key('Bielsko-Biała') == 'bielsko biala'
+
+
+def test_weather_detector_finds_anchored_cities():
+    detector = bot.WeatherIntentDetector(bot.WEATHER_CITIES)
+    assert detector.detect("Jaka jest pogoda w Warszawie?") == "Warszawa"
+    assert detector.detect("wrocław pogoda") == "Wrocław"
+    assert detector.detect("temperatura Łódź") == "Łódź"
+    assert detector.detect("jaka pogoda jutro w nowym jorku") == "New York"
+    assert detector.detect("prognoza dla Bielska-Białej") == "Bielsko-Biała"
+    assert detector.detect("pogoda w Mediolanie") == "Milan"
+
+
+def test_weather_detector_ignores_chatter_and_ambiguous_names():
+    detector = bot.WeatherIntentDetector(bot.WEATHER_CITIES)
+    for text in ["wkurza mnie ta pogoda", "pogoda do dupy dzisiaj", "siema co tam",
+                 "pogodny dzień w Krakowie", "muszę się pogodzić z Kasią w Gdańsku",
+                 "Milan mówi, że pogoda jest super", "Nice pogoda dziś", "Porto pogoda",
+                 "Kraków to fajne miasto, pogoda tam taka sobie",
+                 "temperatura w piekarniku 200 stopni"]:
+        assert detector.detect(text) is None, text
+
+
+def test_weather_detector_uses_known_locations():
+    detector = bot.WeatherIntentDetector(bot.WEATHER_CITIES)
+    known = {'ketrzyn': 'Kętrzyn', 'milan': 'Milan'}.get
+    assert detector.detect("pogoda Kętrzyn", known) == "Kętrzyn"
+    assert detector.detect("Kętrzyn ładny, ale pogoda kiepska", known) is None
+    assert detector.detect("pogoda Milan", known) is None
+
+
+def test_weather_detector_recognises_hyphenated_cached_city():
+    path = os.path.join(tempfile.mkdtemp(), 'weather_locations.json')
+    cache = bot.LocationKeyCache({'locations_file': path})
+    cache.put("Kędzierzyn-Koźle", ["264475", "Kędzierzyn-Koźle", "Polska"])
+    detector = bot.WeatherIntentDetector(bot.WEATHER_CITIES)
+    assert detector.detect("pogoda Kędzierzyn-Koźle", cache.known) == "Kędzierzyn-Koźle"
+    assert cache.get("kedzierzyn kozle")[0]
+
+    # Plik z kluczami sprzed zmiany (z myślnikiem) - klucze przeliczane przy wczytaniu
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([["bielsko-biala", bot.time.time(), ["2696", "Bielsko-Biała", "Polska"]]], f)
+    restored = bot.LocationKeyCache({'locations_file': path})
+    restored.load()
+    assert detector.detect("jaka pogoda w Bielsko-Biała?", restored.known) == "Bielsko-Biała"
+
+
+def test_location_key_cache_negative_ttl_and_persistence():
+    path = os.path.join(tempfile.mkdtemp(), 'weather_locations.json')
+    with FakeClock() as clock:
+        config = {'locations_file': path, 'location_ttl_days': 1, 'negative_ttl_hours': 1}
+        cache = bot.LocationKeyCache(config)
+        cache.put("Kraków", ["274455", "Kraków", "Polska"])
+        cache.put("Atlantyda", None)
+        assert cache.get("krakow") == (True, ["274455", "Kraków", "Polska"])
+        assert cache.get("ATLANTYDA") == (True, None)  # miasto nieznane AccuWeather też jest trafieniem
+        assert cache.known("krakow") == "Kraków" and cache.known("atlantyda") is None
+        cache.save()
+
+        clock.advance(3600)
+        assert cache.get("atlantyda") == (False, None)
+        restored = bot.LocationKeyCache(config)
+        restored.load()
+        assert list(restored.entries) == ["krakow"]
+        clock.advance(86400)
+        assert restored.get("Kraków") == (False, None)
+
+
+class FakeAccuWeatherServer:
+    """Lokalny zastępca AccuWeather (aiohttp) - wyszukiwarka miast i aktualne warunki"""
+
+    CITIES = {'krakow': ['274455', 'Kraków', 'Polska'], 'gdansk': ['275174', 'Gdańsk', 'Polska']}
+
+    def __init__(self):
+        self.searches = []
+        self.server = None
+
+    async def search(self, request):
+        query = request.query['q']
+        self.searches.append(query)
+        location = self.CITIES.get(bot.place_key(query))
+        if location is None:
+            return web.json_response([])
+        return web.json_response([{'Key': location[0], 'LocalizedName': location[1], 'Country': {'LocalizedName': location[2]}}])
+
+    async def conditions(self, request):
+        return web.json_response([{
+            'Temperature': {'Metric': {'Value': 21}}, 'RealFeelTemperature': {'Metric': {'Value': 23}},
+            'RelativeHumidity': 40, 'WeatherText': 'Słonecznie',
+            'Wind': {'Speed': {'Metric': {'Value': 9}}, 'Direction': {'Localized': 'W'}}
+        }])
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get('/locations/v1/cities/search', self.search)
+        app.router.add_get('/currentconditions/v1/{key}', self.conditions)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return str(self.server.make_url(''))
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+
+def make_weather_bot(api_url):
+    smart_bot = make_bot()
+    smart_bot.accuweather_api_key = 'KLUCZ'
+    smart_bot.weather_api_url = api_url.rstrip('/')
+    smart_bot.weather_locations.file = os.path.join(tempfile.mkdtemp(), 'weather_locations.json')
+    return smart_bot
+
+
+def test_location_searches_saved_once_at_a_time():
+    async def scenario():
+        async with FakeAccuWeatherServer() as api_url:
+            smart_bot = make_weather_bot(api_url)
+            await asyncio.gather(*(smart_bot.search_weather_location(city) for city in ("Kraków", "Gdańsk", "Atlantyda")))
+            await smart_bot.weather_locations.saver.task
+            with open(smart_bot.weather_locations.file, 'r', encoding='utf-8') as f:
+                stored = {key: location for key, _, location in json.load(f)}
+            assert stored == {'krakow': ['274455', 'Kraków', 'Polska'], 'gdansk': ['275174', 'Gdańsk', 'Polska'], 'atlantyda': None}
+            await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_weather_lookup_counted_once_per_question():
+    async def scenario():
+        fake = FakeAccuWeatherServer()
+        async with fake as api_url:
+            smart_bot = make_weather_bot(api_url)
+            locations = smart_bot.weather_locations
+            assert "Kraków" in await smart_bot.get_weather("Kraków")
+            assert (locations.hits, locations.misses) == (0, 1)
+            assert "Kraków" in await smart_bot.get_weather("krakow")  # warunki z cache
+            assert (locations.hits, locations.misses) == (1, 1)
+            assert await smart_bot.get_weather("Atlantyda") == "❌ Nie znaleziono miasta: Atlantyda"
+            assert (locations.hits, locations.misses) == (1, 2)
+
+            locations.preload = ["Kraków", "Gdańsk"]
+            await smart_bot.preload_weather_locations()
+            assert (locations.hits, locations.misses) == (2, 3)
+            assert fake.searches == ["Kraków", "Atlantyda", "Gdańsk"]
+            await smart_bot.close_http_session()
+
+    asyncio.run(scenario())
+
+
+def test_weather_conditions_cache_fresh_stale_miss():
+    with FakeClock() as clock:
+        cache = bot.WeatherConditionsCache({'conditions_fresh_minutes': 10, 'conditions_max_stale_minutes': 60, 'max_conditions': 2})
+        assert cache.get("274455") == (None, True)
+        cache.put("274455", "☀️ 21°C")
+        assert cache.get("274455") == ("☀️ 21°C", False)
+        clock.advance(600)
+        assert cache.get("274455") == ("☀️ 21°C", True)
+        clock.advance(3000)
+        assert cache.get("274455") == (None, True)
+        assert cache.stats() == {'entries': 1, 'fresh': 1, 'stale': 1, 'miss': 2}
+        for key in ("a", "b", "c"):
+            cache.put(key, key)
+        assert list(cache.entries) == ["b", "c"]
+
+
+if __name__ == "__main__":
+    failed = 0
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            try:
+                test()
+                print(f"✅ {name}")
+            except Exception as e:
+                failed += 1
+                print(f"❌ {name}: {e!r}")
+    sys.exit(1 if failed else 0)